@@ -3,6 +3,16 @@ import sys
 from pathlib import Path
 
 import appdirs
+
+# Opt-in timing of the startup files (see xfp_lib/startup_profiler.py):
+if os.environ.get("XFP_PROFILE_STARTUP"):
+    from xfp_lib import startup_profiler
+
+    startup_profiler.install(
+        get_ipython(),
+        appdirs.user_data_dir(appname="bluesky") / Path("startup-profile.jsonl"),
+    )
+
 import bluesky.plan_stubs as bps
 import bluesky.plans as bp
 import bluesky.preprocessors as bpp
@@ -12,12 +22,24 @@ import nslsii
 import pandas as pd
 import yaml
 from bluesky.callbacks.best_effort import BestEffortCallback
-from bluesky.utils import PersistentDict
 from matplotlib._pylab_helpers import Gcf
 from matplotlib.backends.backend_qt5 import _create_qApp
 
-# Disable Best Effort Callback at the moment (01/18/2018):
-nslsii.configure_base(get_ipython().user_ns, "xfp", bec=False, pbar=False, publish_documents_with_kafka=True)
+# Offline simulation mode: XFP_SIM=1 runs all startup files against a model of
+# the beamline instead of the IOCs (see xfp_sim/):
+XFP_SIM = bool(os.environ.get("XFP_SIM"))
+
+if XFP_SIM:
+    import xfp_sim
+    from databroker import Broker
+
+    sim_model = xfp_sim.install(speed=float(os.environ.get("XFP_SIM_SPEED", 1)))
+    # configure_base only defines db when given a broker name:
+    db = Broker.named("temp")
+    nslsii.configure_base(get_ipython().user_ns, db, bec=False, pbar=False)
+else:
+    # Disable Best Effort Callback at the moment (01/18/2018):
+    nslsii.configure_base(get_ipython().user_ns, "xfp", bec=False, pbar=False, publish_documents_with_kafka=True)
 
 # nice format string to use in various places
 _time_fmtstr = "%Y-%m-%d %H:%M:%S"
@@ -31,10 +53,17 @@ def xfp_print(string, stdout=sys.stdout, flush=True):
 
 
 runengine_metadata_dir = appdirs.user_data_dir(appname="bluesky") / Path(
-    "runengine-metadata"
+    "runengine-metadata-sim" if XFP_SIM else "runengine-metadata"
 )
 
-# PersistentDict will create the directory if it does not exist
-RE.md = PersistentDict(runengine_metadata_dir)
+if XFP_SIM:
+    xfp_print("Running in offline simulation mode: no EPICS IOCs are used.")
+
+# BatchedPersistentDict (a PersistentDict writing once per transaction and
+# scan_id block, see xfp_lib/batched_persistent_dict.py) will create the
+# directory if it does not exist
+from xfp_lib.batched_persistent_dict import BatchedPersistentDict
+
+RE.md = BatchedPersistentDict(runengine_metadata_dir)
 
 app = _create_qApp()
@@ -8,10 +8,11 @@ def set_user_md():
     saf_num = input("Enter the SAF number: ")
     pi_name = input("Enter last name of the PI: ")
     user_name = input("Enter last name of the lead experimenter: ")
-    RE.md['proposal'] = proposal_num
-    RE.md['SAF'] = saf_num
-    RE.md['PI'] = pi_name
-    RE.md['experimenter'] = user_name
+    with RE.md.transaction():
+        RE.md['proposal'] = proposal_num
+        RE.md['SAF'] = saf_num
+        RE.md['PI'] = pi_name
+        RE.md['experimenter'] = user_name
     print(f"\nSet proposal number to {proposal_num} and SAF number to {saf_num}.")
     print(f"Set the PI to {pi_name} and lead experimenter to {user_name}.")
 
@@ -20,10 +21,11 @@ def clear_user_md():
     #Current proposal/SAF valid for CY2024
     inp_choice = input("Are you sure you want to clear metadata (y/n)? ")
     if inp_choice=='y' or inp_choice=='yes':
-        RE.md['proposal'] = '317793'
-        RE.md['SAF'] = '315353'
-        RE.md['PI'] = 'Farquhar'
-        RE.md['experimenter'] = 'Farquhar'
+        with RE.md.transaction():
+            RE.md['proposal'] = '317793'
+            RE.md['SAF'] = '315353'
+            RE.md['PI'] = 'Farquhar'
+            RE.md['experimenter'] = 'Farquhar'
         print("Reset metadata keys to commissioning proposal.")
     else:
         print("\nNo change made! Current persistant metadata is:")
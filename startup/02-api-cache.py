@@ -0,0 +1,137 @@
+#On-disk cache of the NSLS-II API responses (proposals, cycle proposal lists,
+#current cycle) used by 02-proposal-utils.py. Each endpoint has its own
+#time-to-live (API_CACHE_TTLS); older entries are refetched, but are still
+#served when the API cannot be reached. The least recently used entries are
+#evicted beyond API_CACHE_MAX_ENTRIES. api_cache.invalidate() forces a refetch.
+
+import contextlib
+import json
+import sqlite3
+import threading
+import time as ttime
+from collections import namedtuple
+from pathlib import Path
+
+import appdirs
+
+# Time-to-live of the cached responses [s], by URL prefix (first match wins)
+API_CACHE_TTLS = (
+    ('facility/nsls2/cycles/current', 3600),
+    ('facility/nsls2/cycle/', 6 * 3600),
+    ('proposal/', 6 * 3600),
+)
+
+# Maximum number of cached responses
+API_CACHE_MAX_ENTRIES = 5000
+
+# A cached response: the decoded JSON, when it was fetched and whether it is
+# younger than its time-to-live
+CachedResponse = namedtuple('CachedResponse', ['data', 'time', 'fresh'])
+
+
+class APICache:
+    '''
+    Persistent cache of JSON API responses, keyed by URL.
+
+    Parameters
+    ----------
+    path: Path or string
+        SQLite database the cache is stored in.
+
+    ttls: sequence of (string, float)
+        Time-to-live in seconds by URL prefix. URLs matching no prefix are
+        always refetched (but still served when the API is unreachable).
+
+    max_entries: int
+        The least recently used responses are dropped beyond this number.
+    '''
+    def __init__(self, path, ttls=API_CACHE_TTLS, max_entries=API_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.ttls = tuple(ttls)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                         '(url TEXT PRIMARY KEY, data TEXT, time REAL, used REAL)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one short-lived connection (and transaction) per operation: several
+        # sessions may share the file
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def ttl(self, url):
+        '''Time-to-live [s] of the responses of `url`.'''
+        for prefix, ttl in self.ttls:
+            if url.startswith(prefix):
+                return ttl
+        return 0
+
+    def get_many(self, urls):
+        '''
+        Cached responses of `urls`.
+
+        Returns
+        -------
+        responses: dict
+            CachedResponse by URL, for the URLs in the cache.
+        '''
+        urls = list(urls)
+        now = ttime.time()
+        responses = {}
+        with self._lock, self._connect() as conn:
+            # stay under SQLite's limit on the number of query parameters
+            for i in range(0, len(urls), 500):
+                chunk = urls[i:i + 500]
+                marks = ','.join('?' * len(chunk))
+                rows = conn.execute(f'SELECT url, data, time FROM responses WHERE url IN ({marks})',
+                                    chunk).fetchall()
+                conn.execute(f'UPDATE responses SET used = ? WHERE url IN ({marks})', [now, *chunk])
+                for url, data, fetched in rows:
+                    responses[url] = CachedResponse(json.loads(data), fetched,
+                                                    now - fetched < self.ttl(url))
+        return responses
+
+    def get(self, url):
+        '''Cached response of `url` (a CachedResponse), or None.'''
+        return self.get_many([url]).get(url)
+
+    def put_many(self, responses):
+        '''Store fresh responses, given as a dict of decoded JSON by URL.'''
+        if not responses:
+            return
+        now = ttime.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                             [(url, json.dumps(data), now, now) for url, data in responses.items()])
+            conn.execute('DELETE FROM responses WHERE url NOT IN '
+                         '(SELECT url FROM responses ORDER BY used DESC LIMIT ?)',
+                         (self.max_entries,))
+
+    def put(self, url, data):
+        '''Store a fresh response.'''
+        self.put_many({url: data})
+
+    def invalidate(self, prefix=''):
+        '''
+        Drop cached responses.
+
+        Parameters
+        ----------
+        prefix: string, optional
+            Only drop the URLs starting with it, e.g. 'proposal/'. Everything
+            is dropped if not given.
+        '''
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses WHERE substr(url, 1, ?) = ?",
+                         (len(prefix), prefix))
+
+
+api_cache = APICache(appdirs.user_cache_dir(appname="bluesky") / Path("nsls2-api-cache.sqlite"))
@@ -1,31 +1,199 @@
 #Borrow from  https://github.com/NSLS-II/nsls2api_for_mx/
 
+import asyncio
+import atexit
+import concurrent.futures
+import threading
+import time
+
 import httpx
 
 base_url = "https://api.nsls2.bnl.gov/v1"
 
+# Timeout of a single API request [s]
+API_TIMEOUT = 10
+# Number of attempts of a request failing with a network error or a 5xx/429 response
+API_ATTEMPTS = 3
+# Delay before the first retry [s], doubled for each further retry
+API_RETRY_DELAY = 0.5
+# Maximum number of proposals fetched at the same time
+API_MAX_CONCURRENT = 16
+
+# Pooled connection for the one-off requests, opened on the first request:
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+def _get_api_client():
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            _api_client = httpx.Client(base_url=base_url, timeout=API_TIMEOUT)
+            atexit.register(_api_client.close)
+        return _api_client
+
+
+def _retry_response(response):
+    return response.status_code == httpx.codes.TOO_MANY_REQUESTS or response.status_code >= 500
+
+
+class APIUnavailableError(RuntimeError):
+    '''The NSLS-II API could not be reached, or kept failing.'''
+
+
+def _api_result(url, response):
+    if response.status_code == httpx.codes.OK:
+        return response.json()
+    raise RuntimeError(f"Failed to get value from {url}. response code: {response.status_code}")
+
+
+def _fetch_from_api(url):
+    for attempt in range(API_ATTEMPTS):
+        if attempt:
+            time.sleep(API_RETRY_DELAY * 2 ** (attempt - 1))
+        try:
+            response = _get_api_client().get(url)
+        except httpx.TransportError as err:
+            error = repr(err)
+            continue
+        if not _retry_response(response):
+            return _api_result(url, response)
+        error = f"response code: {response.status_code}"
+    raise APIUnavailableError(f"Failed to get value from {url}. {error}")
+
+
+async def _fetch_from_api_async(client, semaphore, url):
+    async with semaphore:
+        for attempt in range(API_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(API_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                response = await client.get(url)
+            except httpx.TransportError as err:
+                error = repr(err)
+                continue
+            if not _retry_response(response):
+                return _api_result(url, response)
+            error = f"response code: {response.status_code}"
+    raise APIUnavailableError(f"Failed to get value from {url}. {error}")
+
+
+def _stale_response(url, cached, error):
+    age = (time.time() - cached.time) / 3600
+    print(f"NSLS-II API unavailable ({error}), using the cached {url} from {age:.1f} h ago.")
+    return cached.data
+
+
 def get_from_api(url):
+    '''
+    Get `url` from the NSLS-II API, through the on-disk cache (02-api-cache.py).
+    '''
     if url:
-        response = httpx.get(f"{base_url}/{url}")
-        if response.status_code == httpx.codes.OK:
-            return response.json()
-        raise RuntimeError(f"Failed to get value from {url}. response code: {response.status_code}")
+        cached = api_cache.get(url)
+        if cached is not None and cached.fresh:
+            return cached.data
+        try:
+            data = _fetch_from_api(url)
+        except APIUnavailableError as err:
+            if cached is None:
+                raise
+            return _stale_response(url, cached, err)
+        api_cache.put(url, data)
+        return data
     else:
         raise ValueError("URL cannot be empty")
 
+
+async def _fetch_many_async(urls):
+    semaphore = asyncio.Semaphore(API_MAX_CONCURRENT)
+    limits = httpx.Limits(max_connections=API_MAX_CONCURRENT)
+    async with httpx.AsyncClient(base_url=base_url, timeout=API_TIMEOUT, limits=limits) as client:
+        results = await asyncio.gather(
+            *(_fetch_from_api_async(client, semaphore, url) for url in urls),
+            return_exceptions=True)
+    return dict(zip(urls, results))
+
+
+def _fetch_many(urls):
+    if not urls:
+        return {}
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_fetch_many_async(urls))
+    # An event loop already runs in this thread (e.g. in Jupyter): use another one.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, _fetch_many_async(urls)).result()
+
+
+def get_proposals_info(proposal_ids, errors=None):
+    '''
+    Fetch several proposals concurrently, over one pooled connection.
+
+    Proposals in the on-disk cache are not fetched again until they expire.
+
+    Parameters
+    ----------
+    proposal_ids: iterable of str
+        Proposal numbers; each one is fetched once.
+
+    errors: dict, optional
+        If given, the proposals that could not be fetched (e.g. withdrawn)
+        are left out and their errors stored here by proposal number, instead
+        of raising the first one.
+
+    Returns
+    -------
+    proposals: dict
+        Proposal info by proposal number, in the order of proposal_ids.
+    '''
+    urls = {proposal_id: f"proposal/{proposal_id}" for proposal_id in proposal_ids}
+    cached = api_cache.get_many(urls.values())
+    fetched = _fetch_many([url for url in urls.values()
+                           if url not in cached or not cached[url].fresh])
+    fresh = {}
+    for url, result in fetched.items():
+        if not isinstance(result, Exception):
+            fresh[url] = result
+    api_cache.put_many(fresh)
+
+    proposals = {}
+    stale = []
+    for proposal_id, url in urls.items():
+        result = fetched.get(url)
+        if result is None:
+            result = cached[url].data
+        elif isinstance(result, APIUnavailableError) and url in cached:
+            stale.append((cached[url], result))
+            result = cached[url].data
+        elif isinstance(result, Exception):
+            if errors is None:
+                raise result
+            errors[proposal_id] = result
+            continue
+        proposals[proposal_id] = result['proposal']
+    if stale:
+        age = (time.time() - min(cached.time for cached, _ in stale)) / 3600
+        print(f"NSLS-II API unavailable ({stale[0][1]}), using {len(stale)} cached "
+              f"proposals up to {age:.1f} h old.")
+    return proposals
+
+
 def get_proposals_from_cycle(cycle):
     return get_from_api(f"facility/nsls2/cycle/{cycle}/proposals")['proposals']
 def get_proposal_info(proposal_id):
     return get_from_api(f"proposal/{proposal_id}")['proposal']
 
+def get_instrument_proposals_info(cycle, instrument):
+    '''
+    Info of the proposals of the cycle on the instrument, by proposal number.
+    '''
+    proposals = get_proposals_info(get_proposals_from_cycle(cycle))
+    return {proposal_num: proposal for proposal_num, proposal in proposals.items()
+            if instrument in proposal['instruments']}
+
 def get_proposals_for_instrument(cycle, instrument):
-    proposals_on_instrument = []
-    proposals = get_proposals_from_cycle(cycle)
-    for proposal_num in proposals:
-        proposal = get_proposal_info(proposal_num)
-        if instrument in proposal['instruments']:
-            proposals_on_instrument.append(proposal_num)
-    return proposals_on_instrument
+    return list(get_instrument_proposals_info(cycle, instrument))
 
 def get_current_cycle():
     return get_from_api(f"facility/nsls2/cycles/current")["cycle"]
@@ -37,12 +205,13 @@ def inst_proposals_report(cycle, instrument, detail):
     Returns report listing proposal number, title, type, and PI
     '''   
     print(f"Retrieving {instrument} proposals for the {cycle} cycle. This may take some time.")
-    proposal_list = sorted(get_proposals_for_instrument(cycle, instrument), key=int)
+    proposals = get_instrument_proposals_info(cycle, instrument)
+    proposal_list = sorted(proposals, key=int)
     
     if detail == 'long':
         print(f"\nLong Report of {instrument} proposals for {cycle} cycle")
         for item in proposal_list:
-            single_prop = get_proposal_info(item)
+            single_prop = proposals[item]
             print("\nProposal #:", single_prop['proposal_id'], " Title:", single_prop['title'])
             print("Proposal Type:", single_prop['type'])
             pi_users = [user for user in single_prop['users'] if user['is_pi']]
@@ -61,7 +230,7 @@ def inst_proposals_report(cycle, instrument, detail):
     if detail == 'medium':
         print(f"\nMedium Report of {instrument} proposals for {cycle} cycle")
         for item in proposal_list:
-            single_prop = get_proposal_info(item)
+            single_prop = proposals[item]
             print("\nProposal #:", single_prop['proposal_id'], " Title:", single_prop['title'])
             print("Proposal Type:", single_prop['type'])
             #sometimes this prints out multiple entries for same PI due to data source
@@ -75,7 +244,7 @@ def inst_proposals_report(cycle, instrument, detail):
     if detail == 'short':
         print(f"\nShort Report of {instrument} proposals for {cycle} cycle")
         for item in proposal_list:
-            single_prop = get_proposal_info(item)
+            single_prop = proposals[item]
             print("Proposal #:", single_prop['proposal_id'], " Title:", single_prop['title'])
 
 def api_proposal_report(proposal_num):
@@ -123,9 +292,10 @@ def set_user_md_api():
     saf_num = input("\nEnter the SAF number: ")
     pi_name = input("Enter last name of the PI: ")
     user_name = input("Enter last name of the lead experimenter: ")
-    RE.md['proposal'] = proposal_num
-    RE.md['SAF'] = saf_num
-    RE.md['PI'] = pi_name
-    RE.md['experimenter'] = user_name
+    with RE.md.transaction():
+        RE.md['proposal'] = proposal_num
+        RE.md['SAF'] = saf_num
+        RE.md['PI'] = pi_name
+        RE.md['experimenter'] = user_name
     print(f"\nSet proposal number to {proposal_num} and SAF number to {saf_num}.")
     print(f"Set the PI to {pi_name} and lead experimenter to {user_name}.")
\ No newline at end of file
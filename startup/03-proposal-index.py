@@ -0,0 +1,256 @@
+#Local searchable index of the proposals of a cycle, for a fast user metadata
+#setup: set_user_md_search('smith') finds the proposals by PI or user last
+#name prefix, picks the approved SAF and sets RE.md. The index is built in bulk
+#from the NSLS-II API (through the cache of 02-api-cache.py) and rebuilt when
+#older than PROPOSAL_INDEX_MAX_AGE.
+
+import contextlib
+import json
+import sqlite3
+import time as ttime
+from pathlib import Path
+
+import appdirs
+
+# The index of a cycle is rebuilt when older than this [s]
+PROPOSAL_INDEX_MAX_AGE = 6 * 3600
+
+
+class ProposalIndex:
+    '''
+    SQLite index of proposals: title, type, instruments, users (and PIs) and
+    approved SAFs, searchable by last name prefix.
+
+    Parameters
+    ----------
+    path: Path or string
+        SQLite database the index is stored in.
+    '''
+    # Bumped when the schema changes: older indexes are dropped and rebuilt
+    schema_version = 1
+    schema = '''
+        CREATE TABLE IF NOT EXISTS cycles (cycle TEXT PRIMARY KEY, built REAL);
+        CREATE TABLE IF NOT EXISTS proposals (
+            proposal_id TEXT PRIMARY KEY, title TEXT, type TEXT, instruments TEXT);
+        CREATE TABLE IF NOT EXISTS proposal_cycles (
+            proposal_id TEXT, cycle TEXT, PRIMARY KEY (proposal_id, cycle));
+        CREATE INDEX IF NOT EXISTS proposal_cycles_cycle ON proposal_cycles (cycle);
+        CREATE TABLE IF NOT EXISTS users (
+            proposal_id TEXT, first_name TEXT, last_name TEXT, name_key TEXT,
+            username TEXT, email TEXT, is_pi INTEGER);
+        CREATE INDEX IF NOT EXISTS users_name_key ON users (name_key);
+        CREATE TABLE IF NOT EXISTS safs (proposal_id TEXT, saf_id TEXT, status TEXT);
+        CREATE INDEX IF NOT EXISTS safs_proposal ON safs (proposal_id);
+    '''
+    tables = ('cycles', 'proposals', 'proposal_cycles', 'users', 'safs')
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.schema_version:
+                for table in self.tables:
+                    conn.execute(f'DROP TABLE IF EXISTS {table}')
+                conn.execute(f'PRAGMA user_version = {self.schema_version}')
+            conn.executescript(self.schema)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def age(self, cycle):
+        '''Age [s] of the index of `cycle`, None if it was never built.'''
+        with self._connect() as conn:
+            row = conn.execute('SELECT built FROM cycles WHERE cycle = ?', (cycle,)).fetchone()
+        return None if row is None else ttime.time() - row['built']
+
+    def build(self, cycle):
+        '''
+        (Re)build the index of `cycle` from the NSLS-II API.
+
+        Proposals that cannot be fetched (e.g. withdrawn ones) are skipped;
+        the index of the other cycles of a proposal is kept.
+
+        Returns
+        -------
+        n_proposals: int
+            Number of proposals indexed.
+        '''
+        errors = {}
+        proposals = get_proposals_info(get_proposals_from_cycle(cycle), errors)
+        if errors and not proposals:
+            raise next(iter(errors.values()))
+        if errors:
+            print(f"Skipped {len(errors)} proposals of the {cycle} cycle that could not be "
+                  f"fetched: {', '.join(str(proposal_id) for proposal_id in errors)}")
+        new = [(str(proposal_id),) for proposal_id in proposals]
+        with self._connect() as conn:
+            conn.execute('DELETE FROM proposal_cycles WHERE cycle = ?', (cycle,))
+            conn.executemany('INSERT INTO proposal_cycles VALUES (?, ?)',
+                             [(proposal_id, cycle) for proposal_id, in new])
+            # the proposals of no cycle any more, and the fetched ones (fresh info)
+            old = [(row['proposal_id'],) for row in conn.execute(
+                'SELECT proposal_id FROM proposals WHERE proposal_id NOT IN '
+                '(SELECT proposal_id FROM proposal_cycles)')]
+            for table in ('proposals', 'users', 'safs'):
+                conn.executemany(f'DELETE FROM {table} WHERE proposal_id = ?', old + new)
+            conn.executemany(
+                'INSERT INTO proposals VALUES (?, ?, ?, ?)',
+                [(str(proposal_id), p['title'], p['type'], json.dumps(p['instruments']))
+                 for proposal_id, p in proposals.items()])
+            conn.executemany(
+                'INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(str(proposal_id), u.get('first_name'), u['last_name'], _name_key(u['last_name']),
+                  u.get('username'), u.get('email'), int(bool(u.get('is_pi'))))
+                 for proposal_id, p in proposals.items() for u in p['users'] if u.get('last_name')])
+            conn.executemany(
+                'INSERT INTO safs VALUES (?, ?, ?)',
+                [(str(proposal_id), str(saf['saf_id']), saf['status'])
+                 for proposal_id, p in proposals.items() for saf in p.get('safs') or []])
+            conn.execute('INSERT OR REPLACE INTO cycles VALUES (?, ?)', (cycle, ttime.time()))
+        return len(proposals)
+
+    def ensure(self, cycle, max_age=PROPOSAL_INDEX_MAX_AGE):
+        '''Build the index of `cycle` if it is missing or older than `max_age` [s].'''
+        age = self.age(cycle)
+        if age is None or age > max_age:
+            print(f"Indexing the proposals of the {cycle} cycle...")
+            self.build(cycle)
+
+    def search(self, name, *, cycle=None, instrument='XFP', pi_only=False):
+        '''
+        Proposals with a PI (or any user) whose last name starts with `name`.
+
+        Parameters
+        ----------
+        name: string
+            Last name prefix, case-insensitive.
+
+        cycle: string, optional
+            Only search the proposals of this cycle.
+
+        instrument: string, optional
+            Only search the proposals on this instrument (None for all).
+
+        pi_only: bool
+            Only match the PIs.
+
+        Returns
+        -------
+        matches: list of dict
+            Proposal id, title, type, PIs (last names), matching users and
+            approved SAFs of each proposal, most recent proposal first.
+        '''
+        key = _name_key(name)
+        query = ('SELECT DISTINCT users.proposal_id, last_name FROM users '
+                 'JOIN proposals USING (proposal_id) WHERE name_key >= ? AND name_key < ?')
+        params = [key, key + '\uffff']
+        if pi_only:
+            query += ' AND is_pi'
+        if cycle is not None:
+            query += (' AND proposal_id IN '
+                      '(SELECT proposal_id FROM proposal_cycles WHERE cycle = ?)')
+            params.append(cycle)
+        with self._connect() as conn:
+            matched = {}
+            for row in conn.execute(query, params):
+                matched.setdefault(row['proposal_id'], []).append(row['last_name'])
+            matches = []
+            for proposal_id, users in matched.items():
+                info = self.proposal(proposal_id, conn=conn)
+                if instrument is None or instrument in info['instruments']:
+                    matches.append(dict(info, matched_users=users))
+        return sorted(matches, key=lambda m: int(m['proposal_id']), reverse=True)
+
+    def proposal(self, proposal_id, *, conn=None):
+        '''Indexed info of a proposal (see search()), None if not indexed.'''
+        if conn is None:
+            with self._connect() as conn:
+                return self.proposal(proposal_id, conn=conn)
+        row = conn.execute('SELECT * FROM proposals WHERE proposal_id = ?',
+                           (str(proposal_id),)).fetchone()
+        if row is None:
+            return None
+        pis = [r['last_name'] for r in conn.execute(
+            'SELECT last_name FROM users WHERE proposal_id = ? AND is_pi', (row['proposal_id'],))]
+        safs = [r['saf_id'] for r in conn.execute(
+            "SELECT saf_id FROM safs WHERE proposal_id = ? AND status = 'APPROVED' "
+            "ORDER BY CAST(saf_id AS INTEGER) DESC", (row['proposal_id'],))]
+        cycles = [r['cycle'] for r in conn.execute(
+            'SELECT cycle FROM proposal_cycles WHERE proposal_id = ? ORDER BY cycle',
+            (row['proposal_id'],))]
+        return {'proposal_id': row['proposal_id'], 'cycles': cycles,
+                'title': row['title'], 'type': row['type'],
+                'instruments': json.loads(row['instruments']),
+                'pis': list(dict.fromkeys(pis)), 'approved_safs': safs}
+
+
+def _name_key(name):
+    return name.strip().casefold()
+
+
+def _print_match(i, match):
+    print(f"{i:>3}. Proposal #{match['proposal_id']} ({match['type']}), "
+          f"PI: {', '.join(match['pis']) or '-'}, users: {', '.join(match['matched_users'])}")
+    print(f"     {match['title']}")
+    print(f"     Approved SAFs: {', '.join(match['approved_safs']) or 'none'}")
+
+
+def set_user_md_search(name=None, *, cycle=None):
+    '''
+    Set the user metadata from the local proposal index.
+
+    Finds the XFP proposals with a PI or user whose last name starts with
+    `name`, asks which one if several match, and sets the proposal, its most
+    recent approved SAF, the PI and the lead experimenter (the matched user)
+    in RE.md.
+
+    Parameters
+    ----------
+    name: string, optional
+        Last name prefix of the PI or of a user; asked for if not given.
+
+    cycle: string, optional
+        Cycle to search, the current one by default.
+    '''
+    if cycle is None:
+        cycle = get_current_cycle()
+    proposal_index.ensure(cycle)
+    if name is None:
+        name = input("Enter the (beginning of the) last name of the PI or a user: ")
+    matches = proposal_index.search(name, cycle=cycle)
+    if not matches:
+        print(f"No XFP proposal of the {cycle} cycle with a user named {name}*. "
+              "Use set_user_md_api() or set_user_md() instead.")
+        return
+    for i, match in enumerate(matches, start=1):
+        _print_match(i, match)
+    if len(matches) == 1:
+        match = matches[0]
+    else:
+        choice = input(f"\nSelect the proposal [1-{len(matches)}]: ")
+        try:
+            match = matches[int(choice) - 1]
+        except (ValueError, IndexError):
+            print("No change made!")
+            return
+    if not match['approved_safs']:
+        print(f"Proposal #{match['proposal_id']} has no approved SAF, no change made!")
+        return
+
+    with RE.md.transaction():
+        RE.md['proposal'] = match['proposal_id']
+        RE.md['SAF'] = match['approved_safs'][0]
+        RE.md['PI'] = match['pis'][0] if match['pis'] else match['matched_users'][0]
+        RE.md['experimenter'] = match['matched_users'][0]
+    print(f"\nSet proposal number to {RE.md['proposal']} and SAF number to {RE.md['SAF']}.")
+    print(f"Set the PI to {RE.md['PI']} and lead experimenter to {RE.md['experimenter']}.")
+
+
+proposal_index = ProposalIndex(appdirs.user_cache_dir(appname="bluesky") / Path("nsls2-proposal-index.sqlite"))
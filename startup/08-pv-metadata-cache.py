@@ -0,0 +1,209 @@
+#On-disk cache of PV metadata that (almost) never changes: enum strings, units,
+#precision and control limits, plus the values of static PVs such as motor EGUs.
+#The code that needs them before the channels connect reads them through
+#pv_metadata.enum_strs(), .limits() and .value(); ophyd's own metadata of the
+#signals is left alone. The cache is refreshed in the background from the
+#metadata that arrives when the channels connect (see track() and
+#30-connect-all.py). Cache entries expire after XFP_PV_CACHE_MAX_AGE seconds
+#(default one week); pv_metadata.invalidate() drops them by hand.
+
+import atexit
+import json
+import os
+import threading
+import time as ttime
+from pathlib import Path
+
+import appdirs
+from ophyd import Device
+from ophyd.signal import EpicsSignalBase
+
+
+class PVMetadataCache:
+    '''
+    Persistent cache of static PV metadata, keyed by PV name.
+
+    Parameters
+    ----------
+    path: Path or string
+        JSON file the cache is stored in.
+
+    max_age: float
+        Entries older than this (in seconds) are ignored.
+
+    save_delay: float
+        Changes are written to disk this many seconds after the last update
+        (and at exit), so that a burst of connections is saved only once.
+    '''
+    version = 1
+    metadata_keys = ('enum_strs', 'units', 'precision',
+                     'lower_ctrl_limit', 'upper_ctrl_limit')
+
+    def __init__(self, path, max_age=7 * 24 * 3600, save_delay=5):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.save_delay = save_delay
+        self._lock = threading.RLock()
+        self._save_timer = None
+        self._dirty = False
+        self._tracked = set()
+        self._pvs = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print(f"Ignoring corrupt PV metadata cache {self.path}")
+            return {}
+        if data.get('version') != self.version:
+            return {}
+        now = ttime.time()
+        return {pvname: entry for pvname, entry in data.get('pvs', {}).items()
+                if now - entry.get('time', 0) < self.max_age}
+
+    def save(self):
+        '''Write the cache to disk now, if it changed.'''
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._dirty:
+                return
+            data = {'version': self.version, 'pvs': self._pvs}
+            self._dirty = False
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError) as err:
+            print(f"Could not save the PV metadata cache: {err}")
+
+    def _schedule_save(self):
+        with self._lock:
+            self._dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def get(self, pvname, key, default=None):
+        '''Cached `key` ('units', 'enum_strs', 'value', ...) of a PV.'''
+        with self._lock:
+            return self._pvs.get(pvname, {}).get(key, default)
+
+    def update(self, pvname, **metadata):
+        '''Store fresh metadata for a PV; None values are ignored.'''
+        metadata = {k: list(v) if isinstance(v, tuple) else v
+                    for k, v in metadata.items() if v is not None}
+        if not metadata:
+            return
+        with self._lock:
+            entry = self._pvs.setdefault(pvname, {})
+            now = ttime.time()
+            stale = now - entry.get('time', 0) > self.max_age / 2
+            changed = any(entry.get(k) != v for k, v in metadata.items())
+            entry.update(metadata, time=now)
+            if changed or stale:
+                self._schedule_save()
+
+    def invalidate(self, pvname=None):
+        '''
+        Drop cached metadata.
+
+        Parameters
+        ----------
+        pvname: string or ophyd object, optional
+            PV name, signal or device to forget. Everything is dropped if
+            not given.
+        '''
+        with self._lock:
+            if pvname is None:
+                self._pvs.clear()
+            else:
+                for name in _pvnames(pvname):
+                    self._pvs.pop(name, None)
+            self._schedule_save()
+
+    def _metadata_changed(self, *, obj, connected=False, **metadata):
+        if connected:
+            self.update(obj.pvname, **{key: metadata.get(key) for key in self.metadata_keys})
+
+    def _value_changed(self, *, obj, value, **kwargs):
+        self.update(obj.pvname, value=value)
+
+    def track(self, obj):
+        '''
+        Keep the cache up to date with the metadata of the EPICS signals of a
+        device (or of a single signal).
+        '''
+        for sig in _epics_signals(obj):
+            if ('meta', id(sig)) not in self._tracked:
+                self._tracked.add(('meta', id(sig)))
+                sig.subscribe(self._metadata_changed, event_type=sig.SUB_META, run=sig.connected)
+
+    def value(self, signal, default=None):
+        '''
+        Value of a static PV (e.g. a motor .EGU) without waiting for it.
+
+        Returns the live value if the signal is connected, else the cached one
+        (or `default`). The cache follows the value from then on.
+        '''
+        if ('value', id(signal)) not in self._tracked:
+            self._tracked.add(('value', id(signal)))
+            signal.subscribe(self._value_changed, run=False)
+        if signal.connected:
+            return signal.get()
+        return self.get(signal.pvname, 'value', default)
+
+    def enum_strs(self, signal, timeout=2):
+        '''
+        Enum strings of a signal: live if known, else cached, and only as a
+        last resort wait (up to `timeout` s) for the signal to connect.
+        '''
+        if signal.enum_strs is not None:
+            return signal.enum_strs
+        cached = self.get(signal.pvname, 'enum_strs')
+        if cached is not None:
+            return tuple(cached)
+        signal.wait_for_connection(timeout=timeout)
+        return signal.enum_strs
+
+    def limits(self, signal, default=(0, 0)):
+        '''
+        Control limits (low, high) of a signal: live if connected, else cached
+        (or `default`), without waiting for the signal.
+        '''
+        if signal.connected:
+            return signal.limits
+        low = self.get(signal.pvname, 'lower_ctrl_limit')
+        high = self.get(signal.pvname, 'upper_ctrl_limit')
+        if low is None or high is None:
+            return default
+        return (low, high)
+
+
+def _epics_signals(obj):
+    if isinstance(obj, EpicsSignalBase):
+        return [obj]
+    if isinstance(obj, Device):
+        return [walk.item for walk in obj.walk_signals()
+                if isinstance(walk.item, EpicsSignalBase)]
+    return []
+
+
+def _pvnames(obj):
+    if isinstance(obj, str):
+        return [obj]
+    return [sig.pvname for sig in _epics_signals(obj)]
+
+
+pv_metadata = PVMetadataCache(
+    appdirs.user_cache_dir(appname="bluesky") / Path("xfp-pv-metadata.json"),
+    max_age=float(os.environ.get('XFP_PV_CACHE_MAX_AGE', 7 * 24 * 3600)),
+)
+atexit.register(pv_metadata.save)
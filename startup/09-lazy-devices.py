@@ -0,0 +1,162 @@
+#Lazy (on-first-use) devices for stages that are not usually connected.
+#A LazyDevice registers the PV names of the device it stands in for, but the
+#ophyd object (and its CA channels) is only built the first time a plan or the
+#user touches it. Use lazy_device_report() to see which ones were needed.
+
+import atexit
+import threading
+import time as ttime
+
+from ophyd import Device, FormattedComponent
+from ophyd.signal import EpicsSignalBase
+
+# name -> LazyDevice, filled in as the startup files declare them
+lazy_devices = {}
+
+
+def declared_pvnames(cls, prefix=''):
+    '''
+    List the PV names a Device class would connect to, without building it.
+
+    Parameters
+    ----------
+    cls: Device subclass
+        The ophyd device class to inspect.
+
+    prefix: string
+        PV prefix the device would be created with.
+
+    FormattedComponent PVs are skipped since they can only be resolved
+    against a device instance.
+    '''
+    pvnames = []
+    for attr, cpt in cls._sig_attrs.items():
+        if isinstance(cpt, FormattedComponent) or cpt.cls is None:
+            continue
+        suffix = cpt.suffix or ''
+        if issubclass(cpt.cls, Device):
+            pvnames.extend(declared_pvnames(cpt.cls, prefix + suffix))
+        elif issubclass(cpt.cls, EpicsSignalBase):
+            pvnames.append(prefix + suffix)
+            write_pv = cpt.kwargs.get('write_pv')
+            if write_pv is not None and prefix + write_pv not in pvnames:
+                pvnames.append(prefix + write_pv)
+    return pvnames
+
+
+class LazyDevice:
+    '''
+    Stand-in for a rarely connected ophyd Device.
+
+    Behaves like the real device: any attribute that is not one of the proxy's
+    own (name, prefix, pvnames, used, ...) builds the device on first access
+    and is forwarded to it. Until then, private names (leading underscore)
+    which are not components of the device class raise AttributeError
+    without building it, so that IPython's display probes do not connect the
+    device.
+
+    `isinstance(obj, Device)` is False: helpers which skip non-Device objects
+    (e.g. adding devices to the baseline) need `obj.device`. %wa, which looks
+    for `_ophyd_labels_`, only lists the lazy devices already used.
+
+    Parameters
+    ----------
+    cls: Device subclass
+        The ophyd device class to build on first use.
+
+    prefix: string
+        PV prefix, as for the device class.
+
+    name: string
+        Device name, as for the device class.
+
+    kwargs:
+        Passed on to the device class when it is built.
+    '''
+    _own_attrs = ('name', 'prefix', 'pvnames', 'first_used', 'first_used_by')
+
+    def __init__(self, cls, prefix='', *, name, **kwargs):
+        object.__setattr__(self, '_lazy_cls', cls)
+        object.__setattr__(self, '_lazy_kwargs', dict(kwargs, name=name))
+        object.__setattr__(self, '_lazy_device', None)
+        object.__setattr__(self, '_lazy_lock', threading.Lock())
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'prefix', prefix)
+        object.__setattr__(self, 'pvnames', declared_pvnames(cls, prefix))
+        object.__setattr__(self, 'first_used', None)
+        object.__setattr__(self, 'first_used_by', None)
+        lazy_devices[name] = self
+
+    @property
+    def used(self):
+        return self._lazy_device is not None
+
+    @property
+    def device(self):
+        '''The real ophyd device, built (and connecting) on first access.'''
+        return self._materialize('device')
+
+    def _materialize(self, reason):
+        with self._lazy_lock:
+            if self._lazy_device is None:
+                xfp_print(f"Connecting lazy device {self.name} (first use: {reason}).")
+                dev = self._lazy_cls(self.prefix, **self._lazy_kwargs)
+                pv_metadata.track(dev)
+                object.__setattr__(self, '_lazy_device', dev)
+                object.__setattr__(self, 'first_used', ttime.time())
+                object.__setattr__(self, 'first_used_by', reason)
+        return self._lazy_device
+
+    def __getattr__(self, attr):
+        # Only called when normal lookup fails, i.e. for device attributes.
+        if attr.startswith('_lazy') or (self._lazy_device is None and attr.startswith('_') and
+                                        attr not in self._lazy_cls.component_names):
+            raise AttributeError(attr)
+        return getattr(self._materialize(attr), attr)
+
+    def __setattr__(self, attr, value):
+        if attr in self._own_attrs:
+            raise AttributeError(f"Cannot change {attr!r} of lazy device {self.name}")
+        setattr(self._materialize(attr), attr, value)
+
+    def __dir__(self):
+        attrs = set(super().__dir__())
+        attrs.update(self._lazy_cls._sig_attrs)
+        if self._lazy_device is not None:
+            attrs.update(dir(self._lazy_device))
+        return sorted(attrs)
+
+    def __repr__(self):
+        if self._lazy_device is not None:
+            return repr(self._lazy_device)
+        return (f"LazyDevice({self._lazy_cls.__name__}, {self.prefix!r}, "
+                f"name={self.name!r}, not yet connected)")
+
+
+def lazy_device_report(used_only=False):
+    '''
+    Print which lazy devices were used in this session.
+
+    Parameters
+    ----------
+    used_only: boolean
+        Only list the lazy devices that were actually built.
+    '''
+    print(f"{'Device':<15}{'Class':<18}{'PVs':>5}  Status")
+    for name, ld in lazy_devices.items():
+        if ld.used:
+            when = ttime.strftime(_time_fmtstr, ttime.localtime(ld.first_used))
+            status = f"used since {when} (first touched: {ld.first_used_by})"
+        elif used_only:
+            continue
+        else:
+            status = 'not used'
+        print(f"{name:<15}{ld._lazy_cls.__name__:<18}{len(ld.pvnames):>5}  {status}")
+
+
+def _lazy_devices_at_exit():
+    used = [name for name, ld in lazy_devices.items() if ld.used]
+    if lazy_devices:
+        print(f"Lazy devices used this session: {', '.join(used) or 'none'}")
+
+atexit.register(_lazy_devices_at_exit)
@@ -1,6 +1,13 @@
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import numpy as np
 import ophyd
 from ophyd.status import Status
 import epics
+import threading
 import time as ttime
 
 def local_set_and_wait(signal, val, poll_time=0.01, timeout=10, rtol=None,
@@ -86,24 +93,272 @@ def _compare_maybe_enum(a, b, enums, atol, rtol):
 
 
 
+def _pool_thread_init():
+    # like the control layer's thread_class (epics.ca.CAThread for pyepics)
+    if ophyd.cl.name == 'pyepics':
+        epics.ca.use_initial_context()
+
+
+class SignalSetExecutor:
+    '''
+    Runs the set() operations of signals: one at a time per signal, different
+    signals in parallel.
+
+    A set() requested while another one is in progress on the same signal is
+    queued; a newer target replaces a queued one (the statuses of both are
+    finished when the newer one is reached). Queued sets are started, and
+    blocking set operations run, in a bounded pool of threads shared by all
+    signals (never in the status callback of the previous set, which may run
+    in the control layer's dispatcher thread).
+
+    Parameters
+    ----------
+    max_workers: int
+        Number of threads of the pool.
+
+    history: int
+        Number of latencies kept for stats().
+    '''
+    def __init__(self, max_workers=4, history=1000):
+        self._lock = threading.Lock()
+        # signal -> waiters of the set in progress
+        self._running = {}
+        # signal -> (value, start, waiters) of the next set
+        self._queued = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='set_executor',
+            initializer=_pool_thread_init)
+        self.counts = collections.Counter()
+        self.max_depth = 0
+        # (signal name, latency from request to completion [s])
+        self.latencies = collections.deque(maxlen=history)
+
+    def depth(self):
+        '''Number of set() requests in progress or queued.'''
+        with self._lock:
+            return self._depth()
+
+    def _depth(self):
+        return (sum(len(waiters) for waiters in self._running.values()) +
+                sum(len(waiters) for _, _, waiters in self._queued.values()))
+
+    def submit(self, signal, value, start):
+        '''
+        Request a set of `signal` to `value`.
+
+        Parameters
+        ----------
+        signal: Signal
+        value: object
+        start: callable
+            start(value) starts the actual set and returns its status.
+
+        Returns
+        -------
+        st: Status
+            Finished when the set (or a later one superseding it) is done.
+        '''
+        st = Status(signal)
+        waiter = (st, ttime.monotonic())
+        with self._lock:
+            self.counts['submitted'] += 1
+            start_now = signal not in self._running
+            if start_now:
+                waiters = self._running[signal] = [waiter]
+            else:
+                if signal in self._queued:
+                    waiters = self._queued[signal][2]
+                    self.counts['coalesced'] += 1
+                else:
+                    waiters = []
+                waiters.append(waiter)
+                self._queued[signal] = (value, start, waiters)
+            self.max_depth = max(self.max_depth, self._depth())
+        if start_now:
+            self._start(signal, value, start, waiters)
+        return st
+
+    def run(self, func, *args):
+        '''Run a blocking function in the shared pool (a Future).'''
+        return self._pool.submit(func, *args)
+
+    def _start(self, signal, value, start, waiters):
+        try:
+            inner = start(value)
+        except Exception as ex:
+            inner = Status(signal)
+            inner.set_exception(ex)
+        inner.add_callback(lambda inner: self._done(signal, inner, waiters))
+
+    def _done(self, signal, inner, waiters):
+        now = ttime.monotonic()
+        with self._lock:
+            self.counts['completed' if inner.success else 'failed'] += len(waiters)
+            self.latencies.extend((signal.name, now - t0) for _, t0 in waiters)
+            queued = self._queued.pop(signal, None)
+            if queued is None:
+                del self._running[signal]
+            else:
+                self._running[signal] = queued[2]
+        for st, _ in waiters:
+            st.readback_time = getattr(inner, 'readback_time', None)
+            if inner.success:
+                st.set_finished()
+            else:
+                st.set_exception(inner.exception() or RuntimeError(f'set of {signal.name} failed'))
+        if queued is not None:
+            self._pool.submit(self._start, signal, *queued)
+
+    def stats(self):
+        '''
+        Queue depth, request counts and latencies [s] (overall and by signal).
+        '''
+        with self._lock:
+            latencies = list(self.latencies)
+            stats = dict(self.counts, depth=self._depth(), max_depth=self.max_depth)
+        by_signal = collections.defaultdict(list)
+        for name, latency in latencies:
+            by_signal[name].append(latency)
+        stats['latency'] = {name: {'count': len(values), 'mean': np.mean(values),
+                                   'max': np.max(values)}
+                            for name, values in sorted(by_signal.items())}
+        return stats
+
+
+set_executor = SignalSetExecutor()
+
+
+class ScheduledCall:
+    '''A call scheduled by RetryScheduler.call_later().'''
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        '''Do not run the call (if it did not run yet).'''
+        self.cancelled = True
+
+
+class RetryScheduler:
+    '''
+    Runs delayed calls, in time order, in one timer thread.
+
+    Error recovery (waiting, then writing again) must not run in the monitor
+    callbacks: they share the control layer's dispatcher thread with every
+    other signal. The callbacks schedule the recovery steps here instead.
+    The calls should not block: they run one after the other.
+    '''
+    def __init__(self):
+        self._cond = threading.Condition()
+        # (when, sequence number, call), sorted by heapq
+        self._queue = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func, *args):
+        '''Run func(*args) in `delay` seconds (a ScheduledCall).'''
+        call = ScheduledCall(ttime.monotonic() + delay, func, args)
+        with self._cond:
+            heapq.heappush(self._queue, (call.when, next(self._seq), call))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='retry_scheduler',
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return call
+
+    def pending(self):
+        '''Number of calls waiting to run.'''
+        with self._cond:
+            return sum(not call.cancelled for _, _, call in self._queue)
+
+    def _run(self):
+        _pool_thread_init()
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > ttime.monotonic():
+                    timeout = self._queue[0][0] - ttime.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                _, _, call = heapq.heappop(self._queue)
+            if call.cancelled:
+                continue
+            try:
+                call.func(*call.args)
+            except Exception as ex:
+                print(f'retry_scheduler: {call.func!r} failed: {ex!r}')
+
+
+retry_scheduler = RetryScheduler()
+
+
 class AgressiveSignal(ophyd.EpicsSignal):
+    # 'monitor': complete set() on readback monitor updates; 'poll': poll the
+    # readback with local_set_and_wait (in the threads of set_executor)
+    set_mode = 'monitor'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._set_lock = threading.Lock()
+        # time from the put to the matching readback of the last set() [s]
+        self.readback_time = None
+
     def set(self, value, *, timeout=None, settle_time=None):
         '''Set is like `put`, but is here for bluesky compatibility
 
+        Sets of the same signal are run one after the other (and a newer
+        target replaces a queued one) by set_executor.
+
         Returns
         -------
         st : Status
             This status object will be finished upon return in the
-            case of basic soft Signals
+            case of basic soft Signals. Its readback_time is the time
+            from the put to the matching readback [s].
         '''
+        if timeout is None:
+            timeout = 10
+            # TODO set_and_wait does not support a timeout of None
+            #      and 10 is its default timeout
+        set_method = self._poll_set if self.set_mode == 'poll' else self._monitor_set
+        return set_executor.submit(
+            self, value, functools.partial(set_method, timeout=timeout, settle_time=settle_time))
+
+    def _monitor_set(self, value, *, timeout, settle_time):
+        set_value = value
+        st = Status(self, timeout=timeout, settle_time=settle_time)
+        st.readback_time = None
+        try:
+            es = self.enum_strs
+        except AttributeError:
+            es = ()
+        put_time = None
+
+        def check_readback(value, **kwargs):
+            # updates arriving before the put may be stale values
+            if put_time is None:
+                return
+            with self._set_lock:
+                if st.done or st.readback_time is not None:
+                    return
+                if _compare_maybe_enum(set_value, value, es, self.tolerance, self.rtolerance):
+                    st.readback_time = self.readback_time = ttime.monotonic() - put_time
+                    st.set_finished()
+
+        def clear_subscription(status):
+            self.unsubscribe(cid)
+
+        cid = self.subscribe(check_readback, event_type=self.SUB_VALUE, run=False)
+        st.add_callback(clear_subscription)
+        put_time = ttime.monotonic()
+        self.put(value)
+        check_readback(self.get())
+        return st
+
+    def _poll_set(self, value, *, timeout, settle_time):
         def set_thread():
-            nonlocal timeout
             success = False
-            if timeout is None:
-                timeout = 10
-                # TODO set_and_wait does not support a timeout of None
-                #      and 10 is its default timeout
-
             try:
                 local_set_and_wait(self, value, timeout=timeout, atol=self.tolerance,
                                    rtol=self.rtolerance, poll_time=.001, log_backoff=1.1)
@@ -114,17 +369,10 @@ class AgressiveSignal(ophyd.EpicsSignal):
             else:
                 success = True
                 if settle_time is not None:
-                    time.sleep(settle_time)
+                    ttime.sleep(settle_time)
             finally:
                 st._finished(success=success)
-                self._set_thread = None
-
-        if self._set_thread is not None:
-            raise RuntimeError('Another set() call is still in progress')
 
         st = Status(self)
-        self._status = st
-        self._set_thread = epics.ca.CAThread(target=set_thread)
-        self._set_thread.daemon = True
-        self._set_thread.start()
-        return self._status
+        set_executor.run(set_thread)
+        return st
@@ -3,58 +3,125 @@
 #Also incldues: DG535 delay gen., SR630 temp monitor, and quadEM.
 #Motor classes are defined in 10-motors.py
 
+import collections
+import threading
 import time
 import datetime
 from ophyd import (EpicsMotor, Device,
                    Component as Cpt, EpicsSignal,
                    EpicsSignalRO, DeviceStatus)
 
-class SamplePump(Device):
+def _enum_str(enums, value):
+    '''Map an enum value to its string; string=True signals already deliver the string.'''
+    if isinstance(value, str):
+        return value
+    try:
+        return enums[int(value)]
+    except (TypeError, ValueError, IndexError):
+        # e.g. old_value is ophyd's placeholder before the first update
+        return None
+
+
+class MonitorCollectMixin:
+    '''
+    Flyer-style collection of the monitor updates of a device.
+
+    Between start_monitor_collect() (at kickoff) and stop_monitor_collect()
+    (when complete finishes, or at stop) every monitor update of the signals
+    in `monitor_collect_attrs` is buffered with its timestamp. collect()
+    returns the buffered updates, which the RunEngine emits in bulk as event
+    pages, in one '<signal name>_monitor' stream per signal. Only collect()
+    empties the buffers: the updates of a kickoff that was not collected are
+    returned by the next collect().
+    '''
+    monitor_collect_attrs = ()
+
+    def _monitor_collect_signals(self):
+        return [getattr(self, attr) for attr in self.monitor_collect_attrs]
+
+    def start_monitor_collect(self):
+        self.stop_monitor_collect()
+        if not hasattr(self, '_monitor_lock'):
+            self._monitor_lock = threading.Lock()
+            self._monitor_buffers = {sig.name: [] for sig in self._monitor_collect_signals()}
+        for sig in self._monitor_collect_signals():
+            def buffer_update(value, timestamp, _name=sig.name, **kwargs):
+                with self._monitor_lock:
+                    self._monitor_buffers[_name].append((value, timestamp))
+
+            self._monitor_cids.append((sig, sig.subscribe(buffer_update, run=True)))
+
+    def stop_monitor_collect(self):
+        for sig, cid in getattr(self, '_monitor_cids', ()):
+            sig.unsubscribe(cid)
+        self._monitor_cids = []
+
+    def describe_collect(self):
+        return {f'{sig.name}_monitor': sig.describe()
+                for sig in self._monitor_collect_signals()}
+
+    def collect(self):
+        if not hasattr(self, '_monitor_lock'):
+            return
+        with self._monitor_lock:
+            buffers = self._monitor_buffers
+            self._monitor_buffers = {name: [] for name in buffers}
+        for name, updates in buffers.items():
+            for value, timestamp in updates:
+                yield {'time': timestamp, 'data': {name: value},
+                       'timestamps': {name: timestamp}}
+
+
+class SamplePump(MonitorCollectMixin, Device):
     vel = Cpt(EpicsSignal, 'Val:Vel-SP')
     vol = Cpt(EpicsSignal, 'Val:Vol-SP')
 
-    sts = Cpt(EpicsSignal, 'Sts:Flag-Sts')
-
     slew_cmd = Cpt(EpicsSignal, 'Cmd:Slew-Cmd')
     stop_cmd = Cpt(EpicsSignal, 'Cmd:Stop-Cmd')
     movr_cmd = Cpt(EpicsSignal, 'Cmd:MOVR-Cmd')
 
     sts = Cpt(EpicsSignal, 'Sts:Flag-Sts', string=True)
 
+    # no delivered volume PV: only the status (vel is a setpoint)
+    monitor_collect_attrs = ('sts',)
+
     def kickoff(self):
         # The timeout controls how long to wait for the pump
         # to report it started working before assuming it is broken
         st = DeviceStatus(self, timeout=1.5)
-        enums = self.sts.enum_strs
+        enums = pv_metadata.enum_strs(self.sts)
         def inner_cb(value, old_value, **kwargs):
 
-            old_value, value = enums[int(old_value)], enums[int(value)]
+            old_value, value = _enum_str(enums, old_value), _enum_str(enums, value)
             # print('ko', old_value, value, time.time())
             if value == 'Moving':
                 st._finished(success=True)
                 self.sts.clear_sub(inner_cb)
 
+        self.start_monitor_collect()
         self.sts.subscribe(inner_cb)
         self.slew_cmd.put(1)
         return st
 
     def complete(self):
         st = DeviceStatus(self)
-        enums = self.sts.enum_strs
+        enums = pv_metadata.enum_strs(self.sts)
         def inner_cb(value, old_value, **kwargs):
-            old_value, value = enums[int(old_value)], enums[int(value)]
+            old_value, value = _enum_str(enums, old_value), _enum_str(enums, value)
             # print('cp', kwargs['timestamp'], old_value, value, value == 'Stopped')
             if value == 'Stopped':
                 st._finished(success=True)
                 self.sts.clear_sub(inner_cb)
 
         self.sts.subscribe(inner_cb)
+        st.add_callback(lambda st: self.stop_monitor_collect())
 
         self.stop_cmd.put(1)
         return st
 
     def stop(self):
         self.stop_cmd.put(1)
+        self.stop_monitor_collect()
 
 sample_pump = SamplePump('XF:17BMA-ES:1{Pmp:02}',
                          name='sample_pump',
@@ -78,7 +145,7 @@ class FractionCollector(Device):
 
 fc = FractionCollector('XF:17BM-ES:1{FC:1}', name='fc')
 
-class Pump(Device):
+class Pump(MonitorCollectMixin, Device):
     # This needs to be turned into a PV positioner
     mode = Cpt(EpicsSignal, 'Mode', string=True)
     direction = Cpt(EpicsSignal, 'Direction', string=True)
@@ -91,6 +158,8 @@ class Pump(Device):
 
     delivered = Cpt(EpicsSignalRO, 'Delivered_RBV')
 
+    monitor_collect_attrs = ('delivered', 'state')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._kickoff_st = None
@@ -116,18 +185,19 @@ class Pump(Device):
             raise RuntimeError('trying to kickoff before previous kickoff done')
 
         # set up local caches of pv information
-        enums = self.state.enum_strs
+        enums = pv_metadata.enum_strs(self.state)
         target = self.infusion_volume.get()
 
         # status objects
         self._complete_st = cp_st = DeviceStatus(self)
         self._kickoff_st = ko_st = DeviceStatus(self)
-
+        self.start_monitor_collect()
+        cp_st.add_callback(lambda st: self.stop_monitor_collect())
 
         def inner_cb_state(value, old_value, **kwargs):
             '''state changed based callback to identify starting
             '''
-            old_value, value = enums[int(old_value)], enums[int(value)]
+            old_value, value = _enum_str(enums, old_value), _enum_str(enums, value)
 
             if value == 'Interrupted':
                 ko_st._finished(success=False)
@@ -140,7 +210,7 @@ class Pump(Device):
         def inner_complete_cb(value, old_value, **kwargs):
             '''State based callback to identify finishing
             '''
-            old_value, value = enums[int(old_value)], enums[int(value)]
+            old_value, value = _enum_str(enums, old_value), _enum_str(enums, value)
 
             if value == 'Idle' and old_value != 'Idle':
                 cp_st._finished(success=True)
@@ -199,6 +269,7 @@ class Pump(Device):
         self._complete_st = None
         self._kickoff_st = None
         self.run.set('Stop')
+        self.stop_monitor_collect()
 
 
 pump1 = Pump('XF:17BM-ES:1{Pmp:01}', name='food_pump')
@@ -214,58 +285,113 @@ class DelayGenerator(Device):
     fire = Cpt(EpicsSignal, 'genSingleShotTrigBO', write_pv='genSingleShotTrigBO')
 
     _complete_set = None
-    
+
+    # Error recovery: at most rekick_attempts re-kicks (or rewrites) per set,
+    # the n-th one (from 0) waiting rekick_delay * rekick_backoff**n [s] before
+    # each of its writes. They are run by retry_scheduler, never in the monitor
+    # callbacks.
+    rekick_attempts = 3
+    rekick_delay = 5
+    rekick_backoff = 2
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._finish_set = None
+        # (time, value, number of re-kicks, success) of the last sets
+        self.rekick_history = collections.deque(maxlen=1000)
+
     def set(self, val, *, timeout=None, settle_time=None):
         cp_st = DeviceStatus(self)
+        # number of re-kicks (and rewrites) this set needed
+        cp_st.rekicks = 0
         if val == self.delay.get():
             cp_st._finished()
             return cp_st
-        
+
         self._complete_st = cp_st
         rekicking = False
-        
+        lock = threading.Lock()
+        scheduled = []
+
+        def next_delay():
+            # None when the attempts are exhausted (the set then fails)
+            if cp_st.rekicks >= self.rekick_attempts:
+                print(f'delay generator still failing after {cp_st.rekicks} attempts')
+                finish(success=False)
+                return None
+            delay = self.rekick_delay * self.rekick_backoff ** cp_st.rekicks
+            cp_st.rekicks += 1
+            return delay
+
+        def schedule(delay, func):
+            with lock:
+                if not cp_st.done:
+                    scheduled.append(retry_scheduler.call_later(delay, func))
+
         def stat_monitor(value, **kwargs):
             nonlocal rekicking
-            
-            if not rekicking and value:
-                print('err', value)
-                rekicking = True
-                print('wait, then set to 0')
-                sleep(5)
+            if rekicking or not value or cp_st.done:
+                return
+            print('err', value)
+            delay = next_delay()
+            if delay is None:
+                return
+            rekicking = True
+            print(f'wait {delay} s, then set to 0')
+
+            def set_zero():
                 self.exp_time.set(0)
-                print('wait, then set to val')
-                sleep(5)
+                print(f'wait {delay} s, then set to val')
+                schedule(delay, set_val)
+
+            def set_val():
+                nonlocal rekicking
                 rekicking = False
                 self.exp_time.set(val)
                 print('rekicked')
 
+            schedule(delay, set_zero)
+
         def stat_write_monitor(value, **kwargs):
-            if value:
-                print('delay generator write failed')
-                sleep(5)
-                self.exp_time.set(self.exp_time.get())                          
-                
-        self.delay_status.subscribe(stat_monitor, run=False)
-        self.exp_time_status.subscribe(stat_write_monitor, run=False)
-        
+            if not value or cp_st.done:
+                return
+            print('delay generator write failed')
+            delay = next_delay()
+            if delay is not None:
+                schedule(delay, lambda: self.exp_time.set(self.exp_time.get()))
+
         def rb_monitor(value, **kwargs):
-            nonlocal rekicking
             if rekicking:
                 print('bail')
                 return
-            
             if np.isclose(value, val):
+                finish(success=True)
+
+        def finish(success):
+            with lock:
+                if cp_st.done:
+                    return
+                for call in scheduled:
+                    call.cancel()
                 self._complete_st = None
+                self._finish_set = None
                 self.delay_status.clear_sub(stat_monitor)
                 self.delay.clear_sub(rb_monitor)
                 self.exp_time_status.clear_sub(stat_write_monitor)
-                cp_st._finished()
+                self.rekick_history.append((time.time(), val, cp_st.rekicks, success))
+                cp_st._finished(success=success)
+
+        self._finish_set = finish
+        self.delay_status.subscribe(stat_monitor, run=False)
+        self.exp_time_status.subscribe(stat_write_monitor, run=False)
         self.delay.subscribe(rb_monitor, run=False)
         self.exp_time.set(val)
-        
+
         return cp_st
 
     def stop(self, *, success):
+        if self._finish_set is not None:
+            self._finish_set(success=success)
         # TODO make this less brute force
         self.delay_status._reset_sub('value')
         self.delay._reset_sub('value')
@@ -2,6 +2,8 @@
 #Includes: all components in XFP PDS, ES:1, and ES:3.
 
 #This stuff should be imported by 10-fp-devices.py
+#Stages that are not usually connected are wrapped in LazyDevice (09-lazy-devices.py)
+#and only connect the first time they are used.
 import time
 import datetime
 from ophyd import (EpicsMotor, Device,
@@ -21,7 +23,7 @@ class BeamPipeStage(Device):
     x = Cpt(EpicsMotor, 'X}Mtr', labels=('FP PDS',))
     y = Cpt(EpicsMotor, 'Y}Mtr', labels=('FP PDS',))
 
-pipe = BeamPipeStage('XF:17BMA-OP{Stg:2-Ax:', name='pipe')
+pipe = LazyDevice(BeamPipeStage, 'XF:17BMA-OP{Stg:2-Ax:', name='pipe')
 
 #ES:1 3-axis table
 class Table1(Device):
@@ -50,13 +52,13 @@ class CVDViewer(Device):
     x = Cpt(EpicsMotor, 'X}Mtr', labels=('greenfield ES:2',))
     y = Cpt(EpicsMotor, 'Y}Mtr', labels=('greenfield ES:2',))
 
-cvd = CVDViewer('XF:17BMA-ES:1{CVD:1-Ax:', name='cvd')
+cvd = LazyDevice(CVDViewer, 'XF:17BMA-ES:1{CVD:1-Ax:', name='cvd')
 
 #CF sample collector (Amaazon slide), not usually connected
 class CFSample(Device):
     z = Cpt(EpicsMotor, 'Z}Mtr', labels=('greenfield ES:2',))
 
-cfsam = CFSample('XF:17BMA-ES:1{Sam:1-Ax:', name='cfsam')
+cfsam = LazyDevice(CFSample, 'XF:17BMA-ES:1{Sam:1-Ax:', name='cfsam')
 
 #Real and virtual XFP PB Slit axes in a single class.
 class PBSlits(Device):
@@ -102,7 +104,7 @@ class Sample_Cryo(Device):
     y = Cpt(EpicsMotor, 'Y}Mtr', labels=('monochromatic ES',))
     z = Cpt(EpicsMotor, 'Z}Mtr', labels=('monochromatic ES',))
 
-sample_cryo = Sample_Cryo('XF:17BMA-ES:3{Stg:9-Ax:', name='sample_cryo')
+sample_cryo = LazyDevice(Sample_Cryo, 'XF:17BMA-ES:3{Stg:9-Ax:', name='sample_cryo')
 
 #Real and virtual PreMono Slit axes in a single class.
 #Functionally identical to the XFP PB slits
@@ -130,10 +132,10 @@ class Mod12(Device):
     x = Cpt(EpicsMotor, 'X}Mtr', settle_time=2, labels=('greenfield ES:2',))
     y = Cpt(EpicsMotor, 'Y}Mtr', settle_time=2, labels=('greenfield ES:2',))
 
-mod12 = Mod12('XF:17BMA-ES:2{Mod:12-Ax:', name='mod12')
+mod12 = LazyDevice(Mod12, 'XF:17BMA-ES:2{Mod:12-Ax:', name='mod12')
 
 class Mod34(Device):
     x = Cpt(EpicsMotor, 'X}Mtr', labels=('greenfield ES:2',))
     y = Cpt(EpicsMotor, 'Y}Mtr', labels=('greenfield ES:2',))
 
-mod34 = Mod34('XF:17BMA-ES:2{Mod:34-Ax:', name='mod34')
\ No newline at end of file
+mod34 = LazyDevice(Mod34, 'XF:17BMA-ES:2{Mod:34-Ax:', name='mod34')
\ No newline at end of file
@@ -0,0 +1,138 @@
+#Settle-aware arrival of motors: instead of sleeping a fixed time after a
+#move, watch the readbacks and declare arrival when the position is within
+#tolerance of the target and has not moved for a settle window. The window
+#timers run in retry_scheduler (09-ophyd_hack.py), never in the monitor
+#callbacks.
+
+import asyncio
+import collections
+import threading
+import time as ttime
+
+from bluesky.utils import FailedStatus
+from ophyd.status import Status
+
+
+class SettlePolicy:
+    '''
+    When a motor has arrived at its target.
+
+    Parameters
+    ----------
+    tolerance: float
+        Maximum distance from the target (in the motor units).
+
+    window: float
+        Time [s] the readback must stay still (velocity zero) within the
+        tolerance.
+
+    deadband: float, optional
+        Readback changes up to this are noise, not motion. Defaults to a
+        tenth of the tolerance.
+
+    timeout: float
+        The arrival fails after this time [s].
+
+    history: int
+        Number of measured settle times kept in `settle_times`.
+
+    log: bool
+        Print every arrival (motor, target and settle time) with xfp_print.
+    '''
+    def __init__(self, tolerance=0.01, window=0.2, deadband=None, timeout=60, history=1000,
+                 log=True):
+        self.tolerance = tolerance
+        self.window = window
+        self.deadband = tolerance / 10 if deadband is None else deadband
+        self.timeout = timeout
+        self.log = log
+        # (motor name, target, time from the status creation to the arrival [s])
+        self.settle_times = collections.deque(maxlen=history)
+
+    def status(self, motor, target):
+        '''
+        A status finished when `motor` has settled at `target`. Its
+        arrival_time is the time from its creation to the arrival [s].
+        '''
+        st = Status(motor, timeout=self.timeout)
+        st.arrival_time = None
+        start = ttime.monotonic()
+        lock = threading.Lock()
+        # time since when the readback is still and within tolerance, and the
+        # last readback
+        still_since = None
+        last = None
+
+        def arrived(since):
+            with lock:
+                if st.done or still_since != since:
+                    return
+                st.arrival_time = ttime.monotonic() - start
+            self.settle_times.append((motor.name, target, st.arrival_time))
+            if self.log:
+                xfp_print(f'{motor.name} settled at {target:g} in {st.arrival_time:.3f} s')
+            st.set_finished()
+
+        def readback_cb(value, **kwargs):
+            nonlocal still_since, last
+            now = ttime.monotonic()
+            with lock:
+                if st.done:
+                    return
+                moved = last is None or abs(value - last) > self.deadband
+                last = value
+                if abs(value - target) > self.tolerance:
+                    still_since = None
+                    return
+                if still_since is not None and not moved:
+                    return
+                still_since = since = now
+            retry_scheduler.call_later(self.window, arrived, since)
+
+        cid = motor.user_readback.subscribe(readback_cb, event_type=motor.user_readback.SUB_VALUE,
+                                            run=True)
+        st.add_callback(lambda st: motor.user_readback.unsubscribe(cid))
+        return st
+
+
+# Arrival of the HT stage at a slot
+ht_settle = SettlePolicy(tolerance=0.01, window=0.2)
+
+
+def wait_statuses(statuses):
+    '''Plan: wait for ophyd statuses, raising FailedStatus if one fails.'''
+    def waiter(st):
+        async def wait():
+            loop = asyncio.get_running_loop()
+            done = loop.create_future()
+            st.add_callback(lambda st: loop.call_soon_threadsafe(
+                lambda: done.done() or done.set_result(None)))
+            await done
+        return wait
+
+    yield from bps.wait_for([waiter(st) for st in statuses])
+    for st in statuses:
+        if not st.success:
+            raise FailedStatus(st)
+
+
+def wait_settled(*args, policy=ht_settle):
+    '''
+    Plan: wait until motors have settled at their targets.
+
+    Parameters
+    ----------
+    *args
+        motor1, target1, motor2, target2, ...
+
+    policy: SettlePolicy
+
+    Returns
+    -------
+    settle_times: dict
+        Time [s] each motor took to settle, by motor name.
+    '''
+    pairs = list(zip(args[::2], args[1::2]))
+    statuses = [policy.status(motor, target) for motor, target in pairs]
+    yield from wait_statuses(statuses)
+    return {motor.name: st.arrival_time for (motor, _), st in zip(pairs, statuses)}
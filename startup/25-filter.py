@@ -32,14 +32,23 @@ class PseudoFilterWheel(PseudoPositioner):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        time.sleep(1)
-        self._angle_egu = self.angle.egu
+        # Don't block on the motor's EGU here: start from the cached value
+        # (or the usual 'deg') and update the units once the channel connects.
+        self._angle_egu = pv_metadata.value(self.angle.motor_egu, default='deg')
+        self._update_wheel_egu()
+        self.angle.motor_egu.subscribe(self._angle_egu_changed, run=False)
 
+    def _update_wheel_egu(self):
         # Update the wheel_positions list of dicts with the units:
         for i, _ in enumerate(self.wheel_positions):
             self.wheel_positions[i].update(angle_egu=self._angle_egu,
                                            thickness_egu=self._thickness_egu)
 
+    def _angle_egu_changed(self, value, **kwargs):
+        if value:
+            self._angle_egu = value
+            self._update_wheel_egu()
+
     @pseudo_position_argument
     def forward(self, pseudo_pos):
         '''Run a forward (pseudo -> real) calculation'''
@@ -0,0 +1,126 @@
+#Bulk connection stage for all devices defined in the 0x-2x startup files.
+#Devices are created without waiting on their channels. Here we wait for every
+#declared PV at once, with a single global timeout, and print a connection
+#report instead of connecting device by device on first use.
+#The timeout (seconds) can be changed with the XFP_CONNECT_TIMEOUT env variable.
+
+import os
+import time as ttime
+
+from ophyd import Device
+from ophyd.signal import EpicsSignalBase
+
+from xfp_lib import startup_profiler
+
+STARTUP_CONNECT_TIMEOUT = float(os.environ.get('XFP_CONNECT_TIMEOUT', 10))
+
+
+def _namespace_devices(ns):
+    '''
+    Top-level ophyd devices and signals in a namespace, first name wins.
+    Aliases (e.g. shutter = pre_shutter) are only listed once.
+    '''
+    found = {}
+    for name, obj in list(ns.items()):
+        if name.startswith('_'):
+            continue
+        if isinstance(obj, (Device, EpicsSignalBase)) and obj.parent is None:
+            found.setdefault(id(obj), (name, obj))
+    return list(found.values())
+
+
+def _signal_pvnames(sig):
+    pvnames = [sig.pvname]
+    setpoint_pvname = getattr(sig, 'setpoint_pvname', sig.pvname)
+    if setpoint_pvname != sig.pvname:
+        pvnames.append(setpoint_pvname)
+    return pvnames
+
+
+def connect_all_devices(ns=None, timeout=STARTUP_CONNECT_TIMEOUT, poll_time=0.01):
+    '''
+    Wait for the CA channels of every device in the namespace to connect.
+
+    All channels are already being searched for in the background, so this
+    only waits once, for at most `timeout` seconds in total, and records when
+    each device became fully connected.
+
+    Parameters
+    ----------
+    ns: dict, optional
+        Namespace to look for devices in. Defaults to the IPython user namespace.
+
+    timeout: float
+        Global connection timeout in seconds.
+
+    Returns
+    -------
+    report: dict
+        device name -> {'pvs': number of PVs, 'time': seconds to connect or None,
+        'failed': list of PV names that did not connect}
+    '''
+    if ns is None:
+        ns = get_ipython().user_ns
+
+    pending = {}
+    report = {}
+    for name, obj in _namespace_devices(ns):
+        signals = _epics_signals(obj)
+        if not signals:
+            continue
+        pending[name] = signals
+        # Refresh the cached PV metadata once the channels connect
+        pv_metadata.track(obj)
+        report[name] = {'pvs': sum(len(_signal_pvnames(s)) for s in signals),
+                        'time': None,
+                        'failed': []}
+
+    start = ttime.monotonic()
+    deadline = start + timeout
+    with startup_profiler.timed('connect'):
+        while pending:
+            now = ttime.monotonic()
+            for name, signals in list(pending.items()):
+                if all(sig.connected for sig in signals):
+                    report[name]['time'] = now - start
+                    del pending[name]
+            if not pending or now > deadline:
+                break
+            ttime.sleep(poll_time)
+
+    for name, signals in pending.items():
+        report[name]['failed'] = [pvname for sig in signals if not sig.connected
+                                  for pvname in _signal_pvnames(sig)]
+    return report
+
+
+def print_connection_report(report):
+    '''Print a per-device connection table and the PVs that failed to connect.'''
+    ok = {k: v for k, v in report.items() if v['time'] is not None}
+    failed = {k: v for k, v in report.items() if v['time'] is None}
+
+    print(f"\n{'Device':<20}{'PVs':>6}{'Connect [ms]':>15}")
+    for name, entry in sorted(ok.items(), key=lambda kv: kv[1]['time'], reverse=True):
+        print(f"{name:<20}{entry['pvs']:>6}{entry['time'] * 1000:>15.1f}")
+    for name, entry in failed.items():
+        print(f"{name:<20}{entry['pvs']:>6}{'FAILED':>15}")
+
+    n_lazy = len([ld for ld in lazy_devices.values() if not ld.used])
+    print(f"\n{len(ok)} of {len(report)} devices connected, "
+          f"{n_lazy} lazy devices not connected yet.")
+    if failed:
+        print("PVs that did not connect:")
+        for name, entry in failed.items():
+            for pvname in entry['failed']:
+                print(f"  {name}: {pvname}")
+
+
+def connection_report(timeout=STARTUP_CONNECT_TIMEOUT):
+    '''Re-run the bulk connection wait and print the report.'''
+    global startup_connection_report
+    startup_connection_report = connect_all_devices(timeout=timeout)
+    print_connection_report(startup_connection_report)
+
+
+print(f"\nConnecting all devices (timeout {STARTUP_CONNECT_TIMEOUT:g} s).")
+connection_report()
@@ -28,20 +28,17 @@ def simple_pump(pump):
 
         yield from bps.wait('pump_started')
         print('pump started')
-        st = yield from bps.complete(pump, group='pump_done', wait=False)
+        yield from bps.complete(pump, group='pump_done', wait=False)
         print('waiting for pump to finish')
 
         yield from bps.trigger_and_read([pump])
 
-        while st is not None and not st.done:
-            yield from bps.trigger_and_read([pump])
-            yield from bps.sleep(.5)
-
-        yield from bps.sleep(.1)
-        yield from bps.trigger_and_read([pump])
-
+        # the pump buffers every monitor update until it is done: collect
+        # them in bulk instead of polling
         yield from bps.wait('pump_done')
         print('pump finished')
+        yield from bps.collect(pump)
+        yield from bps.trigger_and_read([pump])
 
         yield from bps.abs_set(shutter, 'Close', wait=True)
         print('closed shutter')
@@ -48,20 +48,17 @@ def flow(diameter, rate, tgt_vol, *, md=None):
         yield from bps.wait('pump_started')
         print("({}) Exposing {:.2f} mL at {:.2f} mL/min".format(datetime.datetime.now().strftime(_time_fmtstr), tgt_vol, rate))
         print('waiting for pump to finish')
-        st = yield from bps.complete(spump, group='pump_done', wait=False)
+        yield from bps.complete(spump, group='pump_done', wait=False)
         #st = yield from bps.complete(spump, wait=True)
         #print('pump finished')
         yield from bps.trigger_and_read(dets)
 
-        while st is not None and not st.done:
-            yield from bps.trigger_and_read(dets)
-            yield from bps.sleep(.5)
-
-        yield from bps.sleep(.1)
-        yield from bps.trigger_and_read(dets)
-
+        # the pump buffers every monitor update until it is done: collect
+        # them in bulk instead of polling
         yield from bps.wait('pump_done')
         print('pump finished')
+        yield from bps.collect(spump)
+        yield from bps.trigger_and_read(dets)
         
        # close the shutter
         yield from bps.abs_set(shutter, 'Close', wait=True)
@@ -0,0 +1,390 @@
+#Import of the plans of the HT (98-gui-ht.py) and HTFly (99-gui-htfly.py)
+#GUIs, from Excel files or from the plan format (.json). The files are parsed
+#and validated in a worker thread, all the rows of a column at once, and the
+#parsed plans are cached by file content (SHA-256) and modification time:
+#importing the same plan again does not read it. The GUIs get the slots as
+#one list of records, through a Qt signal.
+#
+#The plan format is a JSON document with a versioned schema and one list per
+#column:
+#
+#    {"format": "xfp-plan", "version": 1, "kind": "ht",
+#     "columns": {"slot": [0, 1, ...], "location": ["H1", "G1", ...],
+#                 "name": [...], "exposure": [...], "filter": [...],
+#                 "notes": [...]}}
+#
+#See PLAN_SCHEMAS for the columns of each kind of plan; excel_to_plan() and
+#plan_to_excel() convert between the two formats.
+
+import collections
+import hashlib
+import io
+import json
+import math
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.qt_compat import QtCore
+
+from locate_slot import NUM_COLS, NUM_ROWS
+
+# Maximum number of parsed plans kept in memory
+PLAN_CACHE_MAX_ENTRIES = 32
+
+PLAN_FORMAT = 'xfp-plan'
+PLAN_FORMAT_VERSION = 1
+
+# Columns of the plan format by kind of plan, and their types. 'slot' (0-95)
+# and 'row' (1-6) number the slots, each once. exposure [ms]; filter and
+# attenuation: thickness of the filter [um], null to keep the current filter.
+PLAN_SCHEMAS = {
+    'ht': {'slot': int, 'location': str, 'name': str, 'exposure': float,
+           'filter': float, 'notes': str},
+    'htfly': {'row': int, 'name': str, 'exposure': float, 'attenuation': float,
+              'notes': str},
+}
+
+# Number of slots by kind of plan
+PLAN_SIZES = {'ht': NUM_ROWS * NUM_COLS, 'htfly': 6}
+
+# Headers of the Excel plans by column of the plan format. The HT slot is
+# the row of the sheet; its filter column is optional.
+EXCEL_COLUMNS = {
+    'ht': {'slot': 'Slot (0-95)', 'location': 'Location', 'name': 'Sample name',
+           'exposure': 'Exposure time (ms)', 'filter': 'Filter Thickness (um)', 'notes': 'Notes'},
+    'htfly': {'name': 'Sample name', 'exposure': 'Exposure time (ms)',
+              'attenuation': 'Filter Thickness (um)', 'notes': 'Notes'},
+}
+
+
+class PlanFileError(ValueError):
+    pass
+
+
+def _rows(mask, first=2):
+    # Excel row numbers (the header is row 1), or slot indices
+    return ', '.join(str(i + first) for i in np.flatnonzero(mask))
+
+
+def _numeric(column, what):
+    # empty cells are 0
+    values = pd.to_numeric(column.replace('', 0), errors='coerce')
+    if values.isna().any():
+        raise PlanFileError(f'Invalid {what} in rows {_rows(values.isna())}')
+    return values.to_numpy(dtype=float)
+
+
+def filter_indices(thicknesses, wheel_thicknesses, tolerance=1e-8):
+    '''
+    Index of the filter wheel position of each thickness, None if there is
+    none.
+    '''
+    wheel = np.asarray(wheel_thicknesses, dtype=float)
+    match = np.abs(np.asarray(thicknesses, dtype=float)[:, None] - wheel[None, :]) < tolerance
+    indices = match.argmax(axis=1)
+    return [int(i) if found else None for i, found in zip(indices, match.any(axis=1))]
+
+
+def columns_from_excel(df, kind, size=None):
+    '''
+    Columns of the plan format (a dict of arrays) from the sheet of an Excel
+    plan. Empty exposure times and thicknesses are 0; HT plans use their
+    first `size` rows.
+    '''
+    size = PLAN_SIZES[kind] if size is None else size
+    headers = EXCEL_COLUMNS[kind]
+    optional = {'slot', 'filter'}
+    missing_columns = [header for key, header in headers.items()
+                       if key not in optional and header not in df.columns]
+    if missing_columns:
+        raise PlanFileError(f'Missing columns: {(",").join(missing_columns)}')
+    if kind == 'htfly' and len(df) != size:
+        raise PlanFileError(f'Excel file does not contain exactly {size} rows, aborting import')
+    if len(df) < size:
+        raise PlanFileError(f'The plan has {len(df)} rows instead of {size}')
+    df = df.iloc[:size]
+    columns = {}
+    for key, key_type in PLAN_SCHEMAS[kind].items():
+        header = headers.get(key)
+        if key in ('slot', 'row'):
+            columns[key] = np.arange(size) + (key == 'row')
+        elif header not in df.columns:
+            columns[key] = np.full(size, np.nan)
+        elif key_type is float:
+            columns[key] = _numeric(df[header], header.lower())
+        else:
+            columns[key] = df[header].astype(str).to_numpy()
+    return columns
+
+
+def columns_from_json(data, kind, size=None):
+    '''
+    Columns of a plan in the plan format (JSON text or bytes), validated
+    against its schema and sorted by slot.
+    '''
+    size = PLAN_SIZES[kind] if size is None else size
+    try:
+        doc = json.loads(data)
+    except ValueError as ex:
+        raise PlanFileError(f'Not a JSON document: {ex}') from None
+    if not isinstance(doc, dict) or doc.get('format') != PLAN_FORMAT:
+        raise PlanFileError(f'Not an {PLAN_FORMAT} document')
+    if doc.get('version') != PLAN_FORMAT_VERSION:
+        raise PlanFileError(f'Unsupported plan format version {doc.get("version")!r} '
+                            f'(supported: {PLAN_FORMAT_VERSION})')
+    if doc.get('kind') != kind:
+        raise PlanFileError(f'The plan is for {doc.get("kind")!r}, not {kind!r}')
+    raw = doc.get('columns')
+    schema = PLAN_SCHEMAS[kind]
+    if not isinstance(raw, dict):
+        raise PlanFileError('The plan has no columns')
+    missing = [key for key in schema if key not in raw]
+    unknown = [key for key in raw if key not in schema]
+    if missing:
+        raise PlanFileError(f'Missing columns: {",".join(missing)}')
+    if unknown:
+        raise PlanFileError(f'Unknown columns: {",".join(unknown)}')
+
+    columns = {}
+    for key, key_type in schema.items():
+        values = raw[key]
+        if not isinstance(values, list) or len(values) != size:
+            raise PlanFileError(f'Column {key!r} must be a list of {size} values')
+        if key_type is str:
+            bad = [not isinstance(v, str) for v in values]
+            columns[key] = np.array(values, dtype=object)
+        elif key_type is int:
+            bad = [isinstance(v, bool) or not isinstance(v, int) for v in values]
+            columns[key] = np.array([v if not b else -1 for v, b in zip(values, bad)])
+        else:
+            # null thicknesses keep the filter; exposure times are required
+            nullable = key != 'exposure'
+            bad = [not ((v is None and nullable) or
+                        (isinstance(v, (int, float)) and not isinstance(v, bool) and
+                         math.isfinite(v) and v >= 0)) for v in values]
+            columns[key] = np.array([np.nan if v is None or b else v
+                                     for v, b in zip(values, bad)], dtype=float)
+        if any(bad):
+            raise PlanFileError(f'Invalid {key} of the slots at positions {_rows(bad, first=0)}')
+
+    index_key, first = ('slot', 0) if kind == 'ht' else ('row', 1)
+    index = columns[index_key]
+    if sorted(index) != list(range(first, size + first)):
+        raise PlanFileError(f'The {index_key}s must be {first} to {size + first - 1}, each once')
+    order = np.argsort(index)
+    return {key: values[order] for key, values in columns.items()}
+
+
+def read_plan_columns(data, suffix, kind, size=None):
+    '''Columns of a plan file (bytes): the plan format if `suffix` is .json, else Excel.'''
+    if suffix == '.json':
+        return columns_from_json(data, kind, size)
+    return columns_from_excel(pd.read_excel(io.BytesIO(data), keep_default_na=False), kind, size)
+
+
+def plan_records(columns, kind, wheel_thicknesses, strict=False):
+    '''
+    The slots of a plan as dicts (the columns of the plan format), with
+    'filter' the index of the filter wheel position (None: keep the
+    filter). With `strict`, a thickness of no wheel position is an error,
+    else the filter is kept.
+    '''
+    thickness_key = 'filter' if kind == 'ht' else 'attenuation'
+    thickness = columns[thickness_key]
+    indices = filter_indices(thickness, wheel_thicknesses)
+    if strict:
+        unknown = [index is None and not np.isnan(t) for index, t in zip(indices, thickness)]
+        if any(unknown):
+            raise PlanFileError(f'No filter wheel position has the thickness of the slots at '
+                                f'positions {_rows(unknown, first=0)}')
+    keys = [key for key in PLAN_SCHEMAS[kind] if key != thickness_key]
+    records = []
+    for j, index in enumerate(indices):
+        record = {key: columns[key][j].item() if hasattr(columns[key][j], 'item') else columns[key][j]
+                  for key in keys}
+        record['filter'] = index
+        records.append(record)
+    return records
+
+
+def parse_ht_plan(data, suffix, wheel_thicknesses, n_slots=PLAN_SIZES['ht']):
+    '''
+    Slots of an HT plan file (bytes), as dicts with 'slot', 'location',
+    'name', 'exposure' [ms], 'filter' (wheel index, None to keep the filter)
+    and 'notes'.
+    '''
+    columns = read_plan_columns(data, suffix, 'ht', n_slots)
+    return plan_records(columns, 'ht', wheel_thicknesses, strict=suffix == '.json')
+
+
+def parse_htfly_plan(data, suffix, wheel_thicknesses, n_rows=PLAN_SIZES['htfly']):
+    '''
+    Rows of an HTFly plan file (bytes), as dicts with 'row', 'name',
+    'exposure' [ms], 'filter' (wheel index, None to keep the filter) and
+    'notes'.
+    '''
+    columns = read_plan_columns(data, suffix, 'htfly', n_rows)
+    return plan_records(columns, 'htfly', wheel_thicknesses, strict=suffix == '.json')
+
+
+def write_plan(path, columns, kind):
+    '''Write the columns of a plan to `path` in the plan format.'''
+    doc = {'format': PLAN_FORMAT, 'version': PLAN_FORMAT_VERSION, 'kind': kind,
+           'columns': {key: [None if isinstance(v, float) and math.isnan(v) else v
+                             for v in np.asarray(columns[key]).tolist()]
+                       for key in PLAN_SCHEMAS[kind]}}
+    with open(path, 'w') as f:
+        json.dump(doc, f, separators=(',', ':'))
+
+
+def excel_to_plan(excel_path, plan_path, kind='ht', size=None):
+    '''Convert an Excel plan to the plan format.'''
+    with open(excel_path, 'rb') as f:
+        columns = read_plan_columns(f.read(), '.xlsx', kind, size)
+    write_plan(plan_path, columns, kind)
+
+
+def plan_to_excel(plan_path, excel_path, kind='ht', size=None):
+    '''Convert a plan in the plan format to an Excel plan.'''
+    with open(plan_path, 'rb') as f:
+        columns = columns_from_json(f.read(), kind, size)
+    headers = dict(EXCEL_COLUMNS[kind])
+    # empty thicknesses of Excel plans are 0: keeping the filter is only
+    # possible for all the slots of an HT plan, without the column
+    thickness_key = 'filter' if kind == 'ht' else 'attenuation'
+    keep = np.isnan(columns[thickness_key])
+    if keep.all() and kind == 'ht':
+        del headers[thickness_key]
+    elif keep.any():
+        raise PlanFileError(f'The filter of the slots at positions {_rows(keep, first=0)} '
+                            f'cannot be kept in an Excel plan')
+    df = pd.DataFrame({header: columns[key] for key, header in headers.items()})
+    df.to_excel(excel_path, index=False)
+
+
+def _suffix(path):
+    return os.path.splitext(path)[1].lower()
+
+
+class PlanCache:
+    '''
+    Parsed plan files, by file content and parser.
+
+    A file whose path, modification time and size did not change is not read
+    again; a file with the same content (e.g. a copy) is not parsed again.
+
+    Parameters
+    ----------
+    max_entries: int
+        The least recently used plans are dropped beyond this number.
+    '''
+    def __init__(self, max_entries=PLAN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (path, mtime, size) -> SHA-256 of the content
+        self._digests = {}
+        # (SHA-256, suffix, parser, arguments) -> parsed plan
+        self._plans = collections.OrderedDict()
+
+    def cached(self, path, parser, *args):
+        '''
+        The parsed plan if the file did not change since it was parsed (no
+        read), else None.
+        '''
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        with self._lock:
+            digest = self._digests.get((path, st.st_mtime_ns, st.st_size))
+            if digest is None:
+                return None
+            return self._get((digest, _suffix(path), parser.__name__, args))
+
+    def parse(self, path, parser, *args):
+        '''
+        Parsed plan of a file: parser(bytes, suffix, *args) (cached, `args`
+        must be hashable). Raises PlanFileError if it is invalid.
+        '''
+        plan = self.cached(path, parser, *args)
+        if plan is not None:
+            return plan
+        path = os.path.realpath(path)
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        key = (digest, _suffix(path), parser.__name__, args)
+        with self._lock:
+            self._digests[(path, st.st_mtime_ns, st.st_size)] = digest
+            plan = self._get(key)
+        if plan is None:
+            plan = parser(data, _suffix(path), *args)
+            with self._lock:
+                self._plans[key] = plan
+                while len(self._plans) > self.max_entries:
+                    self._plans.popitem(last=False)
+        return plan
+
+    def _get(self, key):
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+            self._plans.clear()
+
+
+plan_cache = PlanCache()
+
+PLAN_PARSERS = {'ht': parse_ht_plan, 'htfly': parse_htfly_plan}
+
+
+def load_plan(path, kind='ht', filter_obj=filter_wheel, cache=plan_cache):
+    '''
+    The slots of a plan file (Excel, or the plan format if it ends with
+    .json), validated, for plans run without a GUI. See parse_ht_plan() and
+    parse_htfly_plan() for the records.
+    '''
+    thicknesses = tuple(pos['thickness'] for pos in filter_obj.wheel_positions)
+    return cache.parse(path, PLAN_PARSERS[kind], thicknesses)
+
+
+class PlanLoader(QtCore.QObject):
+    '''
+    Loads plan files in a worker thread (see PlanCache.parse). The
+    result is emitted in the thread of the connected widgets: `loaded` with
+    the path and the parsed plan, or `failed` with the path and the error
+    message. Plans in the cache are emitted at once.
+    '''
+    loaded = QtCore.Signal(str, object)
+    failed = QtCore.Signal(str, str)
+
+    def __init__(self, cache=plan_cache):
+        super().__init__()
+        self.cache = cache
+
+    def load(self, path, parser, *args):
+        '''Parse `path` with parser(bytes, suffix, *args) in the background.'''
+        try:
+            plan = self.cache.cached(path, parser, *args)
+        except OSError:
+            plan = None
+        if plan is not None:
+            self.loaded.emit(path, plan)
+            return
+        threading.Thread(target=self._work, args=(path, parser, *args),
+                         name='plan_loader', daemon=True).start()
+
+    def _work(self, path, parser, *args):
+        try:
+            plan = self.cache.parse(path, parser, *args)
+        except PlanFileError as ex:
+            self.failed.emit(path, str(ex))
+        except Exception as ex:
+            self.failed.emit(path, f'Cannot read {path}: {ex!r}')
+        else:
+            self.loaded.emit(path, plan)
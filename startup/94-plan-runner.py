@@ -0,0 +1,110 @@
+#Runs the plans of the Qt GUIs (98-gui-ht.py, 99-gui-htfly.py) with the
+#RunEngine in a worker thread, so that the GUI event loop keeps running while
+#a plate is measured. Widgets are only touched from the GUI thread: the
+#RunEngine state changes, slot colours and motor positions reach them
+#through Qt signals (RunEngineBridge), which Qt queues to the GUI thread.
+#LivePlot and the other Qt-aware callbacks draw in the GUI thread through the
+#bluesky Qt 'teleporter', created here in the main thread.
+
+import threading
+import traceback
+
+from bluesky import RunEngine
+from bluesky.callbacks.mpl_plotting import initialize_qt_teleporter
+from bluesky.utils import DuringTask, RunEngineInterrupted, SigintHandler
+from matplotlib.backends.qt_compat import QtCore
+
+initialize_qt_teleporter()
+
+# The RunEngine attribute of the DuringTask object: public in the bluesky
+# versions which have it, private before
+_DURING_TASK_ATTR = ('during_task' if isinstance(getattr(RunEngine, 'during_task', None), property)
+                     else '_during_task')
+
+
+class _WaitDuringTask(DuringTask):
+    # off the main thread there is no Qt event loop to run: just wait
+    def block(self, blocking_event):
+        blocking_event.wait()
+
+
+class RunEngineBridge(QtCore.QObject):
+    '''
+    Signals emitted from the plan (any thread), delivered in the thread of
+    the connected widgets.
+    '''
+    # new state, old state of the RunEngine
+    state_changed = QtCore.Signal(object, object)
+    # text to show (e.g. motor positions)
+    info = QtCore.Signal(str)
+    # exception raised by the RunEngine call (None on success)
+    finished = QtCore.Signal(object)
+
+
+class BackgroundPlanRunner:
+    '''
+    Runs RunEngine calls (a plan, resume, stop) one at a time in a worker
+    thread.
+
+    While it runs, the RunEngine does not install its SIGINT handler (only
+    possible in the main thread; use Pause in the GUI or RE.request_pause())
+    and waits for the plan without running the Qt event loop, which keeps
+    running in the main thread.
+
+    Parameters
+    ----------
+    RE: RunEngine
+    '''
+    def __init__(self, RE):
+        self.RE = RE
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def busy(self):
+        '''Whether a RunEngine call is in progress in the worker thread.'''
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self, plan, bridge=None):
+        '''Run `plan`, emitting bridge.finished when RE returns.'''
+        self._submit(bridge, self.RE, plan)
+
+    def resume(self, bridge=None):
+        '''Resume the paused plan.'''
+        self._submit(bridge, self.RE.resume)
+
+    def stop(self, bridge=None):
+        '''Stop the paused plan (cleaning up).'''
+        self._submit(bridge, self.RE.stop)
+
+    def _submit(self, bridge, func, *args):
+        with self._lock:
+            if self.busy:
+                raise RuntimeError('A RunEngine call is already in progress in the background')
+            self._thread = threading.Thread(target=self._work, args=(bridge, func, *args),
+                                            name='plan_runner', daemon=True)
+            self._thread.start()
+
+    def _work(self, bridge, func, *args):
+        RE = self.RE
+        context_managers = RE.context_managers
+        during_task = getattr(RE, _DURING_TASK_ATTR)
+        error = None
+        try:
+            RE.context_managers = [cm for cm in context_managers if cm is not SigintHandler]
+            setattr(RE, _DURING_TASK_ATTR, _WaitDuringTask())
+            func(*args)
+        except RunEngineInterrupted as ex:
+            # paused: resume() or stop() continues
+            error = ex
+        except BaseException as ex:
+            error = ex
+            traceback.print_exc()
+        finally:
+            RE.context_managers = context_managers
+            setattr(RE, _DURING_TASK_ATTR, during_task)
+        if bridge is not None:
+            bridge.finished.emit(error)
+
+
+plan_runner = BackgroundPlanRunner(RE)
@@ -0,0 +1,270 @@
+#Motion-time-optimal ordering of the slots of the HT walk (98-gui-ht.py).
+#SlotTimeModel predicts the time to go from a slot to the next: the ht.x/ht.y
+#move and settling (see 13-settle.py), overlapped with the filter wheel
+#rotation and the DG535 reprogramming when the exposure changes.
+#plan_slot_order() orders the enabled slots to minimize the total predicted
+#time, optionally keeping the relative order of slots required by the user.
+
+import math
+
+# Minimum time spent at each slot, besides the move [s]
+HT_MIN_SLOT_TIME = 0
+
+# Fixed overheads [s]: starting and checking a move, and reprogramming the
+# DG535 (put, then wait for the matching readback)
+HT_MOVE_OVERHEAD = 0.2
+HT_EXPOSURE_CHANGE_TIME = 0.5
+
+
+def _move_time(distance, velocity, accel_time):
+    # trapezoidal profile of the motor record (triangular for short moves)
+    distance = abs(distance)
+    if distance == 0:
+        return 0.
+    if distance >= velocity * accel_time:
+        return distance / velocity + accel_time
+    return 2 * math.sqrt(distance * accel_time / velocity)
+
+
+class SlotTimeModel:
+    '''
+    Predicted time [s] to go from a slot of the HT holder to the next.
+
+    The x and y moves run together, followed by the settle window (and at
+    least the minimum time spent at each slot). The filter wheel rotation
+    and the exposure change (DG535) start with the moves: the slowest of the
+    three sets the time.
+
+    Parameters
+    ----------
+    x_velocity, y_velocity, filter_velocity: float
+        Velocities of ht.x, ht.y [mm/s] and of the filter wheel [deg/s].
+
+    x_accel, y_accel, filter_accel: float
+        Acceleration times [s].
+
+    filter_angles: sequence of float
+        Angle of the filter wheel [deg] by filter index.
+
+    min_slot_time: float
+        Minimum time spent at each slot [s].
+
+    move_overhead: float
+        Added to every move [s].
+
+    settle_window: float
+        Time the HT stage must stay still to have arrived [s].
+
+    exposure_change_time: float
+        Time to reprogram the DG535 to another exposure [s].
+    '''
+    def __init__(self, *, x_velocity=2., y_velocity=2., x_accel=0.2, y_accel=0.2,
+                 filter_velocity=30., filter_accel=0.2, filter_angles=(),
+                 min_slot_time=HT_MIN_SLOT_TIME, move_overhead=HT_MOVE_OVERHEAD,
+                 settle_window=ht_settle.window, exposure_change_time=HT_EXPOSURE_CHANGE_TIME):
+        self.x_velocity = x_velocity
+        self.y_velocity = y_velocity
+        self.x_accel = x_accel
+        self.y_accel = y_accel
+        self.filter_velocity = filter_velocity
+        self.filter_accel = filter_accel
+        self.filter_angles = tuple(filter_angles)
+        self.min_slot_time = min_slot_time
+        self.move_overhead = move_overhead
+        self.settle_window = settle_window
+        self.exposure_change_time = exposure_change_time
+
+    @classmethod
+    def from_devices(cls, ht_obj=None, filter_obj=None, **kwargs):
+        '''
+        A model with the velocities and acceleration times of the motors of
+        `ht_obj` and `filter_obj` (ht and filter_wheel by default, looked up
+        when called). Values which cannot be read keep their defaults.
+        '''
+        if ht_obj is None:
+            ht_obj = ht
+        if filter_obj is None:
+            filter_obj = filter_wheel
+        params = {'filter_angles': [pos['angle'] for pos in filter_obj.wheel_positions]}
+        for key, motor in (('x', ht_obj.x), ('y', ht_obj.y), ('filter', filter_obj.angle)):
+            try:
+                params[f'{key}_velocity'] = abs(motor.velocity.get()) or None
+                params[f'{key}_accel'] = motor.acceleration.get()
+            except Exception as ex:
+                print(f'Using the default velocity of {motor.name}: {ex}')
+        params = {key: value for key, value in params.items() if value is not None}
+        params.update(kwargs)
+        return cls(**params)
+
+    def time(self, a, b):
+        '''
+        Time [s] to go from slot `a` to slot `b`, dicts with 'x', 'y' [mm],
+        'filter_index' and 'exposure' [ms] (None where unknown; a filter_index
+        of None in `b` keeps the filter).
+        '''
+        move = max(_move_time(b['x'] - a['x'], self.x_velocity, self.x_accel),
+                   _move_time(b['y'] - a['y'], self.y_velocity, self.y_accel))
+        times = [move + self.move_overhead + self.settle_window, self.min_slot_time]
+        if b['filter_index'] is not None and a['filter_index'] != b['filter_index']:
+            if a['filter_index'] is None or not self.filter_angles:
+                rotation = 180.
+            else:
+                rotation = (self.filter_angles[b['filter_index']] -
+                            self.filter_angles[a['filter_index']])
+            times.append(_move_time(rotation, self.filter_velocity, self.filter_accel) +
+                         self.move_overhead)
+        if a['exposure'] != b['exposure']:
+            times.append(self.exposure_change_time)
+        return max(times)
+
+    def matrix(self, states):
+        '''Times [s] from each state to each other (a list of lists).'''
+        return [[self.time(a, b) for b in states] for a in states]
+
+
+def _nearest_neighbour(cost, n):
+    # path of node indices from the start (0), always going to the closest
+    path = [0]
+    left = set(range(1, n))
+    while left:
+        last = path[-1]
+        nxt = min(left, key=lambda j: (cost[last][j], j))
+        path.append(nxt)
+        left.remove(nxt)
+    return path
+
+
+def _cheapest_insertion(cost, n, chain):
+    # the required nodes in their order, then the others each inserted where
+    # it adds the least time
+    path = [0] + list(chain)
+    for node in sorted(set(range(1, n)) - set(chain)):
+        best = None
+        for k in range(1, len(path) + 1):
+            added = cost[path[k - 1]][node]
+            if k < len(path):
+                added += cost[node][path[k]] - cost[path[k - 1]][path[k]]
+            if best is None or added < best[0]:
+                best = (added, k)
+        path.insert(best[1], node)
+    return path
+
+
+def _improve(cost, path, required, max_passes=50):
+    '''
+    Local search on an open path starting at path[0]: 2-opt segment reversals
+    (not reversing two required nodes) and relocations of single nodes
+    (required nodes stay in place), until no move saves time.
+    '''
+    n = len(path)
+    eps = 1e-9
+    for _ in range(max_passes):
+        improved = False
+        # 2-opt: reverse path[i:k + 1]. The costs are not symmetric (e.g. an
+        # unknown filter at the start), so the segment is costed both ways.
+        for i in range(1, n - 1):
+            n_required = path[i] in required
+            forward = backward = 0.
+            for k in range(i + 1, n):
+                n_required += path[k] in required
+                if n_required > 1:
+                    break
+                forward += cost[path[k - 1]][path[k]]
+                backward += cost[path[k]][path[k - 1]]
+                a, b, c = path[i - 1], path[i], path[k]
+                d = path[k + 1] if k + 1 < n else None
+                old = cost[a][b] + forward + (cost[c][d] if d is not None else 0)
+                new = cost[a][c] + backward + (cost[b][d] if d is not None else 0)
+                if new < old - eps:
+                    path[i:k + 1] = path[i:k + 1][::-1]
+                    improved = True
+                    break
+        # relocate path[i] between path[j - 1] and path[j]
+        for i in range(1, n):
+            node = path[i]
+            if node in required:
+                continue
+            prev, nxt = path[i - 1], path[i + 1] if i + 1 < n else None
+            removed = cost[prev][node] + (cost[node][nxt] - cost[prev][nxt] if nxt is not None else 0)
+            rest = path[:i] + path[i + 1:]
+            best = None
+            for j in range(1, len(rest) + 1):
+                added = cost[rest[j - 1]][node]
+                if j < len(rest):
+                    added += cost[node][rest[j]] - cost[rest[j - 1]][rest[j]]
+                if added < removed - eps and (best is None or added < best[0]):
+                    best = (added, j)
+            if best is not None:
+                rest.insert(best[1], node)
+                path[:] = rest
+                improved = True
+        if not improved:
+            break
+    return path
+
+
+def plan_slot_order(slots, x, y, *, start=None, model=None, required_order=None):
+    '''
+    Order the slots of an HT walk to minimize the total predicted time.
+
+    Parameters
+    ----------
+    slots: list of dict
+        Slots to visit, with 'position', 'exposure' [ms] and 'filter_index'
+        (as returned by XFPSampleSelector.walk_values()).
+
+    x, y: sequences
+        Coordinates of the slots [mm], indexed by position.
+
+    start: dict, optional
+        State before the first slot: 'x', 'y', 'filter_index' and 'exposure'
+        (None where unknown). Defaults to the first slot.
+
+    model: SlotTimeModel, optional
+        Defaults to SlotTimeModel.from_devices().
+
+    required_order: sequence of int, optional
+        Positions which must be visited in this relative order; the other
+        slots are placed freely around them.
+
+    Returns
+    -------
+    ordered: list of dict
+        The slots in the order to visit them.
+    '''
+    if not slots:
+        return []
+    if model is None:
+        model = SlotTimeModel.from_devices()
+    states = [{'x': x[s['position']], 'y': y[s['position']],
+               'filter_index': s['filter_index'], 'exposure': s['exposure']} for s in slots]
+    if start is None:
+        start = states[0]
+    cost = model.matrix([start] + states)
+    n = len(states) + 1
+
+    node_by_position = {s['position']: i for i, s in enumerate(slots, start=1)}
+    chain = [node_by_position[p] for p in (required_order or ()) if p in node_by_position]
+    if len(set(chain)) != len(chain):
+        raise ValueError(f'A slot is required twice in {required_order}')
+
+    if chain:
+        path = _cheapest_insertion(cost, n, chain)
+    else:
+        path = _nearest_neighbour(cost, n)
+    path = _improve(cost, path, set(chain))
+    return [slots[node - 1] for node in path[1:]]
+
+
+def predicted_walk_time(slots, x, y, *, start=None, model=None):
+    '''Predicted time [s] of the moves of an HT walk visiting `slots` in order.'''
+    if not slots:
+        return 0.
+    if model is None:
+        model = SlotTimeModel.from_devices()
+    states = [{'x': x[s['position']], 'y': y[s['position']],
+               'filter_index': s['filter_index'], 'exposure': s['exposure']} for s in slots]
+    if start is None:
+        start = states[0]
+    path = [start] + states
+    return sum(model.time(a, b) for a, b in zip(path, path[1:]))
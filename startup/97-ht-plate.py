@@ -0,0 +1,536 @@
+#The HT plate walk as a plan of its own, without the Qt GUI: ht_plate_plan()
+#exposes the slots of a plate description (e.g. from load_plan(), see
+#88-plan-loader.py) at the positions of a coordinate table. The GUI of
+#98-gui-ht.py is a client of it, and plates can be scripted, batched or run
+#in the simulation:
+#
+#    plate = plate_from_plan(load_plan('plate1.json'))
+#    RE(ht_plate_plan(plate, HT_COORDS['x'], HT_COORDS['y'], '/path/plate1.csv'))
+
+import csv
+import os.path
+import time as ttime
+
+from bluesky.callbacks.core import CallbackBase
+from locate_slot import NUM_COLS, NUM_ROWS
+from ophyd import Component as Cpt, Device, DeviceStatus, Signal
+
+# Orders of the slots of the HT walk (see order_slots())
+HT_WALK_ORDERS = ('fastest', 'snake', 'slots')
+
+
+def get_position_from_index(positions, field, idx):
+    return positions[idx][field]
+
+
+def get_index_from_position(positions, field, current_pos, tolerance=1e-8):
+    for idx, pos in enumerate(positions):
+        if abs(pos[field] - current_pos) < tolerance:
+            return idx
+    return None
+
+
+class FileInvalidException(Exception):
+    pass
+
+
+def filter_texts(wheel_positions):
+    '''Descriptions of the positions of the filter wheel.'''
+    return [f'Angle: {pos["angle"]} [{pos["angle_egu"]}] '
+            f'Thickness: {pos["thickness"]} [{pos["thickness_egu"]}]' for pos in wheel_positions]
+
+
+class RunSummaryCSV(CallbackBase):
+    '''
+    Collects fields of the start documents of the successful runs, and
+    appends each run to a CSV file as soon as it is done. A plate recorded
+    as one run ('ht_plate') gets one row per slot event instead, as soon as
+    it is read, with the fields of ht_slot.
+
+    Parameters
+    ----------
+    file_name: string, optional
+        CSV file (created with a header if needed). Rows are only kept in
+        memory if not given.
+
+    columns: sequence of string
+        Fields of the start documents.
+    '''
+    def __init__(self, file_name=None, columns=('uid', 'name', 'exposure', 'filter_text', 'notes')):
+        super().__init__()
+        self.file_name = file_name
+        self.columns = tuple(columns)
+        self.rows = []
+        self._starts = {}
+        # descriptor uid -> start document, for the primary streams of plates
+        self._plate_descriptors = {}
+
+    def start(self, doc):
+        self._starts[doc['uid']] = doc
+
+    def descriptor(self, doc):
+        start = self._starts.get(doc['run_start'])
+        if start is not None and start.get('plan_name') == 'ht_plate' and doc.get('name') == 'primary':
+            self._plate_descriptors[doc['uid']] = start
+
+    def event(self, doc):
+        start = self._plate_descriptors.get(doc['descriptor'])
+        if start is None:
+            return
+        data = doc['data']
+        fields = {'uid': start['uid'], 'name': data.get(f'{ht_slot.name}_sample_name')}
+        self._append_row([fields[c] if c in fields else data.get(f'{ht_slot.name}_{c}', start.get(c))
+                          for c in self.columns])
+
+    def stop(self, doc):
+        start = self._starts.pop(doc['run_start'], None)
+        if start is None or start.get('plan_name') == 'ht_plate' or doc.get('exit_status') != 'success':
+            return
+        self._append_row([start.get(c) for c in self.columns])
+
+    def _append_row(self, row):
+        self.rows.append(row)
+        if self.file_name is not None:
+            new_file = not os.path.exists(self.file_name)
+            with open(self.file_name, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(self.columns)
+                writer.writerow(row)
+                f.flush()
+                os.fsync(f.fileno())
+
+    @property
+    def table(self):
+        '''The collected rows (a DataFrame).'''
+        return pd.DataFrame(self.rows, columns=list(self.columns))
+
+
+def motors_positions(motors):
+    format_str = []
+    motor_values = []
+    for m in motors:
+        format_str.append(f'{m.name}: {{}}')
+        motor_values.append(round(m.read()[m.name]['value'], 3))
+    return '\n'.join(format_str).format(*motor_values)
+
+
+def xfp_prepare_slot(d, group=None, *, filter_obj=None, dg_obj=None):
+    '''
+    Start rotating the filter wheel and setting the DG535 exposure for a slot
+    (wait for `group` before firing). A slot with a filter_index of None keeps
+    the current filter.
+
+    filter_obj and dg_obj default to filter_wheel and dg.
+
+    Returns
+    -------
+    done: dict
+        Filled with the time.monotonic() at which the 'filter' and 'exposure'
+        phases finish.
+    '''
+    if filter_obj is None:
+        filter_obj = filter_wheel
+    if dg_obj is None:
+        dg_obj = dg
+    done = {}
+    statuses = {'exposure': (yield from bps.abs_set(dg_obj, d['exposure']/1000, group=group))}
+    if d['filter_index'] is None:
+        done['filter'] = ttime.monotonic()
+    else:
+        current_field = 'thickness'
+        move_to_thickness = float(get_position_from_index(filter_obj.wheel_positions,
+                                                          current_field,
+                                                          d['filter_index']))
+        statuses['filter'] = yield from bps.abs_set(getattr(filter_obj, current_field),
+                                                    move_to_thickness, group=group)
+    for phase, st in statuses.items():
+        st.add_callback(lambda st, phase=phase: done.setdefault(phase, ttime.monotonic()))
+    return done
+
+
+def slot_timing(move_start, arrived, prep_done, blocked):
+    '''
+    Durations [s] of the phases of a slot, from the start of the stage move:
+    'stage' (until settled), 'filter' and 'exposure' (DG535), 'blocked' (time
+    waited for the filter and exposure before firing) and, for the filter and
+    exposure, the part of their duration hidden by the stage move.
+    '''
+    timing = {'stage': arrived - move_start, 'blocked': blocked}
+    for phase in ('filter', 'exposure'):
+        timing[phase] = prep_done[phase] - move_start
+        timing[f'{phase}_hidden'] = min(timing[phase], timing['stage'])
+    return timing
+
+
+def format_slot_timing(timing):
+    return (f"Stage {timing['stage']:.2f} s, "
+            f"filter {timing['filter']:.2f} s ({timing['filter_hidden']:.2f} s hidden), "
+            f"exposure setup {timing['exposure']:.2f} s ({timing['exposure_hidden']:.2f} s hidden), "
+            f"blocked {timing['blocked']:.2f} s")
+
+
+class HTSlotInfo(Device):
+    '''The metadata of the current HT slot, read as data in single-run mode.'''
+    index = Cpt(Signal, value=-1)
+    sample_name = Cpt(Signal, value='')
+    exposure = Cpt(Signal, value=0.)
+    # -1: the slot keeps the current filter
+    filter_index = Cpt(Signal, value=-1)
+    filter_text = Cpt(Signal, value='')
+    notes = Cpt(Signal, value='')
+    settle_time = Cpt(Signal, value=0.)
+
+    def set(self, d):
+        '''Set the fields from a slot dict (see plate_from_plan()).'''
+        self.index.put(d['position'])
+        self.sample_name.put(d['name'])
+        self.exposure.put(d['exposure'])
+        self.filter_index.put(-1 if d['filter_index'] is None else d['filter_index'])
+        self.filter_text.put(d['filter_text'])
+        self.notes.put(d['notes'])
+        self.settle_time.put(d.get('settle_time', 0.))
+        st = DeviceStatus(self)
+        st._finished()
+        return st
+
+
+ht_slot = HTSlotInfo(name='ht_slot')
+
+
+def xfp_plan_fast_shutter(d, shutter_per_slot, prepared=False, in_run=False, *,
+                          ht_obj=None, filter_obj=None, dg_obj=None):
+    '''
+    Expose a slot, and record it as a run (or, with in_run=True, as an event
+    of the open run, returning None).
+
+    ht_obj, filter_obj and dg_obj default to ht, filter_wheel and dg.
+    '''
+    if ht_obj is None:
+        ht_obj = ht
+    if dg_obj is None:
+        dg_obj = dg
+    if not prepared:
+        yield from xfp_prepare_slot(d, group='slot_prep', filter_obj=filter_obj, dg_obj=dg_obj)
+        yield from bps.wait('slot_prep')
+
+    exp_time = d['exposure']/1000
+
+    if shutter_per_slot:
+        # yield from bps.mv(pre_shutter, 'Open')
+        yield from bps.mv(diode_shutter, 'Open')
+
+    # fire the fast shutter and wait for it to close again
+    yield from bps.mv(dg_obj.fire, 1)
+    yield from bps.sleep(exp_time*1.1)
+
+    if shutter_per_slot:
+        # yield from bps.mv(pre_shutter, 'Close')
+        yield from bps.mv(diode_shutter, 'Close')
+
+    if in_run:
+        yield from bps.abs_set(ht_slot, d, wait=True)
+        yield from bps.trigger_and_read([ht_obj.x, ht_obj.y, ht_slot])
+        return None
+
+    return (yield from bp.count([ht_obj.x, ht_obj.y], md=d))
+
+
+def current_filter_index(filter_obj=None):
+    '''
+    Index of the current position of the filter wheel (filter_wheel by
+    default), None if unknown.
+    '''
+    if filter_obj is None:
+        filter_obj = filter_wheel
+    try:
+        return get_index_from_position(filter_obj.wheel_positions, 'thickness',
+                                       filter_obj.thickness.position, filter_obj._tolerance)
+    except Exception:
+        return None
+
+
+def ht_walk_start(ht_obj=None, filter_obj=None, dg_obj=None):
+    '''
+    The state an HT walk starts from: motor positions, filter and exposure
+    [ms]. The devices default to ht, filter_wheel and dg.
+    '''
+    if ht_obj is None:
+        ht_obj = ht
+    if dg_obj is None:
+        dg_obj = dg
+    return {'x': ht_obj.x.position, 'y': ht_obj.y.position,
+            'filter_index': current_filter_index(filter_obj),
+            'exposure': dg_obj.delay.get() * 1000}
+
+
+# filter_text of the slots keeping the current filter
+KEEP_FILTER_TEXT = 'Current filter'
+
+
+def plate_from_plan(records, filter_obj=None):
+    '''
+    The plate description of the slots of an HT plan (see load_plan()) with
+    an exposure time: dicts with 'position', 'exposure' [ms],
+    'filter_index', 'filter_text', 'name' and 'notes'. Slots keeping the
+    filter have a filter_index of None: the walk does not move the filter
+    wheel (filter_obj, filter_wheel by default) for them.
+    '''
+    if filter_obj is None:
+        filter_obj = filter_wheel
+    texts = filter_texts(filter_obj.wheel_positions)
+    plate = []
+    for r in records:
+        if r['exposure'] <= 0:
+            continue
+        filter_index = r['filter']
+        plate.append({'position': r['slot'], 'exposure': r['exposure'],
+                      'filter_index': filter_index,
+                      'filter_text': KEEP_FILTER_TEXT if filter_index is None else texts[filter_index],
+                      'name': r['name'], 'notes': r['notes']})
+    return plate
+
+
+def order_slots(slots, order, x, y, *, shape=(NUM_ROWS, NUM_COLS), start=None,
+                required_order=None, model=None):
+    '''
+    The slots of an HT walk in the order to visit them.
+
+    Parameters
+    ----------
+    slots: list of dict
+        The plate description (see plate_from_plan()).
+
+    order: {'fastest', 'snake', 'slots'}
+        fastest - minimize the predicted time (see plan_slot_order(), keeping
+        required_order if any); snake - row by row, alternating directions,
+        skipping empty rows; slots - increasing slot numbers.
+
+    x, y: sequences
+        Coordinates of the slots [mm], indexed by position.
+
+    shape: (int, int)
+        Rows and columns of the holder.
+
+    start, required_order, model
+        See plan_slot_order().
+    '''
+    if order not in HT_WALK_ORDERS:
+        raise ValueError(f'Unknown order {order!r}, expected one of {HT_WALK_ORDERS}')
+    by_position = {d['position']: d for d in slots}
+    if len(by_position) != len(slots):
+        raise ValueError('A slot is in the plate twice')
+    rows, cols = shape
+    trajectory = np.arange(rows*cols).reshape((rows, cols))
+    if order == 'snake':
+        non_empty_rows = [i for i in range(rows)
+                          if any(int(p) in by_position for p in trajectory[i, :])]
+        for i, i_real in enumerate(non_empty_rows):
+            if i % 2 != 0:
+                trajectory[i_real, :] = trajectory[i_real, ::-1]
+    ordered = [by_position[int(p)] for p in trajectory.ravel() if int(p) in by_position]
+    if order == 'fastest':
+        ordered = plan_slot_order(ordered, x, y, start=start, required_order=required_order,
+                                  model=model)
+    return ordered
+
+
+def ht_plate_plan(plate, x, y, file_name, *, order='snake', required_order=None,
+                  single_run=False, shutter_per_slot=False, reason=None, md=None,
+                  load_position=None, shape=(NUM_ROWS, NUM_COLS), test_mode=None,
+                  summary=None, timings=None, on_slot=None, on_info=None,
+                  ht_obj=None, filter_obj=None, dg_obj=None):
+    '''
+    Plan exposing the slots of an HT plate, then closing the shutters and
+    going to the load position (also if it fails).
+
+    Parameters
+    ----------
+    plate: list of dict
+        The slots to expose (see plate_from_plan()).
+
+    x, y: sequences
+        Coordinates of the slots [mm], indexed by position (e.g.
+        HT_COORDS['x'], HT_COORDS['y']).
+
+    file_name: string
+        CSV file of the slot metadata (see RunSummaryCSV); it must not exist.
+
+    order, required_order
+        Order of the slots (see order_slots()), computed when the plan
+        starts.
+
+    single_run: bool
+        Record the plate as one run with one event per slot (the slot
+        metadata as data, in ht_slot) instead of one run per slot.
+
+    shutter_per_slot: bool
+        Open and close the diode shutter at each slot.
+
+    reason: string, optional
+        Added to the metadata of the runs.
+
+    md: dict, optional
+        More metadata of the runs.
+
+    load_position: (float, float), optional
+        Where ht.x, ht.y go at the end. Defaults to (LOAD_POS_X, LOAD_POS_Y).
+
+    shape: (int, int)
+        Rows and columns of the holder.
+
+    test_mode: bool, optional
+        Do not require the shutters to be open. Defaults to mode.test_mode.
+
+    summary: RunSummaryCSV, optional
+        Collects the metadata of the slots (a new one by default).
+
+    timings: list, optional
+        Gets the phase durations of each slot (see slot_timing()), with its
+        'position'.
+
+    on_slot: callable, optional
+        on_slot(position, state) when a slot is 'running' and is a
+        'success', e.g. for a GUI (called in the thread of the RunEngine).
+
+    on_info: callable, optional
+        on_info(text) with the motor positions at each slot.
+
+    ht_obj, filter_obj, dg_obj: optional
+        The HT stage, filter wheel and DG535. Default to ht, filter_wheel and
+        dg, looked up when the plan is created.
+
+    Returns
+    -------
+    table: DataFrame or None
+        The rows of the CSV file written by the plan (the return value of
+        the plan, not of RE()).
+    '''
+    if summary is None:
+        summary = RunSummaryCSV()
+    if load_position is None:
+        load_position = (LOAD_POS_X, LOAD_POS_Y)
+    if ht_obj is None:
+        ht_obj = ht
+    if filter_obj is None:
+        filter_obj = filter_wheel
+    if dg_obj is None:
+        dg_obj = dg
+    devices = {'filter_obj': filter_obj, 'dg_obj': dg_obj}
+
+    def close_shutters():
+        yield from bps.mv(diode_shutter, 'Close')
+        # yield from bps.mv(pre_shutter, 'Close')
+        yield from bps.mv(pps_shutter, 'Close')
+        yield from bps.mv(ht_obj.x, load_position[0], ht_obj.y, load_position[1])  # load position
+
+    def main_plan():
+        if os.path.isfile(file_name):
+            raise FileInvalidException(f"Metadata file name {file_name} already in use, change names and retry")
+        check_shutters = not (mode.test_mode if test_mode is None else test_mode)
+
+        xfp_print(f'CSV file name: {file_name}')
+        summary.file_name = file_name
+
+        base_md = {'plan_name': 'ht'}
+        if reason:
+            base_md['reason'] = reason
+        base_md.update(md or {})
+
+        if check_shutters:
+            yield from bps.mv(pps_shutter, 'Open')
+
+        start = ht_walk_start(ht_obj, filter_obj, dg_obj)
+        model = SlotTimeModel.from_devices(ht_obj, filter_obj)
+        walk = order_slots(plate, order, x, y, shape=shape, start=start,
+                           required_order=required_order, model=model)
+        xfp_print(f'{len(walk)} slots in {order} order, '
+                  f'predicted moves: {predicted_walk_time(walk, x, y, start=start, model=model):.0f} s')
+
+        def walk_slots():
+            for slot in walk:
+                position = slot['position']
+                d = dict(base_md)
+                d.update(slot)
+
+                xfp_print(f"Info: {d}")
+                xfp_print(f"Slot #{position}: X={x[position]}  Y={y[position]}")
+                if on_slot is not None:
+                    on_slot(position, 'running')
+
+                move_start = ttime.monotonic()
+                yield from bps.abs_set(ht_obj.x, x[position], group='ht')
+                yield from bps.abs_set(ht_obj.y, y[position], group='ht')
+                # rotate the filter and set the exposure while the stage moves
+                prep_done = yield from xfp_prepare_slot(d, group='slot_prep', **devices)
+
+                # arrived when the readbacks are still within tolerance
+                settle_times = yield from wait_settled(ht_obj.x, x[position], ht_obj.y, y[position],
+                                                       policy=ht_settle)
+                yield from bps.wait('ht')
+                d['settle_time'] = max(settle_times.values())
+                arrived = ttime.monotonic()
+
+                if on_info is not None:
+                    on_info(motors_positions([ht_obj.x, ht_obj.y]))
+
+                # Open it once, when the holder arrives to the first scanning point:
+                if pre_shutter.status.get() == 'Not Open':
+                    yield from bps.mv(pre_shutter, 'Open')
+                if diode_shutter.status_closed.get() == 1 and not shutter_per_slot:
+                    yield from bps.mv(diode_shutter, 'Open')
+
+                # Check that the shutters are opened before collecting data:
+                if check_shutters:
+                    if pps_shutter.status.get() == 'Not Open':
+                        raise Exception(f'{pps_shutter.name} must be open to finish the scan')
+                    if pre_shutter.status.get() == 'Not Open':
+                        raise Exception(f'{pre_shutter.name} must be open to finish the scan')
+                    if diode_shutter.status_closed.get() == 1 and not shutter_per_slot:
+                        raise Exception(f'{diode_shutter.name} must be open to finish the scan')
+
+                # the filter and exposure must be ready before firing
+                wait_start = ttime.monotonic()
+                yield from bps.wait('slot_prep')
+                d['timing'] = slot_timing(move_start, arrived, prep_done,
+                                          blocked=ttime.monotonic() - wait_start)
+                if timings is not None:
+                    timings.append({'position': position, **d['timing']})
+                xfp_print(format_slot_timing(d['timing']))
+
+                uid = (yield from xfp_plan_fast_shutter(d,
+                                                        shutter_per_slot=shutter_per_slot,
+                                                        prepared=True, in_run=single_run,
+                                                        ht_obj=ht_obj, **devices))
+                if on_slot is not None:
+                    on_slot(position, 'success')
+
+                if uid is not None:
+                    xfp_print(f'UID from xfp_plan_fast_shutter(): {uid}')
+
+                yield from bps.checkpoint()
+
+        if single_run:
+            # one run for the plate, one event per slot
+            plate_md = dict(base_md, plan_name='ht_plate', num_points=len(walk),
+                            slots=[slot['position'] for slot in walk])
+            yield from bpp.run_wrapper(walk_slots(), md=plate_md)
+        else:
+            yield from walk_slots()
+
+        # Close it once the walkthrough is done:
+        if not shutter_per_slot:
+            # yield from bps.mv(shutter, 'Close')
+            yield from bps.mv(diode_shutter, 'Close')
+
+        from bluesky.utils import FailedStatus
+        try:
+            yield from bps.mv(pps_shutter, 'Close')
+        except FailedStatus:
+            yield from bps.mv(pps_shutter, 'Close')
+
+        return summary.table if summary.rows else None
+
+    # the CSV file gets a row as soon as each slot's run is done
+    return (yield from bpp.finalize_wrapper(bpp.subs_wrapper(main_plan(), summary),
+                                            close_shutters()))
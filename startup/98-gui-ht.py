@@ -6,7 +6,6 @@ import warnings
 from matplotlib.backends.qt_compat import QtWidgets, QtCore, QtGui
 import matplotlib.pyplot as plt
 from locate_slot import LetterNumberLocator
-import copy
 
 
 COLOR_SUCCESS = 'green'
@@ -14,208 +13,362 @@ COLOR_RUNNING = 'red'
 COLOR_SELECTED = '#007dff'  # blue
 COLOR_SKIPPED = 'gray'
 
+# Orders of the slots of the HT walk (see 96-ht-trajectory.py), the first one
+# is the default:
+# snake - row by row, alternating directions, skipping empty rows
+# fastest - minimize the predicted time (keeping the required order if any)
+# slots - increasing slot numbers
+SLOT_ORDERS = {'Snake rows': 'snake', 'Fastest': 'fastest', 'Slot numbers': 'slots'}
 
-def get_position_from_index(positions, field, idx):
-    return positions[idx][field]
+# Colors of the states of the slots during the walk (see ht_plate_plan())
+SLOT_STATE_COLORS = {'running': COLOR_RUNNING, 'success': COLOR_SUCCESS}
 
 
-def get_index_from_position(positions, field, current_pos, tolerance=1e-8):
-    for idx, pos in enumerate(positions):
-        if abs(pos[field] - current_pos) < tolerance:
-            return idx
-    return None
 
+def parse_slot_list(text, locations):
+    '''
+    Slot numbers from a list of slot numbers and/or locations separated by
+    commas or spaces (e.g. 'A1, B3, 17'). None if the list is empty.
+    '''
+    by_location = {location.upper(): j for j, location in enumerate(locations)}
+    positions = []
+    for token in text.replace(',', ' ').split():
+        if token.isdigit() and int(token) < len(locations):
+            positions.append(int(token))
+        elif token.upper() in by_location:
+            positions.append(by_location[token.upper()])
+        else:
+            raise ValueError(f'Unknown slot: {token}')
+    return positions or None
+
+
+# State of a slot in SlotTableModel.state
+SLOT_STATE_DTYPE = np.dtype([('enabled', '?'), ('exposure', 'f8'), ('filter', 'i2'), ('color', 'u1')])
+
+# Indicator icons by (color, warning), shared by all the cells
+_indicator_icons = {}
+
+
+def _indicator_icon(color, warning, size=30):
+    key = (color, warning)
+    if key not in _indicator_icons:
+        pixmap = QtGui.QPixmap(size, size)
+        pixmap.fill(QtCore.Qt.transparent)
+        painter = QtGui.QPainter(pixmap)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(QtGui.QColor(color))
+        painter.drawEllipse(1, 1, size - 2, size - 2)
+        if warning:
+            font = painter.font()
+            font.setPixelSize(size - 6)
+            font.setBold(True)
+            painter.setFont(font)
+            painter.setPen(QtGui.QColor('red'))
+            painter.drawText(pixmap.rect(), QtCore.Qt.AlignCenter, 'X')
+        painter.end()
+        _indicator_icons[key] = QtGui.QIcon(pixmap)
+    return _indicator_icons[key]
+
+
+class SlotTableModel(QtCore.QAbstractTableModel):
+    '''
+    The slots of the HT holder as a rows x cols table for a QTableView.
 
-class FileInvalidException(Exception):
-    pass
-
-
-class ColumnWidget:
-    def __init__(self, j, *, filter_obj=None, data=None):
-        self._position = j
-        self.data = data
-
-        self.cb = QtWidgets.QGroupBox(f'Pos: {j}')
-        self.cb.setCheckable(True)
+    The state of all the slots is one structured array (`state`: enabled,
+    exposure [ms], filter index and colour code), with the names, notes and
+    locations in lists. The cells are painted from it when shown: changing a
+    slot only emits dataChanged for its cell.
 
-        self.sb = QtWidgets.QDoubleSpinBox()
-        self.sb.setValue(10)
-        self.sb.setMinimum(0)
-        self.sb.setMaximum(20000)
+    Parameters
+    ----------
+    rows, cols: int
 
-        self.le = QtWidgets.QLineEdit(f'sample {j}')
+    locations: list of str
+        Location of each slot (e.g. 'A1'), by slot number.
 
-        # Combo box for selection of the filter thickness:
-        if filter_obj is None:
-            raise ValueError(f'The filter object should be specified. Passed None')
-        self.filter_obj = filter_obj
-        self.wheel_positions = copy.deepcopy(self.filter_obj.wheel_positions)
-        for i, pos in enumerate(self.wheel_positions):
-            self.wheel_positions[i]['text'] = (f'Angle: {pos["angle"]} [{pos["angle_egu"]}] '
-                                               f'Thickness: {pos["thickness"]} [{pos["thickness_egu"]}]')
+    filter_texts: list of str
+        Description of each position of the filter wheel.
 
-        self.filter_combo = QtWidgets.QComboBox()
-        self.filter_combo.addItems([x['text'] for x in self.wheel_positions])
-
-        self.notes = QtWidgets.QTextEdit(f'{j}')
-
-        self.label_text = ''
-
-        self.indicator = QtWidgets.QPushButton()
-
-        self.width = 30
-        self.color = color = COLOR_SELECTED
-        self.inactive_color = COLOR_SKIPPED
-
-        self.indicator.setStyleSheet('''QPushButton {{
-                background-color: {color};
-                color: red;
-                border-style: solid;
-                border-width: 1px;
-                border-radius: {radius}px;
-                border-color: {color};
-                max-width: {width}px;
-                max-height: {width}px;
-                min-width: {width}px;
-                min-height: {width}px;
-                font-size: 36px;
-            }}'''.format(width=self.width, radius=self.width/2, color=self.color))
-        self.indicator.clicked.connect(self.input_dialog)
-        self.update_slot()  # update slot info with self.data
-
-        # self.cb.toggled.connect(self.sb.setEnabled)
-        # self.cb.toggled.connect(self.le.setEnabled)
-        self.cb.toggled.connect(self.state_changed)
-        self.cb.setChecked(self.sb.value() > 0)
-        self.indicator.setEnabled(True)
-
-        self.cb_layout = QtWidgets.QHBoxLayout()
-        self.cb_layout.addWidget(self.indicator)
-
-        self.cb.setLayout(self.cb_layout)
-        self.cb.setAlignment(QtCore.Qt.AlignCenter)
-
-        # Pop up window with parameters:
-        self.popup_window = QtWidgets.QMainWindow()
-        self.popup_window.setWindowTitle(self.label_text)
-
-        self.popup_widget = QtWidgets.QGroupBox()
-        self.popup_widget.setTitle(self.label_text)
-        self.popup_layout = QtWidgets.QFormLayout()
-        self.popup_widget.setLayout(self.popup_layout)
-        self.popup_window.setCentralWidget(self.popup_widget)
-
-        self.popup_layout.addRow('Name', self.le)
-        self.popup_layout.addRow('Exposure [ms]', self.sb)
-        self.popup_layout.addRow('Filter', self.filter_combo)
-        self.popup_layout.addRow('Notes', self.notes)
-
-        # Update tooltip values:
-        self.sb.valueChanged.connect(self.tooltip_update)
-        self.sb.valueChanged.connect(self.check_zero)
-        self.le.textChanged.connect(self.tooltip_update)
-        self.notes.textChanged.connect(self.tooltip_update)
-        self.filter_combo.currentIndexChanged.connect(self.tooltip_update)
-
-    def update_slot(self):
-        if self.data is not None:
-            self.label_text = f"Pos: {self.data['location']} / {self.data['slot']}"
-            self.cb.setTitle(self.label_text)
-            self.le.setText(str(self.data['name']))
-            self.notes.setText(str(self.data['notes']))
-            self.sb.setValue(float(self.data['exposure']))
-            if self.data['filter'] is not None:
-                self.filter_combo.setCurrentIndex(self.data['filter'])
-        self.tooltip_update()
-
-    def input_dialog(self):
-        self.popup_window.show()
-        self.popup_window.activateWindow()
-
-    def check_zero(self):
-        if self.sb.value() == 0:
-            self.cb.setChecked(False)
-            self.state_changed()
-            self.indicator.setEnabled(True)
-
-    def tooltip_update(self):
+    filter_index: int, optional
+        Initial filter index of the slots.
+    '''
+    def __init__(self, rows, cols, *, locations, filter_texts, filter_index=None):
+        super().__init__()
+        self.rows = rows
+        self.cols = cols
+        self.filter_texts = list(filter_texts)
+        n = rows * cols
+        self.state = np.zeros(n, dtype=SLOT_STATE_DTYPE)
+        self.state['filter'] = 0 if filter_index is None else filter_index
+        self.locations = list(locations)
+        self.names = [''] * n
+        self.notes = [''] * n
+        # colours by code of state['color']
+        self._palette = [COLOR_SKIPPED, COLOR_SELECTED, COLOR_RUNNING, COLOR_SUCCESS]
+
+    def __len__(self):
+        return len(self.state)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.rows
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.cols
+
+    def slot_index(self, index):
+        '''Slot number of a cell.'''
+        return index.row() * self.cols + index.column()
+
+    def flags(self, index):
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsUserCheckable
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        j = self.slot_index(index)
+        if role == QtCore.Qt.DisplayRole:
+            return self.label(j)
+        if role == QtCore.Qt.DecorationRole:
+            return _indicator_icon(self.color(j), self.warning(j))
+        if role == QtCore.Qt.CheckStateRole:
+            return QtCore.Qt.Checked if self.state['enabled'][j] else QtCore.Qt.Unchecked
+        if role == QtCore.Qt.ToolTipRole:
+            return self.tooltip(j)
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if role != QtCore.Qt.CheckStateRole or not index.isValid():
+            return False
+        self.set_slot(self.slot_index(index), enabled=value == QtCore.Qt.Checked)
+        return True
+
+    def label(self, j):
+        return f'{self.locations[j]} / {j}'
+
+    def color(self, j):
+        return self._palette[self.state['color'][j]]
+
+    def warning(self, j):
+        return 0 <= self.state['exposure'][j] < 10
+
+    def filter_text(self, j):
+        return self.filter_texts[self.state['filter'][j]]
+
+    def tooltip(self, j):
         warning = ''
-        self.indicator.setText('')
-        if 0 <= self.sb.value() < 10:
-            self.indicator.setText('X')
+        if self.warning(j):
             warning = '<h1 style="color: red;">Minimum exposure time must be >= 10 ms</h1>'
-
-        self.tooltip_text = f"""\
+        return f"""\
 {warning}<table>
     <tr>
-        <td>Slot:</td><td><b>{self.label_text}</b></td>
+        <td>Slot:</td><td><b>Pos: {self.label(j)}</b></td>
     </tr>
     <tr>
-        <td>Name:</td><td><b>{self.le.text()}</b></td>
+        <td>Name:</td><td><b>{self.names[j]}</b></td>
     </tr>
     <tr>
-        <td>Exposure:</td><td><b>{self.sb.value()}</b></td>
+        <td>Exposure:</td><td><b>{self.state['exposure'][j]}</b></td>
     </tr>
     <tr>
-        <td>Filter:</td><td><b>{self.filter_combo.currentText()}</b></td>
+        <td>Filter:</td><td><b>{self.filter_text(j)}</b></td>
     </tr>
     <tr>
-        <td>Notes:</td><td><i>{self.notes.toPlainText()}<i></td>
+        <td>Notes:</td><td><i>{self.notes[j]}<i></td>
     </tr>
 </table>
 """
-        self.indicator.setToolTip(self.tooltip_text)
 
-    def change_color(self, color=None):
-        if not color:
-            color = self.color
-        else:
-            self.color = color
-        width = self.width
-        return self.indicator.setStyleSheet(f'''QPushButton {{
-                background-color: {color};
-                color: red;
-                border-style: solid;
-                border-width: 1px;
-                border-radius: {width/2}px;
-                border-color: {color};
-                max-width: {width}px;
-                max-height: {width}px;
-                min-width: {width}px;
-                min-height: {width}px;
-                font-size: 36px;
-            }}''')
-
-    def state_changed(self):
-        if self.cb.isChecked():
-            color = COLOR_SELECTED
+    def _color_code(self, color):
+        if color not in self._palette:
+            self._palette.append(color)
+        return self._palette.index(color)
+
+    def _changed(self, j=None):
+        # one cell, or the whole table
+        if j is None:
+            first, last = self.index(0, 0), self.index(self.rows - 1, self.cols - 1)
         else:
-            color = COLOR_SKIPPED
-        self.change_color(color=color)
-        self.tooltip_update()
+            first = last = self.index(*divmod(int(j), self.cols))
+        self.dataChanged.emit(first, last)
+
+    def set_slot(self, j, *, enabled=None, exposure=None, filter=None, name=None, notes=None,
+                 location=None):
+        '''
+        Change a slot. Enabling or disabling it resets its colour; a zero
+        exposure disables it.
+        '''
+        state = self.state[j]
+        if exposure is not None:
+            state['exposure'] = exposure
+            if exposure == 0:
+                enabled = False
+        if filter is not None:
+            state['filter'] = filter
+        if name is not None:
+            self.names[j] = str(name)
+        if notes is not None:
+            self.notes[j] = str(notes)
+        if location is not None:
+            self.locations[j] = str(location)
+        if enabled is not None:
+            state['enabled'] = enabled
+            state['color'] = self._color_code(COLOR_SELECTED if enabled else COLOR_SKIPPED)
+        self._changed(j)
+
+    def load(self, records):
+        '''
+        Set the location, name, notes, exposure and filter index of the slots
+        from a sequence of dicts, one per slot (a filter index of None keeps
+        the filter). The slots are not enabled.
+        '''
+        for j, d in enumerate(records):
+            self.locations[j] = str(d['location'])
+            self.names[j] = str(d['name'])
+            self.notes[j] = str(d['notes'])
+            self.state['exposure'][j] = float(d['exposure'])
+            if d['filter'] is not None:
+                self.state['filter'][j] = d['filter']
+        zero = self.state['exposure'] == 0
+        self.state['enabled'][zero] = False
+        self.state['color'][zero] = self._color_code(COLOR_SKIPPED)
+        self._changed()
+
+    def set_all_enabled(self, enabled):
+        '''Enable (the slots with an exposure) or disable all the slots.'''
+        state = self.state
+        state['enabled'] = enabled & (state['exposure'] > 0)
+        state['color'] = np.where(state['enabled'], self._color_code(COLOR_SELECTED),
+                                  self._color_code(COLOR_SKIPPED))
+        self._changed()
+
+    def set_color(self, j, color):
+        self.state['color'][j] = self._color_code(color)
+        self._changed(j)
+
+    def set_colors(self, slots, color):
+        '''Set the colour of several slots (an index array) at once.'''
+        self.state['color'][slots] = self._color_code(color)
+        self._changed()
+
+
+class PlateSlot:
+    '''
+    One slot of a SlotTableModel, read and changed through attributes
+    (enabled, exposure, filter_index, name, notes).
+    '''
+    __slots__ = ('model', 'position')
+
+    def __init__(self, model, position):
+        self.model = model
+        self.position = position
 
     @property
     def enabled(self):
-        return self.cb.isChecked()
+        return bool(self.model.state['enabled'][self.position])
+
+    @enabled.setter
+    def enabled(self, value):
+        self.model.set_slot(self.position, enabled=bool(value))
 
     @property
-    def md(self):
-        return {'name': self.le.displayText(),
-                'notes': self.notes.toPlainText()}
+    def exposure(self):
+        return float(self.model.state['exposure'][self.position])
+
+    @exposure.setter
+    def exposure(self, value):
+        self.model.set_slot(self.position, exposure=float(value))
 
     @property
-    def position(self):
-        return self._position
+    def filter_index(self):
+        return int(self.model.state['filter'][self.position])
+
+    @filter_index.setter
+    def filter_index(self, value):
+        self.model.set_slot(self.position, filter=value)
 
     @property
-    def exposure(self):
-        return self.sb.value()
+    def name(self):
+        return self.model.names[self.position]
+
+    @name.setter
+    def name(self, value):
+        self.model.set_slot(self.position, name=value)
+
+    @property
+    def notes(self):
+        return self.model.notes[self.position]
+
+    @notes.setter
+    def notes(self, value):
+        self.model.set_slot(self.position, notes=value)
 
     @property
     def filter(self):
-        idx = self.filter_combo.currentIndex()
-        txt = self.wheel_positions[idx]['text']
-        return {'index': idx, 'text': txt}
+        return {'index': self.filter_index, 'text': self.model.filter_text(self.position)}
+
+    @property
+    def md(self):
+        return {'name': self.name, 'notes': self.notes}
+
+
+class SlotEditor:
+    '''
+    Pop up window with the parameters of a slot of a SlotTableModel. One is
+    created on first use and shared by all the slots; the changes go to the
+    model as they are typed.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self._position = None
+
+        self.le = QtWidgets.QLineEdit()
+
+        self.sb = QtWidgets.QDoubleSpinBox()
+        self.sb.setMinimum(0)
+        self.sb.setMaximum(20000)
+
+        # Combo box for selection of the filter thickness:
+        self.filter_combo = QtWidgets.QComboBox()
+        self.filter_combo.addItems(model.filter_texts)
+
+        self.notes = QtWidgets.QTextEdit()
+
+        self.window = QtWidgets.QMainWindow()
+        self.widget = QtWidgets.QGroupBox()
+        layout = QtWidgets.QFormLayout()
+        self.widget.setLayout(layout)
+        self.window.setCentralWidget(self.widget)
+
+        layout.addRow('Name', self.le)
+        layout.addRow('Exposure [ms]', self.sb)
+        layout.addRow('Filter', self.filter_combo)
+        layout.addRow('Notes', self.notes)
+
+        self.le.textChanged.connect(lambda text: self._store(name=text))
+        self.sb.valueChanged.connect(lambda value: self._store(exposure=value))
+        self.filter_combo.currentIndexChanged.connect(lambda idx: self._store(filter=idx))
+        self.notes.textChanged.connect(lambda: self._store(notes=self.notes.toPlainText()))
+
+    def _store(self, **values):
+        if self._position is not None:
+            self.model.set_slot(self._position, **values)
+
+    def edit(self, j):
+        '''Show the parameters of slot `j`.'''
+        slot = PlateSlot(self.model, j)
+        # do not store the values while loading them
+        self._position = None
+        label_text = f'Pos: {self.model.label(j)}'
+        self.window.setWindowTitle(label_text)
+        self.widget.setTitle(label_text)
+        self.le.setText(slot.name)
+        self.sb.setValue(slot.exposure)
+        self.filter_combo.setCurrentIndex(slot.filter_index)
+        self.notes.setText(slot.notes)
+        self._position = j
+        self.window.show()
+        self.window.activateWindow()
 
 
 class DirectorySelector:
@@ -299,7 +452,7 @@ class FileSelector:
 
         hlayout.addWidget(self.label)
         # hlayout.addStretch()
-        self.button_name = 'Select Excel plan'
+        self.button_name = 'Select plan'
         button = QtWidgets.QPushButton(self.button_name)
         button.setIcon(QtGui.QIcon.fromTheme('file'))
         button.clicked.connect(self.select_file)
@@ -310,46 +463,37 @@ class FileSelector:
 
         widget.setLayout(f_layout)
 
+        self.loader = PlanLoader()
+        self.loader.loaded.connect(self._plan_loaded)
+        self.loader.failed.connect(self._plan_failed)
+
     def select_file(self):
         fname = QtWidgets.QFileDialog.getOpenFileName(
-            None, 'Select Excel file', os.getcwd(),
-        filter='*.xls, *.xlsx')
+            None, 'Select plan file', os.getcwd(),
+        filter='Plans (*.xls *.xlsx *.json)')
         self.file_name = fname[0]
         self.short_desc.setText(self.file_name)
-        self.update_cells()
+        if self.file_name:
+            self.update_cells()
 
     def update_cells(self):
-        def int_con(str_val):
-            if str_val == '':
-                return(0)
-            else:
-                return(int(str_val))
+        # parsed in the background, the slots are updated by _plan_loaded
+        self.short_desc.setText(f'{self.file_name} (loading...)')
+        thicknesses = tuple(pos['thickness'] for pos in self.filter_obj.wheel_positions)
+        self.loader.load(self.file_name, parse_ht_plan, thicknesses)
+
+    def _plan_loaded(self, path, plan):
+        if path != self.file_name:
+            return
+        self.excel_data = plan
+        self.short_desc.setText(self.file_name)
+        self.ext_widget.slot_model.load(plan)
 
-        def flt_con(str_val):
-            if str_val == '':
-                return(0.)
-            else:
-                return(float(str_val))
-
-        self.excel_data = pd.read_excel(self.file_name,
-                                        dtype={'Slot (0-95)': int,
-                                               'Location': str,
-                                               'Sample name': str,
-                                               'Notes': str},
-                                        converters={'Exposure time (ms)': flt_con,
-                                                    'Filter Thickness (um)': int_con},
-                                        keep_default_na=False)
-        self.excel_data.columns = ['slot',
-                                   'location',
-                                   'name',
-                                   'exposure',
-                                   'filter',
-                                   'notes']
-        for j in range(NUM_ROWS*NUM_COLS):
-            thickness = self.excel_data['filter'][j]
-            self.excel_data.at[j, 'filter'] = get_index_from_position(self.filter_obj.wheel_positions, 'thickness', thickness)
-            self.ext_widget.slots[j].data = self.excel_data.iloc[j, :]
-            self.ext_widget.slots[j].update_slot()
+    def _plan_failed(self, path, message):
+        if path != self.file_name:
+            return
+        self.short_desc.setText(f'{self.file_name} (invalid)')
+        QtWidgets.QMessageBox.warning(self.widget, 'Invalid plan', message)
 
 
 class RunEngineControls:
@@ -383,24 +527,38 @@ class RunEngineControls:
         # label.setStyleSheet('QLabel {background-color: green; color: white}')
         button_layout.addWidget(info_label)
 
-        self.RE.state_hook = self.handle_state_change
+        # The plans run in the thread of plan_runner: the state changes (and
+        # the info shown by the plan) reach the widgets through Qt signals
+        self.bridge = RunEngineBridge()
+        self.bridge.state_changed.connect(self.handle_state_change)
+        self.bridge.info.connect(self.info_label.setText)
+        self.RE.state_hook = self.state_hook
         self.handle_state_change(self.RE.state, None)
 
+    def state_hook(self, new, old):
+        self.bridge.state_changed.emit(new, old)
+
+    def show_info(self, text):
+        '''Show `text` in the info label (from any thread).'''
+        self.bridge.info.emit(text)
+
     def run(self):
         if EpicsSignalRO(pps_shutter.enabled_status.pvname).get() == 0 and not mode.test_mode:
             self.label.setText('Shutter\nnot\nenabled')
             self.label.setStyleSheet(f'QLabel {{background-color: red; color: white}}')
         else:
+            if plan_runner.busy:
+                return
             if self.RE.state == 'idle':
-                self.RE(self.GUI.plan())
+                plan_runner.run(self.GUI.plan(), bridge=self.bridge)
             else:
-                self.RE.resume()
+                plan_runner.resume(bridge=self.bridge)
 
     def pause(self):
         if self.RE.state == 'running':
             self.RE.request_pause()
-        elif self.RE.state == 'paused':
-            self.RE.stop()
+        elif self.RE.state == 'paused' and not plan_runner.busy:
+            plan_runner.stop(bridge=self.bridge)
 
     def handle_state_change(self, new, old):
         if new == 'idle':
@@ -470,37 +628,41 @@ class XFPSampleSelector:
         # Main layout containing slots and control layouts:
         main_layout = QtWidgets.QHBoxLayout()
 
-        # Slots:
-        slots_layout = QtWidgets.QGridLayout()
-
         self.letter_number = LetterNumberLocator(num_cols=cols, num_rows=rows)
 
         field = 'thickness'
         current_thickness = getattr(self.filter_obj, field).read()[f'{getattr(self.filter_obj, field).name}']['value']
         current_index = get_index_from_position(self.filter_obj.wheel_positions, field, current_thickness, self.filter_obj._tolerance)
 
-        self.slots = []
-        for j in range(rows*cols):
-            r, c = np.unravel_index(j, (rows, cols))
-            data = {
-                'location': self.letter_number.find_slot_by_1d_index(j),
-                'slot': j,
-                'name': '',
-                'notes': '',
-                'exposure': 0,
-                'filter': current_index,
-            }
-            cw = ColumnWidget(j, data=data, filter_obj=self.filter_obj)
-            slots_layout.addWidget(cw.cb, r, c)
-            self.slots.append(cw)
-
-        main_layout.addLayout(slots_layout)
+        # Slots: one table model with the state of all the slots, shown by a
+        # table view; the pop up window to edit a slot is created on demand
+        self.slot_model = SlotTableModel(
+            rows, cols,
+            locations=[self.letter_number.find_slot_by_1d_index(j) for j in range(rows*cols)],
+            filter_texts=filter_texts(self.filter_obj.wheel_positions),
+            filter_index=current_index)
+        self.slots = [PlateSlot(self.slot_model, j) for j in range(rows*cols)]
+        self._slot_editor = None
+
+        self.slot_view = slot_view = QtWidgets.QTableView()
+        slot_view.setModel(self.slot_model)
+        slot_view.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        slot_view.setIconSize(QtCore.QSize(30, 30))
+        slot_view.horizontalHeader().hide()
+        slot_view.verticalHeader().hide()
+        slot_view.horizontalHeader().setDefaultSectionSize(110)
+        slot_view.verticalHeader().setDefaultSectionSize(40)
+        slot_view.setMinimumSize(110*cols + 2, 40*rows + 2)
+        # double-click a slot to edit it
+        slot_view.doubleClicked.connect(self.edit_slot)
+
+        main_layout.addWidget(slot_view)
 
         # Controls:
         self.controls_layout = controls_layout = QtWidgets.QVBoxLayout()
 
-        # Import Excel file controls:
-        self.import_file = import_file = FileSelector('Import Excel plan file', ext_widget=self, filter_obj=self.filter_obj)
+        # Import plan file (Excel or .json) controls:
+        self.import_file = import_file = FileSelector('Import plan file (Excel or .json)', ext_widget=self, filter_obj=self.filter_obj)
         self.path_select = path = DirectorySelector('Export CSV metadata after run')
         self.re_controls = RunEngineControls(RE, self, motors=[ht.x, ht.y])
 
@@ -514,6 +676,12 @@ class XFPSampleSelector:
         self.checkbox_shutter.setCheckable(True)
         controls_layout.addWidget(self.checkbox_shutter)
 
+        # Checkbox to record the whole plate as one run:
+        self.checkbox_single_run = QtWidgets.QCheckBox('Record the plate as one run?')
+        self.checkbox_single_run.setChecked(False)
+        self.checkbox_single_run.setCheckable(True)
+        controls_layout.addWidget(self.checkbox_single_run)
+
         # Test mode:
         self.checkbox_test_mode = QtWidgets.QCheckBox('Test mode')
         self.checkbox_test_mode.setChecked(mode.test_mode)
@@ -521,6 +689,22 @@ class XFPSampleSelector:
         self.checkbox_test_mode.clicked.connect(self.switch_test_mode)
         controls_layout.addWidget(self.checkbox_test_mode)
 
+        # Order of the slots:
+        self.order_combo = QtWidgets.QComboBox()
+        self.order_combo.addItems(SLOT_ORDERS.keys())
+        order_layout = QtWidgets.QFormLayout()
+        order_layout.addRow('Slot order:', self.order_combo)
+        # Slots to visit in this relative order in the 'fastest' order:
+        self.required_order_edit = QtWidgets.QLineEdit()
+        self.required_order_edit.setPlaceholderText('e.g. A1, B3, 17')
+        self.required_order_edit.editingFinished.connect(self._check_required_order)
+        order_layout.addRow('Required order:', self.required_order_edit)
+        self.order_combo.currentTextChanged.connect(self._order_changed)
+        self._order_changed(self.order_combo.currentText())
+        controls_layout.addLayout(order_layout)
+        # Phase durations of the slots of the last run (see slot_timing()):
+        self.slot_timings = []
+
         # Check/Uncheck button:
         button_toggle_all = QtWidgets.QPushButton('Check/Uncheck')
         button_toggle_all.setCheckable(True)
@@ -549,6 +733,8 @@ class XFPSampleSelector:
         # Align button:
         button_align = QtWidgets.QPushButton('Align')
         button_align.clicked.connect(self.align_ht)
+        self._align_bridge = RunEngineBridge()
+        self._align_bridge.finished.connect(self._align_finished)
 
         # Combo box for selection of the detectors to be used for alignment:
         self.dets_combo = QtWidgets.QComboBox()
@@ -606,10 +792,18 @@ class XFPSampleSelector:
         self.color_change_signal.signal.connect(self.change_slot_color)
 
     def change_slot_color(self, position, color):
-        self.slots[position].change_color(color)
+        self.slot_model.set_color(position, color)
+
+    def edit_slot(self, index):
+        if self._slot_editor is None:
+            self._slot_editor = SlotEditor(self.slot_model)
+        self._slot_editor.edit(self.slot_model.slot_index(index))
 
     def move_to_load_position(self):
-        RE(bps.mv(ht.x, self.load_pos_x, ht.y, self.load_pos_y))  # load position
+        # in the thread of plan_runner, like the walk
+        if plan_runner.busy:
+            return
+        plan_runner.run(bps.mv(ht.x, self.load_pos_x, ht.y, self.load_pos_y))  # load position
 
     def align_reset(self):
         try:
@@ -627,65 +821,79 @@ class XFPSampleSelector:
         for w in [self.aligning_x_label, self.aligning_x, self.aligning_y_label, self.aligning_y, self.align_reset_button]:
             w.setHidden(is_hidden)
 
-    def walk_values(self, snake=True):
-        rows = self._rows
-        cols = self._cols
-        # A 1d-array with bools (0/1) showing if the slot is enabled:
-        self.enabled = np.zeros((rows*cols))
-        for i in range(rows*cols):
-            d = self.slots[i]
-            if d.enabled:
-                self.enabled[i] = 1
-
-        # Convert it to 2d-array:
-        self.enabled = self.enabled.reshape((rows, cols))
-
-        # A 2d-array with the indices of the slots:
-        self.trajectory = np.arange(rows*cols).reshape((rows, cols))
-
-        # Prepare the snake trajectory
-        non_empty_rows = []
-        if snake:
-            for i in range(self.enabled.shape[0]):
-                if 1 in self.enabled[i, :]:
-                    non_empty_rows.append(i)
-            for i, i_real in enumerate(non_empty_rows):
-                if i % 2 != 0:
-                    self.trajectory[i_real, :] = self.trajectory[i_real, ::-1]
-
-        # List of return values:
-        return_list = []
-        for i in self.trajectory.reshape(rows*cols):
-            d = self.slots[i]
-            if d.enabled:
-                return_list.append({'exposure': d.exposure,
-                                    'position': d.position,
-                                    'filter_index': d.filter['index'],
-                                    'filter_text': d.filter['text'],
-                                    **d.md})
-        return return_list
+    @property
+    def order(self):
+        return SLOT_ORDERS[self.order_combo.currentText()]
+
+    @property
+    def required_order(self):
+        '''
+        Positions to visit in this relative order in the 'fastest' order, from
+        the 'Required order' field (None if empty).
+        '''
+        return parse_slot_list(self.required_order_edit.text(), self.slot_model.locations)
+
+    def _order_changed(self, text):
+        self.required_order_edit.setEnabled(SLOT_ORDERS[text] == 'fastest')
+
+    def _check_required_order(self):
+        try:
+            self.required_order
+        except ValueError as ex:
+            QtWidgets.QMessageBox.warning(self.window, 'Invalid required order', str(ex))
+
+    def walk_values(self, snake=True, order=None):
+        '''
+        Parameters of the enabled slots, in the order to visit them.
+
+        Parameters
+        ----------
+        snake: bool
+            Snake across the non-empty rows (if order is not given).
+
+        order: {'fastest', 'snake', 'slots'}, optional
+            'fastest' minimizes the predicted time of the walk (see
+            plan_slot_order()), keeping the relative order of the positions
+            in self.required_order.
+        '''
+        if order is None:
+            order = 'snake' if snake else 'slots'
+        start = self._current_state() if order == 'fastest' else None
+        return order_slots(self.plate(), order, self.h_pos, self.v_pos,
+                           shape=(self._rows, self._cols), start=start,
+                           required_order=self.required_order)
+
+    def plate(self):
+        '''The enabled slots, as a plate description (see ht_plate_plan()).'''
+        return [{'exposure': d.exposure,
+                 'position': d.position,
+                 'filter_index': d.filter['index'],
+                 'filter_text': d.filter['text'],
+                 **d.md} for d in self.slots if d.enabled]
+
+    def _current_state(self):
+        # the state the walk starts from: motor positions, filter and exposure
+        return ht_walk_start(filter_obj=self.filter_obj)
 
     def show(self):
-        RE.state_hook = self.re_controls.handle_state_change
+        RE.state_hook = self.re_controls.state_hook
         return self.window.show()
 
     def close(self):
         return self.window.close()
 
     def toggle_all(self, state):
-        for column in self.slots:
-            column.cb.setChecked(state and column.sb.value() > 0)
-            column.indicator.setEnabled(True)
+        self.slot_model.set_all_enabled(bool(state))
 
     def reset_colors(self):
-        for i, slot in enumerate(self.slots):
-            if slot.cb.isChecked():
-                self.color_change_signal.signal.emit(i, COLOR_SELECTED)
+        self.slot_model.set_colors(np.flatnonzero(self.slot_model.state['enabled']), COLOR_SELECTED)
 
     def switch_test_mode(self, state):
         mode.test_mode = state
 
     def align_ht(self):
+        if plan_runner.busy:
+            return
         det = ALIGN_DETS[self.dets_combo.currentText()]
         kwargs = {'det': det}
         if self._manual_align_is_checked():
@@ -713,18 +921,23 @@ class XFPSampleSelector:
         self._align_ht_ax_hor = ax_hor
         self._align_ht_ax_ver = ax_ver
 
-        RE(align_ht(**kwargs))
+        # in the thread of plan_runner: _align_finished continues in this one
+        plan_runner.run(align_ht(**kwargs), bridge=self._align_bridge)
+
+    def _align_finished(self, error):
         self.dets_combo.setEnabled(True)
-        self.update_locations(HT_COORDS['x'][self._slot_index[0]],
-                              HT_COORDS['y'][self._slot_index[1]])
+        # the plan sets the titles of the axes, drawn here in the GUI thread
+        self._align_ht_ax_hor.figure.canvas.draw_idle()
+        if error is None:
+            self.update_locations(HT_COORDS['x'][self._slot_index[0]],
+                                  HT_COORDS['y'][self._slot_index[1]])
 
     def set_test(self):
         for i in [(0, 10, 0), (2, 20, 1), (29, 30, 2)]:
-            column = self.slots[i[0]]
-            column.cb.setChecked(True)
-            column.indicator.setEnabled(True)
-            column.sb.setValue(i[1])
-            column.filter_combo.setCurrentIndex(i[2])
+            slot = self.slots[i[0]]
+            slot.exposure = i[1]
+            slot.filter_index = i[2]
+            slot.enabled = True
 
     def update_locations(self, slot_align_x, slot_align_y):
         d = default_coords(x_start=slot_align_x, y_start=slot_align_y,
@@ -733,22 +946,37 @@ class XFPSampleSelector:
         self.h_pos = d['x']
         self.v_pos = d['y']
 
-    def plan(self, file_name=None):
-
-        def close_shutters():
-            yield from bps.mv(diode_shutter, 'Close')
-            # yield from bps.mv(pre_shutter, 'Close')
-            yield from bps.mv(pps_shutter, 'Close')
-            yield from bps.mv(ht.x, self.load_pos_x, ht.y, self.load_pos_y)  # load position
-
-        def main_plan(file_name):
-            # Reset colors to the COLOR_SELECTED before each run:
-            self.reset_colors()
-
-            reason = self.path_select.short_desc.displayText()
-            run_notes = self.path_select.notes.toPlainText()
+    def plan(self, file_name=None, single_run=None):
+        '''
+        Plan exposing the enabled slots.
+
+        Parameters
+        ----------
+        file_name: string, optional
+            CSV file of the slot metadata (from the GUI fields by default).
+
+        single_run: bool, optional
+            Record the plate as one run with one event per slot (the slot
+            metadata as data, in ht_slot) instead of one run per slot. From
+            the GUI checkbox by default.
+        '''
+        # read the GUI now: the plan runs in the thread of plan_runner
+        if single_run is None:
+            single_run = self.checkbox_single_run.isChecked()
+        shutter_per_slot = self.checkbox_shutter.isChecked()
+        reason = self.path_select.short_desc.displayText()
+        gui_path = self.path_select.path
+        plate = self.plate()
+        order = self.order
+        required_order = self.required_order
+        # Reset colors to the COLOR_SELECTED before each run:
+        self.reset_colors()
+
+        def on_slot(position, state):
+            self.color_change_signal.signal.emit(position, SLOT_STATE_COLORS[state])
+
+        def gui_plan(file_name):
             if file_name is None:
-                gui_path = self.path_select.path
                 if gui_path and reason:
                     if '/' in reason:
                         raise FileInvalidException('Metadata file name cannot include reserved character "/".')
@@ -756,120 +984,22 @@ class XFPSampleSelector:
                     file_name = os.path.join(gui_path, fname)
                 else:
                     raise FileInvalidException("No metadata gui path/filename entered, resolve this and retry.")
-            if os.path.isfile(file_name):
-                raise FileInvalidException(f"Metadata file name {file_name} already in use, change names and retry")
-
-            xfp_print(f'CSV file name: {file_name}')
-
-            uid_list = []
-            base_md = {'plan_name': 'ht'}
-            if reason:
-                base_md['reason'] = reason
-
-            if not mode.test_mode:
-                yield from bps.mv(pps_shutter, 'Open')
-
-            for gui_d in self.walk_values():
-                d = dict(base_md)
-                d.update(gui_d)
-
-                row_num, col_num = np.unravel_index(gui_d['position'], (self._rows, self._cols))
-
-                xfp_print(f"Info: {d}")
-                xfp_print(f"Slot #{gui_d['position']}: X={self.h_pos[gui_d['position']]}  Y={self.v_pos[gui_d['position']]}")
-                self.color_change_signal.signal.emit(gui_d['position'], COLOR_RUNNING)
-
-                yield from bps.abs_set(ht.x, self.h_pos[gui_d['position']],
-                                       group='ht')
-                yield from bps.abs_set(ht.y, self.v_pos[gui_d['position']],
-                                       group='ht')
-
-                # always want to wait at least 3 seconds
-                yield from bps.sleep(3)
-                yield from bps.wait('ht')
-
-                self.re_controls.info_label.setText(motors_positions([ht.x, ht.y]))
-
-                # Open it once, when the holder arrives to the first scanning point:
-                if pre_shutter.status.get() == 'Not Open':
-                    yield from bps.mv(pre_shutter, 'Open')
-                if diode_shutter.status_closed.get() == 1 and not self.checkbox_shutter.isChecked():
-                    yield from bps.mv(diode_shutter, 'Open')
-
-                # Check that the shutters are opened before collecting data:
-                if not mode.test_mode:
-                    if pps_shutter.status.get() == 'Not Open':
-                        raise Exception(f'{pps_shutter.name} must be open to finish the scan')
-                    if pre_shutter.status.get() == 'Not Open':
-                        raise Exception(f'{pre_shutter.name} must be open to finish the scan')
-                    if diode_shutter.status_closed.get() == 1 and not self.checkbox_shutter.isChecked() :
-                        raise Exception(f'{diode_shutter.name} must be open to finish the scan')
-
-                uid = (yield from xfp_plan_fast_shutter(d,
-                                                        shutter_per_slot=self.checkbox_shutter.isChecked()))
-                self.color_change_signal.signal.emit(gui_d['position'], COLOR_SUCCESS)
-
-                xfp_print(f'UID from xfp_plan_fast_shutter(): {uid}')
-                if uid is not None:
-                    uid_list.append(uid)
-
-                yield from bps.checkpoint()
-
-            if uid_list:
-                columns = ('uid', 'name', 'exposure', 'filter_text', 'notes')
-                tbl = pd.DataFrame([[h.start[c] for c in columns]
-                                    for h in db[uid_list]], columns=columns)
-                self.last_table = tbl
-                if file_name is not None:
-                    tbl.to_csv(file_name, index=False)
-
-            # Close it once the walkthrough is done:
-            if not self.checkbox_shutter.isChecked():
-                # yield from bps.mv(shutter, 'Close')
-                yield from bps.mv(diode_shutter, 'Close')
-
-            from bluesky.utils import FailedStatus
-            try:
-                yield from bps.mv(pps_shutter, 'Close')
-            except FailedStatus:
-                yield from bps.mv(pps_shutter, 'Close')
-
-        return (yield from bpp.finalize_wrapper(main_plan(file_name),
-                                                close_shutters()))
-
-
-def motors_positions(motors):
-    format_str = []
-    motor_values = []
-    for m in motors:
-        format_str.append(f'{m.name}: {{}}')
-        motor_values.append(round(m.read()[m.name]['value'], 3))
-    return '\n'.join(format_str).format(*motor_values)
-
-
-def xfp_plan_fast_shutter(d, shutter_per_slot):
-    current_field = 'thickness'
-    move_to_thickness = float(get_position_from_index(filter_wheel.wheel_positions,
-                                                      current_field,
-                                                      d['filter_index']))
-    yield from bps.mv(getattr(filter_wheel, current_field), move_to_thickness)
-
-    exp_time = d['exposure']/1000
-    yield from bps.mv(dg, exp_time)
-
-    if shutter_per_slot:
-        # yield from bps.mv(pre_shutter, 'Open')
-        yield from bps.mv(diode_shutter, 'Open')
-
-    # fire the fast shutter and wait for it to close again
-    yield from bps.mv(dg.fire, 1)
-    yield from bps.sleep(exp_time*1.1)
-
-    if shutter_per_slot:
-        # yield from bps.mv(pre_shutter, 'Close')
-        yield from bps.mv(diode_shutter, 'Close')
-
-    return (yield from bp.count([ht.x, ht.y], md=d))
+
+            self.slot_timings = []
+            table = yield from ht_plate_plan(
+                plate, self.h_pos, self.v_pos, file_name, order=order,
+                required_order=required_order, single_run=single_run,
+                shutter_per_slot=shutter_per_slot, reason=reason,
+                load_position=(self.load_pos_x, self.load_pos_y),
+                shape=(self._rows, self._cols), timings=self.slot_timings,
+                on_slot=on_slot, on_info=self.re_controls.show_info,
+                filter_obj=self.filter_obj)
+            if table is not None:
+                self.last_table = table
+            return table
+
+        return gui_plan(file_name)
+
 
 try:
     HTgui.close()
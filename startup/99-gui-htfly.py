@@ -1,7 +1,6 @@
 import copy
 from enum import Enum
 
-import pandas as pd
 from ophyd import EpicsSignalRO
 
 from matplotlib.backends.qt_compat import QtWidgets, QtCore, QtGui
@@ -44,21 +43,35 @@ class RunEngineControlsHTFly:
         # label.setStyleSheet('QLabel {background-color: green; color: white}')
         button_layout.addWidget(info_label)
 
-        self.RE.state_hook = self.handle_state_change
+        # The plans run in the thread of plan_runner: the state changes (and
+        # the info shown by the plan) reach the widgets through Qt signals
+        self.bridge = RunEngineBridge()
+        self.bridge.state_changed.connect(self.handle_state_change)
+        self.bridge.info.connect(self.info_label.setText)
+        self.RE.state_hook = self.state_hook
         self.handle_state_change(self.RE.state, None)
 
+    def state_hook(self, new, old):
+        self.bridge.state_changed.emit(new, old)
+
+    def show_info(self, text):
+        '''Show `text` in the info label (from any thread).'''
+        self.bridge.info.emit(text)
+
     def run(self):
+        if plan_runner.busy:
+            return
         if self.RE.state == 'idle':
             #self.RE(sleep(2.0))
-            self.RE(self.GUI.plan())
+            plan_runner.run(self.GUI.plan(), bridge=self.bridge)
         else:
-            self.RE.resume()
+            plan_runner.resume(bridge=self.bridge)
 
     def pause(self):
         if self.RE.state == 'running':
             self.RE.request_pause()
-        elif self.RE.state == 'paused':
-            self.RE.stop()
+        elif self.RE.state == 'paused' and not plan_runner.busy:
+            plan_runner.stop(bridge=self.bridge)
 
     def handle_state_change(self, new, old):
         if new == 'idle':
@@ -169,7 +182,7 @@ class HTFlyGUI:
         self.main_window = HTFlyGUIMainWindow(filter_obj=filter_obj, re_controls=self.re_controls)
 
     def show(self):
-        RE.state_hook = self.re_controls.handle_state_change
+        RE.state_hook = self.re_controls.state_hook
         self.main_window.show()
 
     def close(self):
@@ -177,6 +190,16 @@ class HTFlyGUI:
 
 
     def plan(self):
+        # read the GUI now: the plan runs in the thread of plan_runner
+        rows = []
+        for row_num, widget_row in enumerate(self.main_window.widget_rows):
+            if widget_row[0].checkState() == QtCore.Qt.CheckState.Checked:
+                exp_time = float(widget_row[3].text())
+                al_thickness = self.main_window.wheel_positions[widget_row[4].currentIndex()][
+                    "thickness"
+                ]
+                rows.append((row_num, exp_time, al_thickness))
+
         def close_shutters():
             #pps_shutter.set("Close")
             yield from bps.mv(pps_shutter, 'Close')
@@ -187,30 +210,24 @@ class HTFlyGUI:
 
         def main_plan():
             num_rows = 0
-            for row_num, widget_row in enumerate(self.main_window.widget_rows):
-                if widget_row[0].checkState() == QtCore.Qt.CheckState.Checked:
-                    self.main_window.led_color_change_signal.emit(row_num, LEDState.COLLECTING)
-                    exp_time = float(widget_row[3].text())
-                    al_thickness = self.main_window.wheel_positions[widget_row[4].currentIndex()][
-                        "thickness"
-                    ]
-                    print(f"Experiment running {row_num} {exp_time} {al_thickness}")
-                    if exp_time.is_integer():
-                        exp_time = int(exp_time)
-
-                    uid = (yield from htfly_exptime_row(row_num + 1, f"{exp_time}ms", al_thickness))
-                    # yield from test_plan()
-                    print(f"UID from htfly_exptime_row: {uid}")
-                    self.main_window.led_color_change_signal.emit(row_num, LEDState.COMPLETE)
-                    num_rows += 1
+            for row_num, exp_time, al_thickness in rows:
+                self.main_window.led_color_change_signal.emit(row_num, LEDState.COLLECTING)
+                print(f"Experiment running {row_num} {exp_time} {al_thickness}")
+                if exp_time.is_integer():
+                    exp_time = int(exp_time)
+
+                uid = (yield from htfly_exptime_row(row_num + 1, f"{exp_time}ms", al_thickness))
+                # yield from test_plan()
+                print(f"UID from htfly_exptime_row: {uid}")
+                self.main_window.led_color_change_signal.emit(row_num, LEDState.COMPLETE)
+                num_rows += 1
             print(
                 f"\nExposure set for {num_rows} row(s) completed, now closing the photon shutter and returning to load position.\n"
             )
 
             
         
-        return (yield from bpp.finalize_wrapper(main_plan(),
-                                                close_shutters()))
+        return bpp.finalize_wrapper(main_plan(), close_shutters())
 
 
 class HTFlyGUIMainWindow(QtWidgets.QMainWindow):
@@ -290,6 +307,9 @@ class HTFlyGUIMainWindow(QtWidgets.QMainWindow):
             )
         self._create_layout()
         self.led_color_change_signal.connect(self.change_led_color)
+        self.plan_loader = PlanLoader()
+        self.plan_loader.loaded.connect(self.populate_widgets)
+        self.plan_loader.failed.connect(self.import_failed)
 
     def change_led_color(self, position, color: LEDState):
         print(f"Changing LED color! {color}")
@@ -340,7 +360,7 @@ class HTFlyGUIMainWindow(QtWidgets.QMainWindow):
                 self.widget_layout.addWidget(widget, row, col)
 
         # Adding import button
-        import_button = QtWidgets.QPushButton("Import Excel Plan")
+        import_button = QtWidgets.QPushButton("Import Plan")
         self.checkbox_test_mode = QtWidgets.QCheckBox("Test mode")
         self.checkbox_test_mode.setChecked(mode.test_mode)
         self.checkbox_test_mode.setCheckable(True)
@@ -365,61 +385,32 @@ class HTFlyGUIMainWindow(QtWidgets.QMainWindow):
     def import_excel_plan(self):
         dialog = QtWidgets.QFileDialog()
         filename, _ = dialog.getOpenFileName(
-            self, "Import Plan", filter="Excel (*.xlsx)"
+            self, "Import Plan", filter="Plans (*.xlsx *.json)"
         )
         if filename:
-            df = pd.read_excel(filename)
-            if not self.is_valid_excel(df):
-                return
-            df = self.cleanup_dataframe(df)
-            self.populate_widgets(df)
-
-    def cleanup_dataframe(self, df):
-        df["Sample name"] = df["Sample name"].fillna("")
-        df["Exposure time (ms)"] = df["Exposure time (ms)"].fillna(0)
-        df["Filter Thickness (um)"] = df["Filter Thickness (um)"].fillna(0)
-        df["Notes"] = df["Notes"].fillna("")
-
-        return df
-
-    def populate_widgets(self, df):
-        for i, row in df.iterrows():
-            widget_row = self.widget_rows[i]
+            # parsed in the background, the widgets are updated by populate_widgets
+            thicknesses = tuple(pos["thickness"] for pos in self.wheel_positions)
+            self.plan_loader.load(filename, parse_htfly_plan, thicknesses)
+
+    def populate_widgets(self, path, plan):
+        for widget_row, row in zip(self.widget_rows, plan):
             widget_row[0].setChecked(True)
-            widget_row[2].setText(row["Sample name"])
-            widget_row[3].setText(str(row["Exposure time (ms)"]))
-            if not row["Sample name"] or row["Exposure time (ms)"] == 0:
+            widget_row[2].setText(row["name"])
+            widget_row[3].setText(str(row["exposure"]))
+            if not row["name"] or row["exposure"] == 0:
                 widget_row[0].setChecked(False)
-            for i, pos in enumerate(self.wheel_positions):
-                if pos["thickness"] == row["Filter Thickness (um)"]:
-                    widget_row[4].setCurrentIndex(i)
-                    break
+            if row["filter"] is not None:
+                widget_row[4].setCurrentIndex(row["filter"])
 
-            if row["Sample name"] == "" or row["Exposure time (ms)"] == 0:
+            if row["name"] == "" or row["exposure"] == 0:
                 for widget in widget_row:
                     widget.setDisabled(True)
             else:
                 for widget in widget_row:
                     widget.setDisabled(False)
 
-    def is_valid_excel(self, df):
-        if len(df) != 6:
-            self.show_error_dialog(
-                "Excel file does not contain exactly 6 rows, aborting import"
-            )
-            return False
-        required_columns = [
-            "Sample name",
-            "Exposure time (ms)",
-            "Filter Thickness (um)",
-            "Notes",
-        ]
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            self.show_error_dialog(f"Missing columns: {(',').join(missing_columns)}")
-            return False
-
-        return True
+    def import_failed(self, path, message):
+        self.show_error_dialog(message)
 
     def show_error_dialog(self, message):
         dlg = QtWidgets.QMessageBox(self)
@@ -0,0 +1,12 @@
+#!/bin/bash
+
+# Run the plan benchmarks in the offline simulation (see xfp_sim/bench.py),
+# e.g. "xfp-bench.sh" for all of them or "xfp-bench.sh flow htfly_rows".
+# The results are appended to the history in the bluesky user data directory.
+
+names=""
+for name in "$@"; do
+    names+="'$name',"
+done
+
+XFP_SIM=1 XFP_SIM_SPEED=${XFP_SIM_SPEED:-1} bsui -c "import xfp_sim.bench; xfp_sim.bench.main([$names] or None)"
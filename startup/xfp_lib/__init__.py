@@ -0,0 +1,9 @@
+'''
+Helper modules of the startup files.
+
+The modules of this package are imported by the startup files; they live in a
+package so that IPython does not run them as startup files themselves:
+
+    batched_persistent_dict  RE.md store writing once per logical update
+    startup_profiler         opt-in per-file profiler of the startup files
+'''
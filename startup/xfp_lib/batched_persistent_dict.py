@@ -0,0 +1,163 @@
+'''
+RE.md store writing to disk once per logical update.
+
+bluesky's PersistentDict writes one file per key on every assignment, and the
+RunEngine assigns scan_id at every run. BatchedPersistentDict wraps a
+PersistentDict (so the directory format is PersistentDict's own) and only
+writes to it through its public mapping interface, but
+
+- groups the assignments made in a transaction into one write per changed key
+  when the transaction ends, and rolls them back if it fails:
+
+      with RE.md.transaction():
+          RE.md['proposal'] = ...
+          RE.md['SAF'] = ...
+
+  (update() is a transaction by itself);
+
+- reserves scan_ids on disk by blocks: when a run gets a scan_id past the
+  reserved block, the end of a new block of `scan_id_block` scan_ids is
+  written before the RunEngine emits the start document; the runs within the
+  block write nothing. The actual value is written by flush() and at exit.
+  After a crash the scan_ids skip ahead to the end of the block, but never
+  repeat. A scan_id set by hand (not the next one) is written as is.
+'''
+
+import collections.abc
+import contextlib
+import copy
+import threading
+import weakref
+
+from bluesky.utils import PersistentDict
+
+_MISSING = object()
+
+
+def _flush(store, data, reserved):
+    # write the actual scan_id over the end of the reserved block
+    if data.get('scan_id') != reserved[0]:
+        store['scan_id'] = reserved[0] = data['scan_id']
+
+
+class BatchedPersistentDict(collections.abc.MutableMapping):
+    '''
+    A PersistentDict writing once per transaction and reserving scan_ids
+    by blocks.
+
+    Parameters
+    ----------
+    directory: Path or string
+        Directory of the metadata files (created if needed).
+
+    scan_id_block: int
+        Number of scan_ids reserved on disk at a time.
+    '''
+    def __init__(self, directory, scan_id_block=100):
+        self.store = PersistentDict(str(directory))
+        self.scan_id_block = scan_id_block
+        self._lock = threading.RLock()
+        self._data = dict(self.store)
+        # [scan_id on disk]: the end of the reserved block, or the actual value
+        self._reserved = [self._data.get('scan_id')]
+        # key -> value before the current transaction (None: no transaction)
+        self._pending = None
+        # write the actual scan_id at exit (without a reference to self)
+        self._finalizer = weakref.finalize(self, _flush, self.store, self._data,
+                                           self._reserved)
+
+    @property
+    def directory(self):
+        return self.store.directory
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Group assignments and deletions into one write to disk. The changes
+        are rolled back if the block raises. Transactions can be nested.
+        '''
+        with self._lock:
+            if self._pending is not None:
+                yield self
+                return
+            self._pending = {}
+            try:
+                yield self
+            except BaseException:
+                for key, value in self._pending.items():
+                    if value is _MISSING:
+                        self._data.pop(key, None)
+                    else:
+                        self._data[key] = value
+                raise
+            else:
+                self._commit(self._pending)
+            finally:
+                self._pending = None
+
+    def _commit(self, keys):
+        if 'scan_id' in keys:
+            self._reserved[0] = self._data.get('scan_id')
+        for key in keys:
+            if key in self._data:
+                self.store[key] = self._data[key]
+            elif key in self.store:
+                del self.store[key]
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self._data!r}>'
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.setdefault(key, self._data.get(key, _MISSING))
+                self._data[key] = value
+            elif (key == 'scan_id' and isinstance(value, int)
+                  and self._data.get(key) == value - 1
+                  and isinstance(self._reserved[0], int)):
+                # the next run: only written past the reserved block
+                if value > self._reserved[0]:
+                    self.store[key] = self._reserved[0] = value + self.scan_id_block - 1
+                self._data[key] = value
+            else:
+                with self.transaction():
+                    self[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._data:
+                raise KeyError(key)
+            with self.transaction():
+                self._pending.setdefault(key, self._data[key])
+                del self._data[key]
+
+    def __deepcopy__(self, memo):
+        # the RunEngine deep-copies the metadata of every run: a plain dict
+        with self._lock:
+            return copy.deepcopy(self._data, memo)
+
+    def update(self, *args, **kwargs):
+        with self.transaction():
+            super().update(*args, **kwargs)
+
+    def flush(self):
+        '''Write the actual scan_id to disk, releasing the reserved block.'''
+        with self._lock:
+            _flush(self.store, self._data, self._reserved)
+
+    def reload(self):
+        '''Force a reload from disk, overwriting the current values.'''
+        with self._lock:
+            self.store.reload()
+            self._data.clear()
+            self._data.update(self.store)
+            self._reserved[0] = self._data.get('scan_id')
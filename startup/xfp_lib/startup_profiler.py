@@ -0,0 +1,290 @@
+'''
+Opt-in per-file profiler for the IPython startup files.
+
+Enable it with the XFP_PROFILE_STARTUP=1 environment variable. The profiler is
+installed at the top of 00-base.py. It times every startup file run after that
+point, splitting each one into:
+
+    import      time spent in (top-level) imports
+    construct   time spent building ophyd devices and signals
+    connect     time spent waiting for CA channels to connect
+    other       everything else
+
+It also records how much each file raised the process peak memory. After the
+last startup file a summary is printed, and the run is appended to a JSONL
+history file, so that slow restarts can be compared with previous ones.
+
+This is a helper module imported by the startup files (see xfp_lib).
+'''
+
+import builtins
+import functools
+import json
+import os
+import resource
+import socket
+import statistics
+import threading
+import time as ttime
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+CATEGORIES = ('import', 'construct', 'connect')
+
+# The installed profiler, if any (see install()).
+_profiler = None
+
+
+class StartupProfiler:
+    '''
+    Collects per-file timings while the startup files run.
+
+    Time is only counted on the main thread, and only for the outermost
+    category: e.g. an import done while building a device counts as
+    construction time.
+
+    Parameters
+    ----------
+    startup_files: list of strings
+        File names of the startup files, in the order IPython runs them.
+
+    history_file: Path
+        JSONL file the results of each startup are appended to.
+    '''
+    def __init__(self, startup_files, history_file):
+        self.startup_files = list(startup_files)
+        self.history_file = Path(history_file)
+        self.records = []
+        self._current = None
+        self._active = None
+        self._main_thread = threading.get_ident()
+        self._patches = []
+        self._start = ttime.perf_counter()
+
+    def _claim(self, category):
+        if (self._current is None or self._active is not None
+                or threading.get_ident() != self._main_thread):
+            return False
+        self._active = category
+        return True
+
+    def _release(self, category, t0):
+        self._current[category] += ttime.perf_counter() - t0
+        self._active = None
+
+    @contextmanager
+    def timed(self, category):
+        '''Count the time spent in the with-block as `category`.'''
+        if not self._claim(category):
+            yield
+            return
+        t0 = ttime.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(category, t0)
+
+    def patch(self, owner, attr, category):
+        '''Replace owner.attr by a wrapper that times calls as `category`.'''
+        original = getattr(owner, attr)
+        profiler = self
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            if not profiler._claim(category):
+                return original(*args, **kwargs)
+            t0 = ttime.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                profiler._release(category, t0)
+
+        setattr(owner, attr, wrapper)
+        self._patches.append((owner, attr, original))
+
+    def unpatch(self):
+        for owner, attr, original in reversed(self._patches):
+            setattr(owner, attr, original)
+        self._patches = []
+
+    def begin(self, filename):
+        self._current = dict(file=filename, start=ttime.perf_counter(),
+                             maxrss=_maxrss_mb(),
+                             **{category: 0.0 for category in CATEGORIES})
+
+    def end(self):
+        rec = self._current
+        self._current = None
+        total = ttime.perf_counter() - rec.pop('start')
+        maxrss = _maxrss_mb()
+        self.records.append(dict(
+            file=rec['file'],
+            total=total,
+            **{category: rec[category] for category in CATEGORIES},
+            other=max(total - sum(rec[category] for category in CATEGORIES), 0),
+            peak_mem_mb=maxrss - rec['maxrss'],
+        ))
+
+    def wrap_execfile(self, shell):
+        '''Time every file run through shell.safe_execfile.'''
+        original = shell.safe_execfile
+        profiler = self
+
+        @functools.wraps(original)
+        def safe_execfile(fname, *args, **kwargs):
+            if profiler._current is not None:
+                # The file the profiler was installed from (00-base.py)
+                profiler.end()
+            profiler.begin(os.path.basename(fname))
+            failed = True
+            try:
+                result = original(fname, *args, **kwargs)
+                failed = False
+                return result
+            finally:
+                profiler.end()
+                # IPython stops running the startup files after an error
+                if failed or os.path.basename(fname) == profiler.startup_files[-1]:
+                    shell.safe_execfile = original
+                    profiler.finish()
+
+        shell.safe_execfile = safe_execfile
+
+    def finish(self):
+        '''Remove the instrumentation, save the results and print a summary.'''
+        global _profiler
+        self.unpatch()
+        builtins.__import__ = self._original_import
+        _profiler = None
+
+        previous = load_history(self.history_file)
+        entry = dict(time=ttime.time(),
+                     host=socket.gethostname(),
+                     total=ttime.perf_counter() - self._start,
+                     files=self.records)
+        try:
+            self.history_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.history_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as err:
+            print(f"Could not save the startup profile to {self.history_file}: {err}")
+        print_startup_profile(entry, previous)
+
+
+def _maxrss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_history(history_file, last=None):
+    '''
+    Read the saved startup profiles.
+
+    Parameters
+    ----------
+    history_file: Path or string
+        JSONL file written by the profiler.
+
+    last: int, optional
+        Only return the last `last` entries.
+    '''
+    history = []
+    try:
+        with open(history_file) as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return history[-last:] if last else history
+
+
+def print_startup_profile(entry, previous=(), n_previous=5):
+    '''
+    Print the per-file table of a startup profile.
+
+    The last column is the median total time of the same file over the
+    previous `n_previous` startups, to spot regressions.
+    '''
+    previous = list(previous)[-n_previous:]
+    median_prev = {}
+    for fname in {rec['file'] for run in previous for rec in run['files']}:
+        times = [rec['total'] for run in previous for rec in run['files']
+                 if rec['file'] == fname]
+        median_prev[fname] = statistics.median(times)
+
+    header = ''.join(f"{col:>10}" for col in ('total', *CATEGORIES, 'other', 'mem [MB]', 'prev'))
+    print(f"\nStartup profile [s]\n{'File':<26}{header}")
+    for rec in entry['files']:
+        prev = median_prev.get(rec['file'])
+        prev = f"{prev:>10.2f}" if prev is not None else f"{'-':>10}"
+        cols = ''.join(f"{rec[col]:>10.2f}" for col in ('total', *CATEGORIES, 'other', 'peak_mem_mb'))
+        print(f"{rec['file']:<26}{cols}{prev}")
+    print(f"{'Total':<26}{entry['total']:>10.2f}")
+
+
+def install(shell, history_file):
+    '''
+    Start profiling the startup files.
+
+    Must be called from the first startup file (00-base.py), which is timed
+    from the point of the call.
+
+    Parameters
+    ----------
+    shell: InteractiveShell
+        The IPython shell running the startup files.
+
+    history_file: Path or string
+        JSONL file to append the results to.
+
+    Returns
+    -------
+    profiler: StartupProfiler
+    '''
+    global _profiler
+    startup_dir = Path(shell.profile_dir.startup_dir)
+    startup_files = sorted(p.name for pattern in ('*.py', '*.ipy')
+                           for p in startup_dir.glob(pattern))
+
+    profiler = StartupProfiler(startup_files, history_file)
+    profiler.begin(startup_files[0])
+    with profiler.timed('import'):
+        from ophyd import Device
+        from ophyd.signal import EpicsSignal, EpicsSignalBase, Signal
+
+    profiler.patch(Device, '__init__', 'construct')
+    profiler.patch(Signal, '__init__', 'construct')
+    profiler.patch(EpicsSignalBase, '_ensure_connected', 'connect')
+    profiler.patch(EpicsSignalBase, 'wait_for_connection', 'connect')
+    profiler.patch(EpicsSignal, 'wait_for_connection', 'connect')
+    profiler.patch(Device, 'wait_for_connection', 'connect')
+
+    # builtins.__import__ is restored separately in finish()
+    original_import = profiler._original_import = builtins.__import__
+
+    def timed_import(*args, **kwargs):
+        if not profiler._claim('import'):
+            return original_import(*args, **kwargs)
+        t0 = ttime.perf_counter()
+        try:
+            return original_import(*args, **kwargs)
+        finally:
+            profiler._release('import', t0)
+
+    builtins.__import__ = timed_import
+    profiler.wrap_execfile(shell)
+    _profiler = profiler
+    return profiler
+
+
+def timed(category):
+    '''
+    Count a block of startup code as `category` (see CATEGORIES).
+    Does nothing if the profiler is not running.
+    '''
+    if _profiler is None:
+        return nullcontext()
+    return _profiler.timed(category)
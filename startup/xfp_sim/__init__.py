@@ -0,0 +1,37 @@
+'''
+Offline simulation of the XFP beamline.
+
+Start the profile with XFP_SIM=1 to run every startup file against simulated
+PVs instead of the beamline IOCs (see 00-base.py). Devices, plans and GUIs are
+unchanged: only ophyd's control layer is swapped, so the real device code
+(EpicsMotor, TwoButtonShutter, DelayGenerator, Pump, ...) runs against a model
+of the hardware with realistic timing. XFP_SIM_SPEED makes simulated time run
+faster than wall-clock time.
+
+This package is not a startup file; it is imported by 00-base.py. The same
+model can also be served over Channel Access by a caproto IOC (xfp_sim.ioc)
+to run the profile's real CA code paths without the beamline.
+'''
+
+from .control_layer import SimPV, control_layer
+from .model import SimModel, xfp_model
+
+
+def install(speed=1.0):
+    '''
+    Create the XFP simulation model and make ophyd use it.
+
+    Parameters
+    ----------
+    speed: float
+        Simulated time runs this many times faster than wall-clock time.
+
+    Returns
+    -------
+    model: SimModel
+    '''
+    from .control_layer import install as install_control_layer
+
+    model = xfp_model(speed=speed)
+    install_control_layer(model)
+    return model
@@ -0,0 +1,372 @@
+'''
+Throughput benchmarks of the production plans on the offline simulation.
+
+Each benchmark runs a real plan of the profile with the RunEngine against the
+simulated devices, and splits its wall time into phases from the messages the
+plan yields:
+
+    motion      waiting for motors and pseudo-positioners
+    exposure    delay generator, pumps and detector triggers
+    shutter     opening and closing the shutters
+    sleep       fixed bps.sleep calls
+    documents   reading devices and emitting documents (open_run, save, ...)
+    other       the plan's own code and every other message
+
+The results are appended to a JSON-lines history together with the git commit
+of the profile, so that a change can be compared with the previous commits.
+Run them in a simulated session (or with xfp-bench.sh):
+
+    XFP_SIM=1 ipython --profile=collection -c "import xfp_sim.bench; xfp_sim.bench.main()"
+
+The wall-clock budgets are for XFP_SIM_SPEED=1 (real hardware timing); a
+faster simulation only makes the plans shorter. bps.sleep is not scaled by
+the simulation speed.
+'''
+
+import builtins
+import collections
+import json
+import subprocess
+import tempfile
+import time as ttime
+from pathlib import Path
+from unittest import mock
+
+import appdirs
+from IPython import get_ipython
+from ophyd import PositionerBase
+
+PHASES = ('motion', 'exposure', 'shutter', 'sleep', 'documents', 'other')
+
+# Phase of the devices that are not positioners, by name of the device
+DEVICE_PHASES = {
+    'shutter': 'shutter',
+    'pps_shutter': 'shutter',
+    'diode_shutter': 'shutter',
+    'dg': 'exposure',
+    'sample_pump': 'exposure',
+    'food_pump': 'exposure',
+    'syringe_pump': 'exposure',
+    'fc': 'exposure',
+}
+
+DOCUMENT_COMMANDS = {'open_run', 'close_run', 'create', 'read', 'save', 'drop',
+                     'declare_stream', 'monitor', 'unmonitor'}
+
+HISTORY_FILE = Path(appdirs.user_data_dir(appname='bluesky')) / 'xfp-bench.jsonl'
+
+STARTUP_DIR = Path(__file__).resolve().parents[1]
+
+
+def _phase_of(obj):
+    '''Phase of the time spent setting or waiting for `obj`.'''
+    while obj is not None:
+        phase = DEVICE_PHASES.get(getattr(obj, 'name', None))
+        if phase is not None:
+            return phase
+        if isinstance(obj, PositionerBase):
+            return 'motion'
+        obj = getattr(obj, 'parent', None)
+    return 'other'
+
+
+class PhaseTimer:
+    '''
+    Accumulate the wall time of a plan per phase, message by message.
+
+    The time between yielding a message and getting the reply of the
+    RunEngine goes to the phase of the message; a 'wait' goes to the phase of
+    the objects of its group (the slowest-looking one: motion first). The
+    time spent in the plan's own code goes to 'other'.
+    '''
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.n_messages = 0
+        self._groups = collections.defaultdict(set)
+
+    def _msg_phase(self, msg):
+        command = msg.command
+        if command == 'sleep':
+            return 'sleep'
+        if command in DOCUMENT_COMMANDS:
+            return 'documents'
+        if command == 'wait':
+            phases = self._groups.pop(msg.kwargs.get('group'), None)
+            return min(phases, key=PHASES.index) if phases else 'other'
+        if command == 'trigger':
+            phase = 'exposure'
+        elif command in ('set', 'kickoff', 'complete'):
+            phase = _phase_of(msg.obj)
+        else:
+            return 'other'
+        group = msg.kwargs.get('group')
+        if group is not None:
+            self._groups[group].add(phase)
+        return phase
+
+    def wrap(self, plan):
+        '''Pass the messages of `plan` through, timing each of them.'''
+        reply, error = None, None
+        while True:
+            t0 = ttime.monotonic()
+            try:
+                msg = plan.throw(error) if error is not None else plan.send(reply)
+            except StopIteration as stop:
+                self.phases['other'] += ttime.monotonic() - t0
+                return stop.value
+            t1 = ttime.monotonic()
+            self.phases['other'] += t1 - t0
+            phase = self._msg_phase(msg)
+            self.n_messages += 1
+            try:
+                reply, error = (yield msg), None
+            except GeneratorExit:
+                plan.close()
+                raise
+            except BaseException as err:
+                reply, error = None, err
+            self.phases[phase] += ttime.monotonic() - t1
+
+
+def _patched(plan, ns, **values):
+    '''Run `plan` with some globals of the profile temporarily replaced.'''
+    missing = object()
+    saved = {key: ns.get(key, missing) for key in values}
+    ns.update(values)
+    try:
+        return (yield from plan)
+    finally:
+        for key, value in saved.items():
+            if value is missing:
+                ns.pop(key, None)
+            else:
+                ns[key] = value
+
+
+def _scripted_input(plan, answers):
+    '''Run `plan`, answering its input() prompts with `answers`.'''
+    with mock.patch.object(builtins, 'input', side_effect=list(answers)):
+        return (yield from plan)
+
+
+def _figure(ns, title):
+    fig = ns['plt'].figure(title, figsize=(16, 5))
+    fig.clf()
+    ax_hor, ax_ver = fig.subplots(1, 2)
+    return fig, ax_hor, ax_ver
+
+
+# -- the benchmarks ------------------------------------------------------------
+
+# Exposure time [ms] of every slot of the HT plate
+HT_PLATE_EXPOSURE = 100
+
+# HTFly rows: row number, exposure time (a key of htfly_lookup.yaml), Al [um]
+HTFLY_ROWS = ((1, '50ms', 0), (2, '20ms', 25), (3, '10ms', 76),
+              (4, '5ms', 152), (5, '2ms', 203), (6, '1ms', 305))
+
+
+# The benchmarks set up the GUI and the figures here, in the main thread, and
+# return the plan: plan code runs in the RunEngine's thread.
+
+def ht_plate(ns, workdir):
+    '''96-slot walk of the HT holder (ht_plate_plan), all slots exposed.'''
+    text = ns['filter_texts'](ns['filter_wheel'].wheel_positions)[0]
+    plate = [{'position': j, 'exposure': HT_PLATE_EXPOSURE, 'filter_index': 0,
+              'filter_text': text, 'name': f'sample {j}', 'notes': ''}
+             for j in range(ns['NUM_ROWS'] * ns['NUM_COLS'])]
+    return ns['ht_plate_plan'](plate, ns['HT_COORDS']['x'], ns['HT_COORDS']['y'],
+                               str(workdir / 'ht_plate.csv'))
+
+
+def htfly_rows(ns, workdir):
+    '''htfly_exp_plan over the 6 rows of HTFLY_ROWS.'''
+    answers = [str(len(HTFLY_ROWS)),
+               ','.join(str(row) for row, _, _ in HTFLY_ROWS),
+               ', '.join(exp_time for _, exp_time, _ in HTFLY_ROWS),
+               ','.join(str(al) for _, _, al in HTFLY_ROWS)]
+    return _scripted_input(ns['htfly_exp_plan'](), answers)
+
+
+def align_ht(ns, workdir):
+    '''align_ht with tcm1; the HT coordinates are written to the work directory.'''
+    fig, ax_hor, ax_ver = _figure(ns, 'Benchmark: align_ht')
+    return _patched(ns['align_ht'](fig=fig, ax_hor=ax_hor, ax_ver=ax_ver), ns,
+                    HT_COORDS_FILE=str(workdir / 'ht_coords.csv'),
+                    HT_COORDS_FILE_OLD=str(workdir / 'ht_coords_old.csv'),
+                    HT_COORDS=ns['HT_COORDS'])
+
+
+def htfly_align(ns, workdir):
+    '''_htfly_align with qem1, keeping the current ROW3_Y_VERT.'''
+    fig, ax_hor, ax_ver = _figure(ns, 'Benchmark: htfly_align')
+    return _patched(ns['_htfly_align'](fig=fig, ax_hor=ax_hor, ax_ver=ax_ver), ns,
+                    ROW3_Y_VERT=ns['ROW3_Y_VERT'])
+
+
+def invivo_dr_fc(ns, workdir):
+    '''invivo_dr_fc at 1 mL/min with 0.05 mL pre-exposure and exposure volumes.'''
+    return ns['invivo_dr_fc'](1.0, 0.05, 0.05, 0.05)
+
+
+def flow(ns, workdir):
+    '''Capillary flow of 0.1 mL at 6 mL/min.'''
+    return ns['flow'](14.57, 6.0, 0.1)
+
+
+# name: (make_plan(ns, workdir), wall-clock budget [s] at XFP_SIM_SPEED=1)
+BENCHMARKS = {
+    'ht_plate': (ht_plate, 900),
+    'htfly_rows': (htfly_rows, 90),
+    'align_ht': (align_ht, 120),
+    'htfly_align': (htfly_align, 60),
+    'invivo_dr_fc': (invivo_dr_fc, 30),
+    'flow': (flow, 20),
+}
+
+
+# -- running -------------------------------------------------------------------
+
+def _git_commit():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'],
+                             cwd=STARTUP_DIR, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_benchmark(name, ns, workdir):
+    '''
+    Run one benchmark with the RunEngine of the profile.
+
+    Returns
+    -------
+    result: dict
+        wall time, budget and per-phase times [s], number of messages and
+        documents, and the error if the plan failed.
+    '''
+    make_plan, budget = BENCHMARKS[name]
+    RE = ns['RE']
+    timer = PhaseTimer()
+    documents = collections.Counter()
+
+    def count_documents(name, doc):
+        documents[name] += 1
+
+    token = RE.subscribe(count_documents)
+    error = None
+    t0 = ttime.monotonic()
+    try:
+        RE(timer.wrap(make_plan(ns, workdir)))
+    except Exception as err:
+        error = repr(err)
+    finally:
+        wall = ttime.monotonic() - t0
+        RE.unsubscribe(token)
+    return {'wall': wall, 'budget': budget, 'phases': timer.phases,
+            'messages': timer.n_messages, 'documents': dict(documents),
+            'error': error}
+
+
+def load_history(history_file=HISTORY_FILE):
+    '''Read the saved benchmark runs.'''
+    history = []
+    try:
+        with open(history_file) as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return history
+
+
+def previous_results(history, commit, speed):
+    '''
+    Latest result of each benchmark from an earlier commit at the same speed.
+    '''
+    previous = {}
+    for entry in history:
+        if entry.get('commit') == commit or entry.get('speed') != speed:
+            continue
+        for name, result in entry['results'].items():
+            if result['error'] is None:
+                previous[name] = (entry['commit'], result['wall'])
+    return previous
+
+
+def print_benchmarks(entry, previous=None):
+    '''Print the per-phase table of a benchmark run.'''
+    previous = previous or {}
+    print(f"\nPlan benchmarks [s], commit {entry['commit']}, "
+          f"XFP_SIM_SPEED={entry['speed']}")
+    header = ''.join(f"{col:>10}" for col in ('wall', 'budget', *PHASES, 'prev'))
+    print(f"{'Benchmark':<14}{header}")
+    for name, result in entry['results'].items():
+        cols = ''.join(f"{result[col]:>10.1f}" for col in ('wall', 'budget'))
+        cols += ''.join(f"{result['phases'][phase]:>10.1f}" for phase in PHASES)
+        prev = previous.get(name)
+        cols += f"{prev[1]:>10.1f} ({prev[0]})" if prev else f"{'-':>10}"
+        print(f"{name:<14}{cols}")
+    for name, result in entry['results'].items():
+        if result['error'] is not None:
+            print(f"{name} FAILED: {result['error']}")
+        elif result['wall'] > result['budget']:
+            print(f"{name} is over its budget: {result['wall']:.1f} s > {result['budget']} s")
+
+
+def run_benchmarks(names=None, *, ns=None, history_file=HISTORY_FILE):
+    '''
+    Run the plan benchmarks in a simulated session and save the results.
+
+    Parameters
+    ----------
+    names: list of str, optional
+        Benchmarks to run (keys of BENCHMARKS), all of them by default.
+
+    ns: dict, optional
+        The profile namespace, by default the IPython user namespace.
+
+    history_file: Path or string
+        JSONL file to append the results to.
+
+    Returns
+    -------
+    entry: dict
+        The saved record: time, commit, speed and results by benchmark.
+    '''
+    if ns is None:
+        ns = get_ipython().user_ns
+    if not ns.get('XFP_SIM'):
+        raise RuntimeError('The benchmarks move devices and open shutters: '
+                           'run them in the offline simulation (XFP_SIM=1).')
+    names = list(names or BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {sorted(unknown)}, choose from {list(BENCHMARKS)}")
+
+    entry = {'time': ttime.time(), 'commit': _git_commit(),
+             'speed': ns['sim_model'].speed, 'results': {}}
+    with tempfile.TemporaryDirectory(prefix='xfp-bench-') as workdir:
+        for name in names:
+            print(f"Benchmark {name}: {BENCHMARKS[name][0].__doc__}")
+            entry['results'][name] = run_benchmark(name, ns, Path(workdir))
+
+    previous = previous_results(load_history(history_file), entry['commit'], entry['speed'])
+    Path(history_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    print_benchmarks(entry, previous)
+    return entry
+
+
+def main(names=None):
+    '''Run the benchmarks; raise if any of them failed or is over its budget.'''
+    entry = run_benchmarks(names)
+    bad = [name for name, result in entry['results'].items()
+           if result['error'] is not None or result['wall'] > result['budget']]
+    if bad:
+        raise RuntimeError(f"Benchmarks failed or over budget: {', '.join(bad)}")
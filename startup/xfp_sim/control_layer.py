@@ -0,0 +1,191 @@
+'''
+ophyd control layer backed by the simulation model.
+
+It implements the small PV interface ophyd's EpicsSignal uses (the same one
+the pyepics and caproto shims provide), so every EpicsSignal, EpicsMotor and
+custom device of the profile runs its real code against simulated PVs.
+Callbacks are delivered through ophyd's EventDispatcher threads, as with the
+real control layers.
+'''
+
+import logging
+import threading
+import types
+
+import ophyd
+from ophyd._dispatch import EventDispatcher, wrap_callback
+
+logger = logging.getLogger(__name__)
+
+# Simulated channel connection time [s]
+CONNECT_LATENCY = 0.001
+
+
+class SimPV:
+    '''A PV of the simulation model, with the pyepics-like API ophyd expects.'''
+    def __init__(self, model, dispatcher, pvname, *, callback=None, form='time',
+                 auto_monitor=None, connection_callback=None, access_callback=None,
+                 **kwargs):
+        self.model = model
+        self.pvname = pvname
+        self.form = form
+        self.auto_monitor = auto_monitor
+        self._dispatcher = dispatcher
+        self._reference_count = 0
+        self._connected = threading.Event()
+        self._callbacks = {}
+        self._connection_callbacks = [wrap_callback(dispatcher, 'metadata', connection_callback)]
+        self._access_callbacks = [wrap_callback(dispatcher, 'metadata', access_callback)]
+        if callback is not None:
+            self.add_callback(callback)
+        model.after(CONNECT_LATENCY, self._connect)
+
+    def _connect(self):
+        self.model.record(self.pvname)
+        self._connected.set()
+        for cb in self._connection_callbacks:
+            if cb is not None:
+                cb(pvname=self.pvname, conn=True, pv=self)
+        for cb in self._access_callbacks:
+            if cb is not None:
+                cb(True, True, pv=self)
+        # like a CA monitor, send the initial value on connection
+        for cb in list(self._callbacks.values()):
+            cb(**self._monitor_kwargs())
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def wait_for_connection(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def _info(self, as_string=False):
+        info = self.model.read(self.pvname)
+        info['pvname'] = self.pvname
+        value = info['value']
+        enum_strs = info['enum_strs']
+        if enum_strs and isinstance(value, int) and 0 <= value < len(enum_strs):
+            info['char_value'] = enum_strs[value]
+        else:
+            info['char_value'] = str(value)
+        if as_string:
+            info['value'] = info['char_value']
+        return info
+
+    def get_with_metadata(self, *, as_string=False, form=None, timeout=None,
+                          use_monitor=True, count=None, **kwargs):
+        return self._info(as_string=as_string)
+
+    def get(self, *, as_string=False, **kwargs):
+        return self._info(as_string=as_string)['value']
+
+    def get_all_metadata_blocking(self, timeout):
+        info = self._info()
+        info.pop('value')
+        return info
+
+    def get_all_metadata_callback(self, callback, *, timeout):
+        def get_metadata_thread(pvname):
+            callback(pvname, self.get_all_metadata_blocking(timeout=timeout))
+
+        self._dispatcher.schedule_utility_task(get_metadata_thread, pvname=self.pvname)
+
+    def put(self, value, wait=False, timeout=None, use_complete=False,
+            callback=None, callback_data=None):
+        callback = wrap_callback(self._dispatcher, 'get_put', callback)
+        done = threading.Event()
+
+        def put_done():
+            done.set()
+            if callback is not None:
+                callback(pvname=self.pvname, data=callback_data)
+
+        self.model.write(self.pvname, value, put_done)
+        if wait:
+            done.wait(timeout)
+
+    def add_callback(self, callback=None, index=None, run_now=False, **kwargs):
+        callback = wrap_callback(self._dispatcher, 'monitor', callback)
+
+        def monitor(name, info):
+            callback(**self._monitor_kwargs())
+
+        token = self.model.subscribe(self.pvname, monitor)
+        self._callbacks[token] = callback
+        if run_now and self.connected:
+            callback(**self._monitor_kwargs())
+        return token
+
+    def _monitor_kwargs(self):
+        info = self._info()
+        info['cb_info'] = (None, self)
+        return info
+
+    def remove_callback(self, index):
+        self.model.unsubscribe(self.pvname, index)
+        self._callbacks.pop(index, None)
+
+    def clear_callbacks(self):
+        for token in list(self._callbacks):
+            self.remove_callback(token)
+        self._connection_callbacks.clear()
+        self._access_callbacks.clear()
+
+    def clear_auto_monitor(self):
+        self.auto_monitor = False
+
+    def get_ctrlvars(self, **kwargs):
+        return self.get_all_metadata_blocking(timeout=None)
+
+    def __repr__(self):
+        return f"<SimPV {self.pvname!r}>"
+
+
+def control_layer(model):
+    '''
+    Build an ophyd control layer namespace (like ophyd.cl) on `model`.
+    '''
+    dispatcher = EventDispatcher(context=None, logger=logger)
+
+    def get_pv(pvname, form='time', connect=False, context=None, timeout=5.0, **kwargs):
+        pv = SimPV(model, dispatcher, pvname, form=form, **kwargs)
+        if connect:
+            pv.wait_for_connection(timeout=timeout)
+        return pv
+
+    def caget(pvname, as_string=False, **kwargs):
+        info = model.read(pvname)
+        return str(info['value']) if as_string else info['value']
+
+    def caput(pvname, value, wait=False, timeout=60, **kwargs):
+        done = threading.Event()
+        model.write(pvname, value, done.set)
+        if wait:
+            done.wait(timeout)
+
+    def release_pvs(*pvs):
+        for pv in pvs:
+            pv._reference_count -= 1
+            if pv._reference_count <= 0:
+                pv.clear_callbacks()
+
+    return types.SimpleNamespace(
+        setup=lambda logger: dispatcher,
+        caput=caput,
+        caget=caget,
+        get_pv=get_pv,
+        thread_class=threading.Thread,
+        name='xfp_sim',
+        release_pvs=release_pvs,
+        get_dispatcher=lambda: dispatcher,
+    )
+
+
+def install(model):
+    '''
+    Make ophyd use the simulation for every EPICS signal created from now on.
+    Must be called before any device is instantiated.
+    '''
+    ophyd.cl = control_layer(model)
+    return ophyd.cl
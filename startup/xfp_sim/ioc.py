@@ -0,0 +1,167 @@
+'''
+caproto IOC serving the XFP simulation model over Channel Access.
+
+It answers for every PV under the XFP prefixes (XF:17BM*, the ring current)
+and creates the channels on first search, backed by the same model as the
+in-process simulation (see model.py): motor records move, the DG535 delay
+readback and .STAT PVs follow the setpoint, the syringe pump goes through its
+State_RBV enum, etc. Puts complete when the model says so (e.g. at the end of
+a motor move), so callback puts behave as on the beamline.
+
+Run it from the startup directory and point the profile at it with plain
+Channel Access (no XFP_SIM):
+
+    python -m xfp_sim.ioc --speed 1
+    EPICS_CA_ADDR_LIST=127.0.0.1 EPICS_CA_AUTO_ADDR_LIST=NO ipython --profile=collection
+
+This exercises the real CA code paths (pyepics monitors, put completion,
+AgressiveSignal, DelayGenerator.set, ...) without the beamline.
+'''
+
+import asyncio
+
+from caproto import ChannelDouble, ChannelEnum, ChannelInteger, ChannelString
+from caproto.asyncio.server import run
+from caproto.server import template_arg_parser
+
+from .model import xfp_model
+
+# PV name prefixes served by the IOC
+XFP_PREFIXES = ('XF:17BM', 'SR:OPS-BI{DCCT:1}')
+
+# Update period of computed PVs (detectors, ring current) [s]
+SCAN_PERIOD = 0.1
+
+
+class _ModelChannel:
+    '''
+    Mixin connecting a caproto channel to a record of the model: client puts
+    go through model.write and model updates are published to subscribers.
+    '''
+    def __init__(self, pvdb, pvname, **kwargs):
+        super().__init__(**kwargs)
+        self.pvdb = pvdb
+        self.pvname = pvname
+        self.record = pvdb.model.record(pvname)
+        pvdb.model.subscribe(pvname, self._model_changed)
+
+    def from_model(self, value):
+        return value
+
+    def _model_changed(self, name, info):
+        # called from the model's threads (or from a put, in the loop)
+        loop = self.pvdb.loop
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(
+            self.write(self.from_model(info['value']), verify_value=False,
+                       timestamp=info['timestamp']),
+            loop)
+
+    async def verify_value(self, value):
+        value = await super().verify_value(value)
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def put_done():
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+        self.pvdb.model.write(self.pvname, value, put_done)
+        await done
+        return self.from_model(self.pvdb.model.get(self.pvname))
+
+    async def refresh(self):
+        '''Publish a new value of a computed PV.'''
+        await self.write(self.from_model(self.record.compute()), verify_value=False)
+
+
+class SimChannelDouble(_ModelChannel, ChannelDouble):
+    pass
+
+
+class SimChannelInteger(_ModelChannel, ChannelInteger):
+    pass
+
+
+class SimChannelString(_ModelChannel, ChannelString):
+    pass
+
+
+class SimChannelEnum(_ModelChannel, ChannelEnum):
+    def from_model(self, value):
+        enum_strs = self.record.enum_strs
+        if isinstance(value, str):
+            return value
+        return enum_strs[min(max(int(value), 0), len(enum_strs) - 1)]
+
+
+def _channel(pvdb, pvname):
+    rec = pvdb.model.record(pvname)
+    value = pvdb.model.get(pvname)
+    kwargs = dict(timestamp=rec.timestamp)
+    if rec.enum_strs:
+        return SimChannelEnum(pvdb, pvname, enum_strings=rec.enum_strs,
+                              value=rec.enum_strs[int(value)], **kwargs)
+    if isinstance(value, str):
+        return SimChannelString(pvdb, pvname, value=value, **kwargs)
+    kwargs.update(units=rec.units,
+                  lower_ctrl_limit=rec.limits[0], upper_ctrl_limit=rec.limits[1],
+                  lower_disp_limit=rec.limits[0], upper_disp_limit=rec.limits[1])
+    if isinstance(value, int):
+        return SimChannelInteger(pvdb, pvname, value=int(value), **kwargs)
+    return SimChannelDouble(pvdb, pvname, value=float(value),
+                            precision=rec.precision, **kwargs)
+
+
+class SimPVDatabase(dict):
+    '''
+    caproto pvdb creating a channel on demand for any PV name under `prefixes`.
+
+    Parameters
+    ----------
+    model: SimModel
+    prefixes: tuple of str
+    '''
+    def __init__(self, model, prefixes=XFP_PREFIXES):
+        super().__init__()
+        self.model = model
+        self.prefixes = tuple(prefixes)
+        self.loop = None
+
+    def __missing__(self, pvname):
+        if not pvname.startswith(self.prefixes):
+            raise KeyError(pvname)
+        channel = self[pvname] = _channel(self, pvname)
+        return channel
+
+    async def scan(self, period=SCAN_PERIOD):
+        '''Periodically publish the computed PVs, like a scanned ai record.'''
+        while True:
+            await asyncio.sleep(period)
+            for channel in set(self.values()):
+                if channel.record.compute is not None:
+                    await channel.refresh()
+
+
+def main(argv=None):
+    parser, split_args = template_arg_parser(
+        desc='Simulated XFP beamline IOC', default_prefix='',
+        argv=argv, supported_async_libs=('asyncio',))
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='simulated time runs this many times faster '
+                             'than wall-clock time')
+    args = parser.parse_args(argv)
+    _, run_options = split_args(args)
+    run_options.pop('module_name')
+
+    pvdb = SimPVDatabase(xfp_model(speed=args.speed))
+
+    async def startup_hook(async_lib):
+        pvdb.loop = asyncio.get_running_loop()
+        pvdb.loop.create_task(pvdb.scan())
+
+    run(pvdb, startup_hook=startup_hook, **run_options)
+
+
+if __name__ == '__main__':
+    main()
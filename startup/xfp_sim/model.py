@@ -0,0 +1,649 @@
+'''
+PV-level model of the XFP beamline used by the offline simulation.
+
+The model is a store of simulated PV records. Every PV name can be read and
+written: unknown PVs are created on first use with a default value of 0, and
+the PVs of known hardware (motor records, the DG535, the syringe and sample
+pumps, the shutters, the alignment detectors) are set up with their enum
+strings and with behaviors that mimic the hardware timing:
+
+    motors          trapezoidal moves using the .VELO/.ACCL fields
+    DG535           delay readback follows the setpoint after a latency
+    syringe pumps   State_RBV goes Idle -> Infusing -> Idle while
+                    Delivered_RBV ramps up at the infusion rate
+    sample pump     Sts:Flag-Sts goes Moving/Stopped on the slew/stop commands
+    shutters        Pos-Sts follows the open/close commands after a latency
+    detectors       gaussian beam spots at the HT / HTFly alignment holes
+
+The same model backs both the in-process control layer (control_layer.py)
+and the caproto IOC (ioc.py).
+'''
+
+import heapq
+import itertools
+import math
+import random
+import re
+import threading
+import time as ttime
+
+# Fields of the motor record used by ophyd's EpicsMotor
+MOTOR_FIELDS = ('VAL', 'RBV', 'DMOV', 'MOVN', 'STOP', 'VELO', 'ACCL', 'EGU',
+                'HLM', 'LLM', 'HLS', 'LLS', 'OFF', 'DIR', 'FOFF', 'SET',
+                'TDIR', 'HOMF', 'HOMR', 'CNEN', 'MSTA', 'SPMG')
+
+# Default motion parameters: velocity [EGU/s] and acceleration time [s]
+MOTOR_VELOCITY = 2.0
+MOTOR_ACCELERATION = 0.2
+MOTOR_TICK = 0.05
+
+# Default velocities of the faster stages [EGU/s]
+MOTOR_VELOCITIES = {
+    'XF:17BMA-ES:2{HTFly:1-Ax:X}Mtr': 100.0,   # HTFly fly stage
+    'XF:17BMA-ES:1{Fltr:1-Ax:Rot}Mtr': 30.0,   # filter wheel [deg/s]
+}
+
+# Initial motor positions (everything else starts at 0)
+MOTOR_POSITIONS = {
+    'XF:17BMA-ES:2{Stg:7-Ax:X}Mtr': -90.0,     # ht at the load position
+    'XF:17BMA-ES:2{Stg:7-Ax:Y}Mtr': -50.0,
+    'XF:17BMA-OP{Slt:ADC-Ax:XGap}Mtr': 6.0,
+}
+
+# Open/close latencies [s] of the two-button shutters, by PV prefix
+SHUTTER_LATENCY = {
+    'XF:17BMA-EPS{Sh:1}': 1.0,     # pre-shutter
+    'XF:17BM-PPS{Sh:FE}': 3.0,     # photon shutter
+}
+DIODE_SHUTTER_LATENCY = 0.01
+DG_READBACK_LATENCY = 0.3
+PUMP_START_LATENCY = 0.3
+PUMP_TICK = 0.1
+
+# Alignment beam spots: detector PV -> motor PVs, spot center, sigma and peak
+# (see HT_X_START/HT_Y_START in 97-align-ht.py and the HTFLY_* values in
+# 89-align-htfly.py)
+BEAM_SPOTS = {
+    'XF:17BMA-ES:2{TCM:1}rCurr_Measure': dict(
+        motors=('XF:17BMA-ES:2{Stg:7-Ax:X}Mtr', 'XF:17BMA-ES:2{Stg:7-Ax:Y}Mtr'),
+        center=(0.65, -76.55), sigma=(0.8, 0.8), peak=5.0, background=0.05),
+    'XF:17BM-BI{EM:1}EM180:Current3:MeanValue_RBV': dict(
+        motors=('XF:17BMA-ES:2{HTFly:1-Ax:X}Mtr', 'XF:17BMA-ES:2{HTFly:1-Ax:Y}Mtr'),
+        center=(1.8, -3.0), sigma=(0.6, 0.6), peak=2e-6, background=1e-9),
+}
+PPS_STATUS = 'XF:17BM-PPS{Sh:FE}Pos-Sts'
+DIODE_OPEN_STATUS = 'XF:17BMA-CT{DIODE-Local:2}InPt00:Data-Sts'
+
+
+class SimRecord:
+    '''A simulated PV: its value, metadata and subscribers.'''
+    def __init__(self, name, value=0.0, *, enum_strs=None, units='', precision=3,
+                 limits=(0, 0), on_write=None, compute=None):
+        self.name = name
+        self.enum_strs = tuple(enum_strs) if enum_strs else None
+        if self.enum_strs and isinstance(value, float):
+            value = int(value)
+        self.value = value
+        self.timestamp = ttime.time()
+        self.units = units
+        self.precision = precision
+        self.limits = limits
+        # on_write(value, done): handle a put; call done() when it completes
+        self.on_write = on_write
+        # compute(): value computed at read time (detectors)
+        self.compute = compute
+        self.listeners = {}
+
+    def metadata(self):
+        return dict(status=0, severity=0, timestamp=self.timestamp,
+                    precision=self.precision, units=self.units,
+                    enum_strs=self.enum_strs,
+                    lower_ctrl_limit=self.limits[0], upper_ctrl_limit=self.limits[1],
+                    lower_disp_limit=self.limits[0], upper_disp_limit=self.limits[1])
+
+
+class SimModel:
+    '''
+    Store of simulated PV records plus a scheduler for timed behaviors.
+
+    Parameters
+    ----------
+    speed: float
+        Simulated time runs this many times faster than wall-clock time.
+    '''
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._records = {}
+        self._devices = set()
+        self._lock = threading.RLock()
+        self._tokens = itertools.count()
+        self._queue = []
+        self._queue_cv = threading.Condition()
+        self._rules = []
+        self._thread = threading.Thread(target=self._run_scheduler,
+                                        name='xfp-sim-scheduler', daemon=True)
+        self._thread.start()
+
+    # -- records --------------------------------------------------------------
+
+    def add_rule(self, pattern, setup):
+        '''
+        Call setup(model, match) the first time a PV matching the regular
+        expression `pattern` is used. It typically defines the records of a
+        whole device.
+        '''
+        self._rules.append((re.compile(pattern), setup))
+
+    def define(self, name, value=0.0, **kwargs):
+        '''Create (or replace) a record. See SimRecord for the arguments.'''
+        with self._lock:
+            rec = SimRecord(name, value, **kwargs)
+            old = self._records.get(name)
+            if old is not None:
+                rec.listeners = old.listeners
+            self._records[name] = rec
+            return rec
+
+    def record(self, name):
+        '''The record of a PV, created on first use.'''
+        with self._lock:
+            rec = self._records.get(name)
+            if rec is not None:
+                return rec
+            for pattern, setup in self._rules:
+                match = pattern.match(name)
+                if match is None:
+                    continue
+                device = (pattern.pattern, match.groupdict().get('base') or match.group(0))
+                if device not in self._devices:
+                    self._devices.add(device)
+                    setup(self, match)
+                    if name in self._records:
+                        return self._records[name]
+            return self.define(name, _default_value(name), **_default_metadata(name))
+
+    def names(self):
+        with self._lock:
+            return list(self._records)
+
+    # -- access ---------------------------------------------------------------
+
+    def get(self, name):
+        '''Current value of a PV.'''
+        rec = self.record(name)
+        return rec.compute() if rec.compute is not None else rec.value
+
+    def read(self, name):
+        '''Value and metadata of a PV, as a dict.'''
+        rec = self.record(name)
+        info = rec.metadata()
+        info['value'] = rec.compute() if rec.compute is not None else rec.value
+        if rec.compute is not None:
+            info['timestamp'] = ttime.time()
+        return info
+
+    def write(self, name, value, callback=None):
+        '''
+        Put a value, as a CA client would. `callback` is called once the put
+        has completed (e.g. at the end of a motor move).
+        '''
+        rec = self.record(name)
+        value = _coerce(rec, value)
+
+        def done():
+            if callback is not None:
+                callback()
+
+        if rec.on_write is not None:
+            rec.on_write(value, done)
+        else:
+            self.set(name, value)
+            done()
+
+    def set(self, name, value):
+        '''Update a PV value from the "IOC" side and notify subscribers.'''
+        rec = self.record(name)
+        with self._lock:
+            rec.value = _coerce(rec, value)
+            rec.timestamp = ttime.time()
+            listeners = list(rec.listeners.values())
+        if listeners:
+            info = self.read(name)
+            for cb in listeners:
+                cb(name, info)
+
+    def subscribe(self, name, callback):
+        '''Call callback(name, info) on every value change. Returns a token.'''
+        rec = self.record(name)
+        token = next(self._tokens)
+        with self._lock:
+            rec.listeners[token] = callback
+        return token
+
+    def unsubscribe(self, name, token):
+        with self._lock:
+            self.record(name).listeners.pop(token, None)
+
+    # -- timing ---------------------------------------------------------------
+
+    def after(self, delay, func, *args):
+        '''Run func(*args) after `delay` seconds of simulated time.'''
+        when = ttime.monotonic() + delay / self.speed
+        with self._queue_cv:
+            heapq.heappush(self._queue, (when, next(self._tokens), func, args))
+            self._queue_cv.notify()
+
+    def _run_scheduler(self):
+        while True:
+            with self._queue_cv:
+                while not self._queue or self._queue[0][0] > ttime.monotonic():
+                    timeout = self._queue[0][0] - ttime.monotonic() if self._queue else None
+                    self._queue_cv.wait(timeout)
+                _, _, func, args = heapq.heappop(self._queue)
+            try:
+                func(*args)
+            except Exception as err:
+                print(f"xfp_sim: error in {func}: {err!r}")
+
+
+def _coerce(rec, value):
+    if rec.enum_strs and isinstance(value, str):
+        if value in rec.enum_strs:
+            return rec.enum_strs.index(value)
+        try:
+            return int(value)
+        except ValueError:
+            return rec.value
+    return value
+
+
+def _default_value(name):
+    if name.endswith(':PluginType_RBV'):
+        plugin = name.rsplit(':', 2)[-2]
+        for prefix, plugin_type in AD_PLUGIN_TYPES.items():
+            if plugin.startswith(prefix):
+                return plugin_type
+        return 'NDPlugin'
+    # asyn ports: each plugin is fed by the driver of its prefix (e.g. EM180)
+    if name.endswith(':PortName_RBV'):
+        return name.rsplit(':', 2)[-2].upper()
+    if name.endswith((':NDArrayPort', ':NDArrayPort_RBV')):
+        return name.rsplit(':', 3)[-3].rsplit('}', 1)[-1]
+    return 0.0
+
+
+def _default_metadata(name):
+    # areaDetector-style enum fields written by ophyd stage_sigs
+    for suffix, enum_strs in AD_ENUMS.items():
+        if name.endswith(suffix) or name.endswith(suffix + '_RBV'):
+            return dict(enum_strs=enum_strs)
+    return {}
+
+
+# areaDetector plugin types by plugin name, checked by ophyd when staging
+AD_PLUGIN_TYPES = {
+    'image': 'NDPluginStdArrays',
+    'Current': 'NDPluginStats',
+    'Sum': 'NDPluginStats',
+    'Stats': 'NDPluginStats',
+    'ROI': 'NDPluginROI',
+    'Proc': 'NDPluginProcess',
+    'Trans': 'NDPluginTransform',
+    'Over': 'NDPluginOverlay',
+    'CC': 'NDPluginColorConvert',
+    'TIFF': 'NDFileTIFF',
+    'HDF': 'NDFileHDF5',
+    'JPEG': 'NDFileJPEG',
+}
+
+AD_ENUMS = {
+    'EnableCallbacks': ('Disable', 'Enable'),
+    'BlockingCallbacks': ('No', 'Yes'),
+    'AcquireMode': ('Continuous', 'Multiple', 'Single'),
+    'TSAcquireMode': ('Fixed length', 'Circ. buffer'),
+    'TSRead.SCAN': ('Passive', 'Event', 'I/O Intr', '10 second', '5 second',
+                    '2 second', '1 second', '.5 second', '.2 second', '.1 second'),
+    'Range': ('350 pC', '700 pC', '1400 pC', '2800 pC', '5600 pC', '11200 pC',
+              '22400 pC', '44800 pC'),
+}
+
+
+# -- hardware behaviors --------------------------------------------------------
+
+class SimMotor:
+    '''Motor record moving with a trapezoidal velocity profile.'''
+    def __init__(self, model, base):
+        self.model = model
+        self.base = base
+        self._move_id = 0
+        position = MOTOR_POSITIONS.get(base, 0.0)
+        egu = 'deg' if 'Rot' in base else 'mm'
+        for field in MOTOR_FIELDS:
+            model.define(f'{base}.{field}', 0.0, units=egu, precision=4)
+        model.define(f'{base}.VAL', position, units=egu, precision=4, on_write=self.move)
+        model.define(f'{base}.RBV', position, units=egu, precision=4)
+        model.define(f'{base}.DMOV', 1)
+        model.define(f'{base}.VELO', MOTOR_VELOCITIES.get(base, MOTOR_VELOCITY), units=f'{egu}/s')
+        model.define(f'{base}.ACCL', MOTOR_ACCELERATION, units='s')
+        model.define(f'{base}.EGU', egu)
+        model.define(f'{base}.DIR', 0, enum_strs=('Pos', 'Neg'))
+        model.define(f'{base}.FOFF', 0, enum_strs=('Variable', 'Frozen'))
+        model.define(f'{base}.SET', 0, enum_strs=('Use', 'Set'))
+        model.define(f'{base}.STOP', 0, on_write=self.stop)
+
+    def _field(self, field):
+        return f'{self.base}.{field}'
+
+    def move(self, target, done):
+        m = self.model
+        start = m.get(self._field('RBV'))
+        velocity = abs(m.get(self._field('VELO'))) or MOTOR_VELOCITY
+        accel_time = max(m.get(self._field('ACCL')), 1e-3)
+        distance = abs(target - start)
+        # trapezoid, or triangle for short moves
+        if distance >= velocity * accel_time:
+            duration = distance / velocity + accel_time
+        else:
+            duration = 2 * math.sqrt(distance * accel_time / velocity)
+        self._move_id += 1
+        move_id = self._move_id
+        t0 = ttime.monotonic()
+
+        m.set(self._field('VAL'), target)
+        m.set(self._field('TDIR'), int(target >= start))
+        m.set(self._field('DMOV'), 0)
+        m.set(self._field('MOVN'), 1)
+
+        def position(t):
+            # distance covered after t seconds
+            if distance >= velocity * accel_time:
+                a = velocity / accel_time
+                t_acc = accel_time
+                if t < t_acc:
+                    return 0.5 * a * t**2
+                elif t < duration - t_acc:
+                    return 0.5 * a * t_acc**2 + velocity * (t - t_acc)
+                return distance - 0.5 * a * (duration - t)**2
+            a = velocity / accel_time
+            half = duration / 2
+            if t < half:
+                return 0.5 * a * t**2
+            return distance - 0.5 * a * (duration - t)**2
+
+        def tick():
+            if move_id != self._move_id:
+                return
+            t = (ttime.monotonic() - t0) * m.speed
+            if t >= duration:
+                m.set(self._field('RBV'), target)
+                m.set(self._field('MOVN'), 0)
+                m.set(self._field('DMOV'), 1)
+                done()
+                return
+            sign = 1 if target >= start else -1
+            m.set(self._field('RBV'), start + sign * position(t))
+            m.after(min(MOTOR_TICK, duration - t), tick)
+
+        m.after(min(MOTOR_TICK, duration) if duration > 0 else MOTOR_TICK, tick)
+
+    def stop(self, value, done):
+        m = self.model
+        if value and m.get(self._field('DMOV')) == 0:
+            self._move_id += 1
+            m.set(self._field('VAL'), m.get(self._field('RBV')))
+            m.set(self._field('MOVN'), 0)
+            m.set(self._field('DMOV'), 1)
+        done()
+
+
+def _setup_motor(model, match):
+    SimMotor(model, match.group('base'))
+
+
+def _setup_delay_generator(model, match):
+    base = match.group('base')
+
+    def set_delay(value, done):
+        model.set(f'{base}bDelaySetAO', value)
+        model.after(DG_READBACK_LATENCY, model.set, f'{base}bDelayAI', value)
+        done()
+
+    def fire(value, done):
+        model.set(f'{base}genSingleShotTrigBO', value)
+        model.after(0.01, model.set, f'{base}genSingleShotTrigBO', 0)
+        done()
+
+    model.define(f'{base}bDelaySetAO', 0.0, units='s', precision=6, on_write=set_delay)
+    model.define(f'{base}bDelayAI', 0.0, units='s', precision=6)
+    model.define(f'{base}bDelayAI.STAT', 0)
+    model.define(f'{base}bDelaySetAO.STAT', 0)
+    model.define(f'{base}trigModeSetMO', 0,
+                 enum_strs=('Internal', 'External', 'Single', 'Burst'))
+    model.define(f'{base}genSingleShotTrigBO', 0, on_write=fire)
+
+
+class SimSyringePump:
+    '''Syringe pump: infuses InfusionVolume at InfusionRate [mL/min] on Run.'''
+    settings = ('Diameter', 'InfusionRate', 'InfusionVolume')
+
+    def __init__(self, model, base):
+        self.model = model
+        self.base = base
+        self._run_id = 0
+        model.define(f'{base}Mode', 0, enum_strs=('Fixed volume', 'Continuous'))
+        model.define(f'{base}Direction', 0, enum_strs=('Infuse', 'Withdraw'))
+        for name, value, units in (('Diameter', 14.57, 'mm'),
+                                   ('InfusionRate', 1.0, 'mL/min'),
+                                   ('InfusionVolume', 0.1, 'mL')):
+            model.define(f'{base}{name}_RBV', value, units=units)
+            model.define(f'{base}{name}', value, units=units,
+                         on_write=self._setting_writer(name))
+        model.define(f'{base}Run', 0, enum_strs=('Stop', 'Run'), on_write=self.run)
+        model.define(f'{base}State_RBV', 0,
+                     enum_strs=('Idle', 'Infusing', 'Withdrawing', 'Interrupted'))
+        model.define(f'{base}Delivered_RBV', 0.0, units='mL', precision=4)
+
+    def _setting_writer(self, name):
+        def write(value, done):
+            self.model.set(f'{self.base}{name}', value)
+            self.model.after(0.05, self.model.set, f'{self.base}{name}_RBV', value)
+            done()
+        return write
+
+    def run(self, value, done):
+        m, base = self.model, self.base
+        m.set(f'{base}Run', value)
+        self._run_id += 1
+        run_id = self._run_id
+        if not value:
+            m.set(f'{base}State_RBV', 0)
+            done()
+            return
+
+        rate = m.get(f'{base}InfusionRate_RBV') / 60
+        volume = m.get(f'{base}InfusionVolume_RBV')
+        state = 2 if m.get(f'{base}Direction') else 1
+
+        def start():
+            if run_id != self._run_id:
+                return
+            m.set(f'{base}Delivered_RBV', 0.0)
+            m.set(f'{base}State_RBV', state)
+            m.after(PUMP_TICK, tick, ttime.monotonic())
+
+        def tick(t0):
+            if run_id != self._run_id:
+                return
+            delivered = min(rate * (ttime.monotonic() - t0) * m.speed, volume)
+            m.set(f'{base}Delivered_RBV', delivered)
+            if delivered >= volume:
+                m.set(f'{base}State_RBV', 0)
+                m.set(f'{base}Run', 0)
+            else:
+                m.after(PUMP_TICK, tick, t0)
+
+        m.after(PUMP_START_LATENCY, start)
+        done()
+
+
+def _setup_syringe_pump(model, match):
+    SimSyringePump(model, match.group('base'))
+
+
+def _setup_sample_pump(model, match):
+    base = match.group('base')
+    status = f'{base}Sts:Flag-Sts'
+
+    def command(state):
+        def write(value, done):
+            model.after(PUMP_START_LATENCY, model.set, status, state)
+            done()
+        return write
+
+    def move_relative(value, done):
+        velocity = model.get(f'{base}Val:Vel-SP') or 1.0
+        duration = abs(model.get(f'{base}Val:Vol-SP')) / velocity
+        model.after(PUMP_START_LATENCY, model.set, status, 1)
+        model.after(PUMP_START_LATENCY + duration, model.set, status, 0)
+        done()
+
+    model.define(f'{base}Val:Vel-SP', 1.0, units='uL/s')
+    model.define(f'{base}Val:Vol-SP', 0.0, units='uL')
+    model.define(status, 0, enum_strs=('Stopped', 'Moving'))
+    model.define(f'{base}Cmd:Slew-Cmd', 0, on_write=command(1))
+    model.define(f'{base}Cmd:Stop-Cmd', 0, on_write=command(0))
+    model.define(f'{base}Cmd:MOVR-Cmd', 0, on_write=move_relative)
+
+
+def _setup_two_button_shutter(model, match):
+    base = match.group('base')
+    latency = SHUTTER_LATENCY.get(base, 1.0)
+    status = f'{base}Pos-Sts'
+
+    # target state of the actuation in progress, if any
+    moving = {'target': None, 'id': 0}
+
+    def command(cmd_pv, state):
+        def write(value, done):
+            model.set(cmd_pv, 1)
+            done()
+            if moving['target'] == state:
+                # already on its way, the command is absorbed
+                return
+            if moving['target'] is None and model.get(status) == state:
+                model.after(0.1, model.set, cmd_pv, 0)
+                return
+            moving['target'] = state
+            moving['id'] += 1
+            move_id = moving['id']
+
+            def actuate():
+                if move_id != moving['id']:
+                    return
+                moving['target'] = None
+                model.set(status, state)
+                # the command PV resets shortly after the position status
+                model.after(0.05, model.set, cmd_pv, 0)
+
+            model.after(latency, actuate)
+        return write
+
+    cmd_enums = ('None', 'Done')
+    model.define(status, 0, enum_strs=('Not Open', 'Open'))
+    model.define(f'{base}Cmd:Opn-Cmd', 0, enum_strs=cmd_enums,
+                 on_write=command(f'{base}Cmd:Opn-Cmd', 1))
+    model.define(f'{base}Cmd:Cls-Cmd', 0, enum_strs=cmd_enums,
+                 on_write=command(f'{base}Cmd:Cls-Cmd', 0))
+    model.define(f'{base}Sts:FailCls-Sts', 0, enum_strs=('False', 'True'))
+    model.define(f'{base}Sts:FailOpn-Sts', 0, enum_strs=('False', 'True'))
+    model.define(f'{base}Enbl-Sts', 1, enum_strs=('False', 'True'))
+
+
+def _setup_diode_shutter(model, match):
+    base = match.group('base')
+
+    def write(value, done):
+        model.set(f'{base}1}}OutPt00:Data-Sel', value)
+        model.after(DIODE_SHUTTER_LATENCY, model.set, f'{base}2}}InPt00:Data-Sts', int(bool(value)))
+        model.after(DIODE_SHUTTER_LATENCY, model.set, f'{base}2}}InPt01:Data-Sts', int(not value))
+        done()
+
+    model.define(f'{base}1}}OutPt00:Data-Sel', 0, on_write=write)
+    model.define(f'{base}2}}InPt00:Data-Sts', 0)
+    model.define(f'{base}2}}InPt01:Data-Sts', 1)
+
+
+def _setup_quadem_acquire(model, match):
+    # Acquire goes back to 0 (Done) after the averaging time
+    pv = match.group(0)
+    base = match.group('base')
+
+    def write(value, done):
+        model.set(pv, value)
+        if value:
+            averaging_time = model.get(f'{base}AveragingTime_RBV') or 0.1
+            model.after(averaging_time, model.set, pv, 0)
+            model.after(averaging_time, done)
+        else:
+            done()
+
+    model.define(pv, 0, enum_strs=('Done', 'Acquire'), on_write=write)
+
+
+def _beam_spot(model, spot):
+    def compute():
+        beam_on = model.get(PPS_STATUS) == 1 and model.get(DIODE_OPEN_STATUS) == 1
+        value = spot['background']
+        if beam_on:
+            x, y = (model.get(f'{m}.RBV') for m in spot['motors'])
+            (x0, y0), (sx, sy) = spot['center'], spot['sigma']
+            value += spot['peak'] * math.exp(-(x - x0)**2 / (2 * sx**2)
+                                             - (y - y0)**2 / (2 * sy**2))
+        return value * random.gauss(1, 0.01)
+    return compute
+
+
+def _setup_beam_spot(model, match):
+    pv = match.group(0)
+    model.define(pv, 0.0, precision=6, compute=_beam_spot(model, BEAM_SPOTS[pv]))
+
+
+# Readback suffix: setpoint suffix
+READBACK_SUFFIXES = {'_RBV': '', '-RB': '-SP'}
+
+
+def _setup_setting_readback(model, match):
+    # Writes to the setpoint show up in the readback (areaDetector X/X_RBV and
+    # EPICS X-SP/X-RB conventions)
+    readback = match.group(0)
+    setpoint = match.group('base') + READBACK_SUFFIXES[match.group('suffix')]
+    metadata = _default_metadata(setpoint)
+
+    def write(value, done):
+        model.set(setpoint, value)
+        model.set(readback, value)
+        done()
+
+    model.define(readback, _default_value(readback), **metadata)
+    model.define(setpoint, _default_value(setpoint), on_write=write, **metadata)
+
+
+def _setup_ring_current(model, match):
+    model.define(match.group(0), 400.0, units='mA', precision=2,
+                 compute=lambda: random.gauss(400.0, 0.2))
+
+
+def xfp_model(speed=1.0):
+    '''A SimModel with all the XFP hardware behaviors registered.'''
+    model = SimModel(speed=speed)
+    model.add_rule(r'^(?P<base>.+)\.(%s)$' % '|'.join(MOTOR_FIELDS), _setup_motor)
+    model.add_rule(r'^(?P<base>.*\{DG:\d\})', _setup_delay_generator)
+    model.add_rule(r'^(?P<base>XF:17BM-ES:1\{Pmp:01\})', _setup_syringe_pump)
+    model.add_rule(r'^(?P<base>XF:17BMA-ES:1\{Pmp:02\})', _setup_sample_pump)
+    model.add_rule(r'^(?P<base>.*\{Sh:[^}]*\})(Cmd:|Pos-Sts|Sts:|Enbl-Sts)', _setup_two_button_shutter)
+    model.add_rule(r'^(?P<base>XF:17BMA-CT\{DIODE-Local:)', _setup_diode_shutter)
+    model.add_rule(r'^(?P<base>.*EM180:)Acquire$', _setup_quadem_acquire)
+    model.add_rule('^(%s)$' % '|'.join(re.escape(pv) for pv in BEAM_SPOTS), _setup_beam_spot)
+    model.add_rule(r'^SR:OPS-BI\{DCCT:1\}I:Real-I$', _setup_ring_current)
+    model.add_rule(r'^(?P<base>.+?)(?P<suffix>_RBV|-RB)$', _setup_setting_readback)
+    return model
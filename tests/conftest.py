@@ -0,0 +1,39 @@
+'''
+Tests of the profile code that runs without EPICS, IOCs or IPython.
+
+The startup files are not modules: IPython runs them in one namespace, each
+one using the names defined by the previous ones. load_startup() does the
+same for a few files, with the names they need from the rest of the profile
+given as keyword arguments.
+'''
+
+import sys
+from pathlib import Path
+
+import pytest
+
+STARTUP_DIR = Path(__file__).resolve().parents[1] / 'startup'
+
+# xfp_lib and xfp_sim are imported from the startup directory
+sys.path.insert(0, str(STARTUP_DIR))
+
+
+def load_startup(*names, **namespace):
+    '''
+    Run the startup files `names` (in this order) in a new namespace holding
+    `namespace`, and return it.
+    '''
+    ns = {'__name__': '__startup__', 'xfp_print': print}
+    ns.update(namespace)
+    for name in names:
+        path = STARTUP_DIR / name
+        exec(compile(path.read_text(), str(path), 'exec'), ns)
+    return ns
+
+
+@pytest.fixture(autouse=True)
+def user_dirs(tmp_path, monkeypatch):
+    # the startup files create their caches in the appdirs user directories
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmp_path / 'data'))
+    return tmp_path
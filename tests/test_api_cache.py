@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import load_startup
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def api(tmp_path):
+    return load_startup('02-api-cache.py', '02-proposal-utils.py')
+
+
+def test_ttl_by_prefix(api, tmp_path, clock):
+    cache = api['APICache'](tmp_path / 'api.sqlite', ttls=(('proposal/', 60),))
+    assert cache.ttl('proposal/1') == 60
+    assert cache.ttl('facility/nsls2/cycles/current') == 0
+    cache.put('proposal/1', {'proposal': 1})
+    cache.put('other', {'other': 1})
+    assert cache.get('proposal/1') == ({'proposal': 1}, 1000.0, True)
+    # no time-to-live: always stale
+    assert not cache.get('other').fresh
+    clock[0] += 61
+    assert cache.get('proposal/1') == ({'proposal': 1}, 1000.0, False)
+    assert cache.get('proposal/2') is None
+
+
+def test_least_recently_used_are_evicted(api, tmp_path, clock):
+    cache = api['APICache'](tmp_path / 'api.sqlite', max_entries=2)
+    cache.put('a', 1)
+    clock[0] += 1
+    cache.put('b', 2)
+    clock[0] += 1
+    cache.get('a')
+    clock[0] += 1
+    cache.put('c', 3)
+    assert set(cache.get_many(['a', 'b', 'c'])) == {'a', 'c'}
+
+
+def test_invalidate_prefix(api, tmp_path):
+    cache = api['APICache'](tmp_path / 'api.sqlite')
+    cache.put_many({'proposal/1': 1, 'proposal/2': 2, 'facility/nsls2/cycles/current': 3})
+    cache.invalidate('proposal/')
+    assert set(cache.get_many(['proposal/1', 'proposal/2', 'facility/nsls2/cycles/current'])) == \
+        {'facility/nsls2/cycles/current'}
+    cache.invalidate()
+    assert cache.get('facility/nsls2/cycles/current') is None
+
+
+def test_get_from_api_uses_the_cache(api, clock):
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return {'proposal': {'proposal_id': url}}
+
+    api['_fetch_from_api'] = fetch
+    assert api['get_from_api']('proposal/1') == {'proposal': {'proposal_id': 'proposal/1'}}
+    assert api['get_from_api']('proposal/1') == {'proposal': {'proposal_id': 'proposal/1'}}
+    assert fetched == ['proposal/1']
+    with pytest.raises(ValueError):
+        api['get_from_api']('')
+
+
+def test_stale_response_when_the_api_is_down(api, clock):
+    api['api_cache'].put('proposal/1', {'proposal': 'old'})
+    clock[0] += 7 * 3600
+
+    def unavailable(url):
+        raise api['APIUnavailableError'](f'cannot reach {url}')
+
+    api['_fetch_from_api'] = unavailable
+    assert api['get_from_api']('proposal/1') == {'proposal': 'old'}
+    with pytest.raises(api['APIUnavailableError']):
+        api['get_from_api']('proposal/2')
+
+
+def test_get_proposals_info_mixes_cached_fetched_and_stale(api, clock):
+    cache = api['api_cache']
+    cache.put('proposal/3', {'proposal': 'old'})
+    clock[0] += 7 * 3600
+    cache.put('proposal/1', {'proposal': 'cached'})
+    requested = []
+
+    def fetch_many(urls):
+        requested.extend(urls)
+        return {'proposal/2': {'proposal': 'fetched'},
+                'proposal/3': api['APIUnavailableError']('down')}
+
+    api['_fetch_many'] = fetch_many
+    assert api['get_proposals_info'](['1', '2', '3']) == \
+        {'1': 'cached', '2': 'fetched', '3': 'old'}
+    # only the missing and expired proposals are fetched
+    assert requested == ['proposal/2', 'proposal/3']
+    assert cache.get('proposal/2').data == {'proposal': 'fetched'}
+
+
+def test_fetch_many_in_a_running_event_loop(api):
+    async def fetch_many_async(urls):
+        return {url: {'url': url} for url in urls}
+
+    async def in_loop():
+        # e.g. IPython autoawait or Jupyter
+        return api['_fetch_many'](['proposal/1'])
+
+    api['_fetch_many_async'] = fetch_many_async
+    assert asyncio.run(in_loop()) == {'proposal/1': {'url': 'proposal/1'}}
+
+    async def failing(urls):
+        raise RuntimeError('no network')
+
+    api['_fetch_many_async'] = failing
+    with pytest.raises(RuntimeError, match='no network'):
+        asyncio.run(in_loop())
+
+
+def test_get_proposals_info_collects_errors(api):
+    def fetch_many(urls):
+        return {'proposal/1': {'proposal': 'fetched'},
+                'proposal/2': api['APIUnavailableError']('404 Not Found')}
+
+    api['_fetch_many'] = fetch_many
+    with pytest.raises(api['APIUnavailableError']):
+        api['get_proposals_info'](['1', '2'])
+    errors = {}
+    assert api['get_proposals_info'](['1', '2'], errors) == {'1': 'fetched'}
+    assert list(errors) == ['2']
@@ -0,0 +1,104 @@
+import copy
+
+import pytest
+from bluesky import RunEngine
+from bluesky.plans import count
+from bluesky.utils import PersistentDict
+
+from xfp_lib.batched_persistent_dict import BatchedPersistentDict
+
+
+def on_disk(directory):
+    return dict(PersistentDict(str(directory)))
+
+
+def test_assignments_are_written(tmp_path):
+    md = BatchedPersistentDict(tmp_path / 'md')
+    md['proposal'] = {'proposal_id': '123'}
+    del md['proposal']
+    md['SAF'] = '456'
+    assert on_disk(tmp_path / 'md') == {'SAF': '456'}
+    assert BatchedPersistentDict(tmp_path / 'md') == {'SAF': '456'}
+
+
+def test_transaction_writes_at_the_end(tmp_path):
+    md = BatchedPersistentDict(tmp_path / 'md')
+    with md.transaction():
+        md['proposal'] = '123'
+        with md.transaction():
+            md['SAF'] = '456'
+        assert on_disk(tmp_path / 'md') == {}
+        assert md['SAF'] == '456'
+    assert on_disk(tmp_path / 'md') == {'proposal': '123', 'SAF': '456'}
+
+
+def test_transaction_rollback(tmp_path):
+    md = BatchedPersistentDict(tmp_path / 'md')
+    md.update(proposal='123', SAF='456')
+    with pytest.raises(RuntimeError):
+        with md.transaction():
+            md['proposal'] = '789'
+            md['cycle'] = '2024-1'
+            del md['SAF']
+            raise RuntimeError('failed lookup')
+    assert md == {'proposal': '123', 'SAF': '456'}
+    assert on_disk(tmp_path / 'md') == {'proposal': '123', 'SAF': '456'}
+
+
+def test_scan_ids_reserved_by_blocks(tmp_path, monkeypatch):
+    md = BatchedPersistentDict(tmp_path / 'md', scan_id_block=10)
+    md['scan_id'] = 10
+    assert on_disk(tmp_path / 'md') == {'scan_id': 10}
+    writes = []
+    store_setitem = PersistentDict.__setitem__
+    monkeypatch.setattr(PersistentDict, '__setitem__',
+                        lambda store, key, value: (writes.append(value),
+                                                   store_setitem(store, key, value)))
+    # the next runs: 11-20 reserved at once, then 21-30
+    for scan_id in range(11, 26):
+        md['scan_id'] = scan_id
+        assert md['scan_id'] == scan_id
+    assert writes == [20, 30]
+    md.flush()
+    assert on_disk(tmp_path / 'md') == {'scan_id': 25}
+    # set by hand: written as is
+    md['scan_id'] = 100
+    assert on_disk(tmp_path / 'md') == {'scan_id': 100}
+    md['scan_id'] = 101
+    assert on_disk(tmp_path / 'md') == {'scan_id': 110}
+
+
+def test_scan_id_never_repeats_after_a_crash(tmp_path):
+    RE = RunEngine({})
+    RE.md = BatchedPersistentDict(tmp_path / 'md', scan_id_block=3)
+    scan_ids = []
+
+    def check_start(name, doc):
+        # the session could die now: the scan_id must already be on disk
+        scan_ids.append(doc['scan_id'])
+        assert on_disk(tmp_path / 'md')['scan_id'] >= doc['scan_id']
+
+    RE.subscribe(check_start, 'start')
+    for _ in range(5):
+        RE(count([]))
+    # crash: the actual scan_id is never written
+    RE.md._finalizer.detach()
+    RE.md = BatchedPersistentDict(tmp_path / 'md', scan_id_block=3)
+    for _ in range(2):
+        RE(count([]))
+    assert scan_ids == [1, 2, 3, 4, 5, 8, 9]
+    # a clean exit writes the actual scan_id: no gap
+    RE.md._finalizer()
+    RE.md = BatchedPersistentDict(tmp_path / 'md', scan_id_block=3)
+    RE(count([]))
+    assert scan_ids[-1] == 10
+
+
+def test_reload_and_deepcopy(tmp_path):
+    md = BatchedPersistentDict(tmp_path / 'md')
+    md['sample'] = {'color': 'red'}
+    PersistentDict(str(tmp_path / 'md'))['sample'] = {'color': 'blue'}
+    md.reload()
+    assert md['sample'] == {'color': 'blue'}
+    copied = copy.deepcopy(md)
+    assert type(copied) is dict and copied == {'sample': {'color': 'blue'}}
@@ -0,0 +1,126 @@
+import json
+import time
+import types
+
+import bluesky.plan_stubs as bps
+import pytest
+from bluesky import RunEngine
+from ophyd.positioner import SoftPositioner
+from ophyd.sim import SynAxis
+
+from xfp_sim import bench
+
+
+def plan(motor):
+    yield from bps.open_run()
+    yield from bps.mv(motor, 1)
+    yield from bps.sleep(0.05)
+    yield from bps.close_run()
+
+
+@pytest.fixture
+def RE():
+    return RunEngine({})
+
+
+@pytest.fixture
+def motor():
+    return SynAxis(name='motor', delay=0.05)
+
+
+def test_phase_timer(RE):
+    # devices are timed by name first, then as positioners
+    shutter = SynAxis(name='shutter', delay=0.05)
+    motor = SoftPositioner(name='motor', init_pos=0)
+    timer = bench.PhaseTimer()
+    RE(timer.wrap(plan(shutter)))
+    RE(timer.wrap(bps.mv(motor, 1)))
+    phases = timer.phases
+    assert set(phases) == set(bench.PHASES)
+    assert phases['shutter'] >= 0.04
+    assert phases['sleep'] >= 0.04
+    assert phases['motion'] > 0
+    assert phases['documents'] > 0
+    assert phases['exposure'] == 0
+    assert timer.n_messages == 7
+
+
+def test_phase_timer_passes_errors_to_the_plan(RE):
+    caught = []
+
+    def failing():
+        try:
+            yield from bps.mv(types.SimpleNamespace(), 1)
+        except Exception as err:
+            caught.append(err)
+        yield from bps.null()
+
+    RE(bench.PhaseTimer().wrap(failing()))
+    assert len(caught) == 1
+
+
+@pytest.fixture
+def benchmarks(monkeypatch, motor):
+    def quick(ns, workdir):
+        '''Move a simulated motor.'''
+        return plan(motor)
+
+    def failing(ns, workdir):
+        '''Fail at once.'''
+        raise RuntimeError('no sample')
+        yield
+
+    monkeypatch.setattr(bench, 'BENCHMARKS', {'quick': (quick, 10), 'slow': (quick, 0),
+                                              'failing': (failing, 10)})
+
+
+def test_run_benchmarks(RE, benchmarks, tmp_path):
+    history_file = tmp_path / 'history.jsonl'
+    ns = {'XFP_SIM': True, 'RE': RE, 'sim_model': types.SimpleNamespace(speed=1)}
+    entry = bench.run_benchmarks(ns=ns, history_file=history_file)
+    results = entry['results']
+    assert results['quick']['error'] is None
+    assert results['quick']['documents'] == {'start': 1, 'stop': 1}
+    assert 0 < results['quick']['wall'] < results['quick']['budget']
+    assert 'no sample' in results['failing']['error']
+    bench.run_benchmarks(['quick'], ns=ns, history_file=history_file)
+    assert [list(e['results']) for e in bench.load_history(history_file)] == \
+        [['quick', 'slow', 'failing'], ['quick']]
+    with pytest.raises(ValueError, match='Unknown benchmarks'):
+        bench.run_benchmarks(['other'], ns=ns, history_file=history_file)
+
+
+def test_run_benchmarks_only_in_the_simulation(RE, benchmarks, tmp_path):
+    with pytest.raises(RuntimeError, match='XFP_SIM=1'):
+        bench.run_benchmarks(ns={'RE': RE}, history_file=tmp_path / 'history.jsonl')
+    assert not (tmp_path / 'history.jsonl').exists()
+
+
+def test_previous_results():
+    history = [{'commit': 'a', 'speed': 1, 'results': {'x': {'wall': 3.0, 'error': None}}},
+               {'commit': 'b', 'speed': 10, 'results': {'x': {'wall': 1.0, 'error': None}}},
+               {'commit': 'c', 'speed': 1, 'results': {'x': {'wall': 2.0, 'error': 'boom'}}},
+               {'commit': 'd', 'speed': 1, 'results': {'x': {'wall': 9.0, 'error': None}}}]
+    assert bench.previous_results(history, 'd', 1) == {'x': ('a', 3.0)}
+
+
+def test_load_history_skips_broken_lines(tmp_path):
+    history_file = tmp_path / 'history.jsonl'
+    assert bench.load_history(history_file) == []
+    history_file.write_text(json.dumps({'commit': 'a'}) + '\n{"commit": \n')
+    assert bench.load_history(history_file) == [{'commit': 'a'}]
+
+
+@pytest.mark.parametrize('result, fails', [
+    ({'error': None, 'wall': 1.0, 'budget': 2}, False),
+    ({'error': None, 'wall': 3.0, 'budget': 2}, True),
+    ({'error': 'RuntimeError()', 'wall': 1.0, 'budget': 2}, True),
+])
+def test_main_raises_on_failure(monkeypatch, result, fails):
+    entry = {'time': time.time(), 'commit': 'a', 'speed': 1, 'results': {'quick': result}}
+    monkeypatch.setattr(bench, 'run_benchmarks', lambda names=None: entry)
+    if fails:
+        with pytest.raises(RuntimeError, match='quick'):
+            bench.main()
+    else:
+        bench.main()
@@ -0,0 +1,51 @@
+import ophyd
+import pytest
+from ophyd import Component as Cpt, Device, EpicsSignal, Signal
+
+import xfp_sim
+from conftest import load_startup
+
+
+@pytest.fixture(scope='module')
+def fp_devs():
+    # the devices of the file are built on the simulated PVs
+    cl = ophyd.cl
+    xfp_sim.install(speed=100)
+    try:
+        yield load_startup('10-fp-devs.py', AgressiveSignal=EpicsSignal)
+    finally:
+        ophyd.cl = cl
+
+
+@pytest.fixture
+def device(fp_devs):
+    class Monitored(fp_devs['MonitorCollectMixin'], Device):
+        sts = Cpt(Signal, value='Idle')
+        monitor_collect_attrs = ('sts',)
+
+    return Monitored(name='pump')
+
+
+def collected(device):
+    return [(doc['data']['pump_sts'], doc['time']) for doc in device.collect()]
+
+
+def test_monitor_updates_are_collected(device):
+    assert list(device.describe_collect()) == ['pump_sts_monitor']
+    device.start_monitor_collect()
+    device.sts.put('Running')
+    device.stop_monitor_collect()
+    device.sts.put('Stopped')
+    assert [value for value, _ in collected(device)] == ['Running']
+    assert collected(device) == []
+
+
+def test_uncollected_updates_are_kept_by_the_next_kickoff(device):
+    device.start_monitor_collect()
+    device.sts.put('Running')
+    device.stop_monitor_collect()
+    # the second kickoff starts with the current value
+    device.start_monitor_collect()
+    device.sts.put('Idle')
+    device.stop_monitor_collect()
+    assert [value for value, _ in collected(device)] == ['Running', 'Running', 'Idle']
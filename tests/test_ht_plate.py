@@ -0,0 +1,26 @@
+import bluesky.plan_stubs as bps
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import load_startup
+
+WHEEL_POSITIONS = [{'angle': 45 * i, 'angle_egu': 'deg', 'thickness': t, 'thickness_egu': 'um'}
+                   for i, t in enumerate((0, 762, 508, 305, 203, 152, 76, 25))]
+
+
+@pytest.fixture(scope='module')
+def ht():
+    return load_startup('13-settle.py', '96-ht-trajectory.py', '97-ht-plate.py',
+                        np=np, pd=pd, bps=bps)
+
+
+def test_plate_from_plan_keeps_unknown_filters(ht):
+    filter_wheel = type('FilterWheel', (), {'wheel_positions': WHEEL_POSITIONS})()
+    records = [{'slot': 3, 'exposure': 20.0, 'filter': None, 'name': 'a', 'notes': ''},
+               {'slot': 4, 'exposure': 0.0, 'filter': 2, 'name': 'b', 'notes': ''},
+               {'slot': 5, 'exposure': 10.0, 'filter': 2, 'name': 'c', 'notes': 'n'}]
+    plate = ht['plate_from_plan'](records, filter_obj=filter_wheel)
+    assert [(d['position'], d['filter_index']) for d in plate] == [(3, None), (5, 2)]
+    assert plate[0]['filter_text'] == ht['KEEP_FILTER_TEXT']
+    assert plate[1]['filter_text'] == ht['filter_texts'](WHEEL_POSITIONS)[2]
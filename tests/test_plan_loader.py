@@ -0,0 +1,172 @@
+import io
+import json
+import types
+
+import pandas as pd
+import pytest
+
+from conftest import STARTUP_DIR, load_startup
+
+EXAMPLE = STARTUP_DIR / 'examples' / 'example.json'
+
+# thickness [um] of the filter wheel positions (as in 25-filter.py)
+THICKNESSES = (0, 762, 508, 305, 203, 152, 76, 25)
+
+
+@pytest.fixture(scope='module')
+def loader():
+    filter_wheel = types.SimpleNamespace(wheel_positions=[{'thickness': t} for t in THICKNESSES])
+    return load_startup('88-plan-loader.py', filter_wheel=filter_wheel)
+
+
+def excel_plan(n_slots=96, **changes):
+    columns = {'Location': [f'{chr(72 - j % 8)}{j // 8 + 1}' for j in range(n_slots)],
+               'Sample name': [f'sample {j}' for j in range(n_slots)],
+               'Exposure time (ms)': [20.0] * n_slots,
+               'Filter Thickness (um)': [0] * n_slots,
+               'Notes': [''] * n_slots}
+    columns.update(changes)
+    buffer = io.BytesIO()
+    pd.DataFrame({key: value for key, value in columns.items() if value is not None}).to_excel(
+        buffer, index=False)
+    return buffer.getvalue()
+
+
+def ht_doc(**changes):
+    doc = json.loads(EXAMPLE.read_text())
+    for key, value in changes.items():
+        doc['columns'][key] = value
+    return doc
+
+
+def parse(loader, doc):
+    return loader['parse_ht_plan'](json.dumps(doc).encode(), '.json', THICKNESSES)
+
+
+def test_parse_excel_plan(loader):
+    thicknesses = [76 if j == 5 else 1 if j == 6 else 0 for j in range(96)]
+    records = loader['parse_ht_plan'](excel_plan(**{'Filter Thickness (um)': thicknesses}),
+                                      '.xlsx', THICKNESSES)
+    assert [r['slot'] for r in records] == list(range(96))
+    assert records[0] == {'slot': 0, 'location': 'H1', 'name': 'sample 0', 'exposure': 20.0,
+                          'notes': '', 'filter': 0}
+    assert records[5]['filter'] == THICKNESSES.index(76)
+    # no wheel position has the thickness: the filter is kept
+    assert records[6]['filter'] is None
+    # without the filter column, every slot keeps the filter
+    records = loader['parse_ht_plan'](excel_plan(**{'Filter Thickness (um)': None}),
+                                      '.xlsx', THICKNESSES)
+    assert {r['filter'] for r in records} == {None}
+
+
+@pytest.mark.parametrize('changes, message', [
+    ({'Exposure time (ms)': [20.0] * 10 + ['x'] + [20.0] * 85}, 'Invalid exposure time .ms. in rows 12'),
+    ({'Notes': None}, 'Missing columns: Notes'),
+    ({'n_slots': 95}, 'The plan has 95 rows instead of 96'),
+])
+def test_invalid_excel_plan(loader, changes, message):
+    with pytest.raises(loader['PlanFileError'], match=message):
+        loader['parse_ht_plan'](excel_plan(**changes), '.xlsx', THICKNESSES)
+
+
+def test_plan_cache(loader, tmp_path):
+    calls = []
+
+    def parser(data, suffix, *args):
+        calls.append(suffix)
+        return [len(data)]
+
+    cache = loader['PlanCache'](max_entries=2)
+    plan = tmp_path / 'a.json'
+    plan.write_text('{}')
+    assert cache.parse(plan, parser, 1) == [2]
+    assert cache.cached(plan, parser, 1) == [2]
+    assert cache.parse(plan, parser, 1) == [2]
+    # a copy has the same content: not parsed again
+    copy = tmp_path / 'b.json'
+    copy.write_text('{}')
+    assert cache.parse(copy, parser, 1) == [2]
+    assert calls == ['.json']
+    # other arguments or a changed file are parsed again
+    assert cache.parse(plan, parser, 2) == [2]
+    plan.write_text('{ }')
+    assert cache.cached(plan, parser, 1) is None
+    assert cache.parse(plan, parser, 1) == [3]
+    assert len(calls) == 3
+    # only the last two plans are kept
+    assert cache.parse(copy, parser, 2) == [2]
+    assert cache.parse(copy, parser, 1) == [2]
+    assert len(calls) == 4
+
+
+def test_parse_example(loader):
+    records = parse(loader, ht_doc())
+    assert len(records) == 96
+    assert records[0] == {'slot': 0, 'location': 'H1', 'name': 'sample name 1',
+                          'exposure': 30.0, 'notes': 'note 1', 'filter': None}
+
+
+def test_slots_are_sorted_and_filters_indexed(loader):
+    doc = ht_doc(filter=[76 if j == 5 else None for j in range(96)])
+    columns = doc['columns']
+    for key in columns:
+        columns[key] = columns[key][::-1]
+    records = parse(loader, doc)
+    assert [r['slot'] for r in records] == list(range(96))
+    assert records[5]['filter'] == THICKNESSES.index(76)
+    assert records[4]['filter'] is None
+
+
+@pytest.mark.parametrize('change, message', [
+    ({'version': 2}, 'Unsupported plan format version'),
+    ({'kind': 'htfly'}, "not 'ht'"),
+    ({'format': 'other'}, 'Not an xfp-plan document'),
+])
+def test_invalid_header(loader, change, message):
+    doc = dict(ht_doc(), **change)
+    with pytest.raises(loader['PlanFileError'], match=message):
+        parse(loader, doc)
+
+
+@pytest.mark.parametrize('column, value, message', [
+    ('exposure', [True] + [0.0] * 95, 'Invalid exposure of the slots at positions 0'),
+    ('exposure', [0.0] * 95 + [-1.0], 'Invalid exposure of the slots at positions 95'),
+    ('exposure', [None] * 96, 'Invalid exposure'),
+    ('slot', [0] * 96, 'The slots must be 0 to 95, each once'),
+    ('filter', [1.5] + [None] * 95, 'No filter wheel position has the thickness'),
+    ('name', ['x'] * 95, "Column 'name' must be a list of 96 values"),
+])
+def test_invalid_columns(loader, column, value, message):
+    with pytest.raises(loader['PlanFileError'], match=message):
+        parse(loader, ht_doc(**{column: value}))
+
+
+def test_missing_and_unknown_columns(loader):
+    doc = ht_doc()
+    del doc['columns']['notes']
+    with pytest.raises(loader['PlanFileError'], match='Missing columns: notes'):
+        parse(loader, doc)
+    with pytest.raises(loader['PlanFileError'], match='Unknown columns: extra'):
+        parse(loader, ht_doc(extra=[0] * 96))
+    with pytest.raises(loader['PlanFileError'], match='Not a JSON document'):
+        loader['parse_ht_plan'](b'{', '.json', THICKNESSES)
+
+
+def test_excel_round_trip(loader, tmp_path):
+    plan = tmp_path / 'plan.json'
+    plan.write_text(json.dumps(ht_doc(filter=[25] * 96)))
+    loader['plan_to_excel'](plan, tmp_path / 'plan.xlsx')
+    loader['excel_to_plan'](tmp_path / 'plan.xlsx', tmp_path / 'back.json')
+    assert parse(loader, json.loads((tmp_path / 'back.json').read_text())) == \
+        parse(loader, json.loads(plan.read_text()))
+    # keeping the filter of some slots only cannot be written to Excel
+    plan.write_text(json.dumps(ht_doc(filter=[25] + [None] * 95)))
+    with pytest.raises(loader['PlanFileError'], match='cannot be kept'):
+        loader['plan_to_excel'](plan, tmp_path / 'partial.xlsx')
+
+
+def test_load_plan(loader, tmp_path):
+    plan = tmp_path / 'plan.json'
+    plan.write_text(json.dumps(ht_doc(filter=[508] * 96)))
+    records = loader['load_plan'](plan, cache=loader['PlanCache']())
+    assert {r['filter'] for r in records} == {THICKNESSES.index(508)}
@@ -0,0 +1,133 @@
+import builtins
+import sqlite3
+import types
+
+import pytest
+
+from conftest import load_startup
+from xfp_lib.batched_persistent_dict import BatchedPersistentDict
+
+CYCLE = '2024-1'
+NEXT_CYCLE = '2024-2'
+
+PROPOSALS = {
+    '310001': {'title': 'Footprinting of RNA', 'type': 'General User', 'instruments': ['XFP'],
+               'users': [{'first_name': 'Ann', 'last_name': 'Smith', 'is_pi': True},
+                         {'first_name': 'Bob', 'last_name': 'Jones', 'is_pi': False}],
+               'safs': [{'saf_id': 9, 'status': 'APPROVED'},
+                        {'saf_id': 12, 'status': 'APPROVED'},
+                        {'saf_id': 15, 'status': 'PENDING'}]},
+    '310002': {'title': 'Membrane proteins', 'type': 'Rapid Access', 'instruments': ['XFP', 'AMX'],
+               'users': [{'first_name': 'Carl', 'last_name': 'Smithson', 'is_pi': False},
+                         {'first_name': 'Dana', 'last_name': 'Lee', 'is_pi': True}],
+               'safs': []},
+    '310003': {'title': 'Crystals', 'type': 'General User', 'instruments': ['AMX'],
+               'users': [{'first_name': 'Eve', 'last_name': 'Smith', 'is_pi': True}],
+               'safs': [{'saf_id': 20, 'status': 'APPROVED'}]},
+}
+
+
+CYCLES = {CYCLE: list(PROPOSALS), NEXT_CYCLE: ['310001', '310004']}
+
+
+@pytest.fixture
+def index_ns(tmp_path):
+    requests = []
+
+    def get_proposals_from_cycle(cycle):
+        requests.append(cycle)
+        return CYCLES[cycle]
+
+    def get_proposals_info(proposal_ids, errors=None):
+        proposals = {}
+        for proposal_id in proposal_ids:
+            if proposal_id in PROPOSALS:
+                proposals[proposal_id] = PROPOSALS[proposal_id]
+            elif errors is None:
+                raise ValueError(f'Proposal {proposal_id} not found')
+            else:
+                errors[proposal_id] = ValueError(f'Proposal {proposal_id} not found')
+        return proposals
+
+    ns = load_startup('03-proposal-index.py',
+                      get_proposals_from_cycle=get_proposals_from_cycle,
+                      get_proposals_info=get_proposals_info,
+                      get_current_cycle=lambda: CYCLE,
+                      RE=types.SimpleNamespace(md=BatchedPersistentDict(tmp_path / 'md')))
+    ns['requests'] = requests
+    return ns
+
+
+def test_search_by_last_name_prefix(index_ns):
+    index = index_ns['proposal_index']
+    assert index.build(CYCLE) == 3
+    matches = index.search('smi', cycle=CYCLE)
+    assert [m['proposal_id'] for m in matches] == ['310002', '310001']
+    assert matches[1]['pis'] == ['Smith']
+    assert matches[1]['approved_safs'] == ['12', '9']
+    assert matches[0]['matched_users'] == ['Smithson']
+    assert [m['proposal_id'] for m in index.search('SMITH', pi_only=True)] == ['310001']
+    assert [m['proposal_id'] for m in index.search('smith', instrument=None, pi_only=True)] == \
+        ['310003', '310001']
+    assert index.search('nobody') == []
+
+
+def test_ensure_rebuilds_old_indexes(index_ns):
+    index = index_ns['proposal_index']
+    assert index.age(CYCLE) is None
+    index.ensure(CYCLE)
+    index.ensure(CYCLE)
+    assert index_ns['requests'] == [CYCLE]
+    index.ensure(CYCLE, max_age=-1)
+    assert index_ns['requests'] == [CYCLE, CYCLE]
+    # rebuilding does not duplicate the rows
+    assert len(index.search('smith', cycle=CYCLE, instrument=None)) == 3
+
+
+def test_proposals_of_several_cycles(index_ns, capsys):
+    index = index_ns['proposal_index']
+    index.build(CYCLE)
+    # 310004 cannot be fetched: skipped, the others are indexed
+    assert index.build(NEXT_CYCLE) == 1
+    assert 'Skipped 1 proposals of the 2024-2 cycle that could not be fetched: 310004' in \
+        capsys.readouterr().out
+    assert [m['proposal_id'] for m in index.search('smi', cycle=CYCLE)] == ['310002', '310001']
+    assert [m['proposal_id'] for m in index.search('smi', cycle=NEXT_CYCLE)] == ['310001']
+    assert index.proposal('310001')['cycles'] == [CYCLE, NEXT_CYCLE]
+    # rebuilding a cycle keeps the proposals of the other cycles
+    index.build(CYCLE)
+    assert index.proposal('310001')['cycles'] == [CYCLE, NEXT_CYCLE]
+    assert index.proposal('310002')['cycles'] == [CYCLE]
+
+
+def test_build_fails_if_no_proposal_can_be_fetched(index_ns, monkeypatch):
+    monkeypatch.setitem(CYCLES, NEXT_CYCLE, ['310004'])
+    index = index_ns['proposal_index']
+    with pytest.raises(ValueError, match='310004'):
+        index.build(NEXT_CYCLE)
+    assert index.age(NEXT_CYCLE) is None
+
+
+def test_old_schema_is_rebuilt(index_ns, tmp_path):
+    index_cls = index_ns['ProposalIndex']
+    with sqlite3.connect(tmp_path / 'old.sqlite') as conn:
+        conn.execute('CREATE TABLE proposals (proposal_id TEXT PRIMARY KEY, cycle TEXT, '
+                     'title TEXT, type TEXT, instruments TEXT)')
+        conn.execute("INSERT INTO proposals VALUES ('1', '2023-3', 't', 'GU', '[]')")
+    conn.close()
+    index = index_cls(tmp_path / 'old.sqlite')
+    assert index.proposal('1') is None
+    assert index.build(CYCLE) == 3
+
+
+def test_set_user_md_search(index_ns, monkeypatch):
+    monkeypatch.setattr(builtins, 'input', lambda prompt: '2')
+    index_ns['set_user_md_search']('smi')
+    md = index_ns['RE'].md
+    assert dict(md) == {'proposal': '310001', 'SAF': '12', 'PI': 'Smith', 'experimenter': 'Smith'}
+
+
+def test_set_user_md_search_without_saf(index_ns, monkeypatch):
+    monkeypatch.setattr(builtins, 'input', lambda prompt: '1')
+    index_ns['set_user_md_search']('smi')
+    assert dict(index_ns['RE'].md) == {}
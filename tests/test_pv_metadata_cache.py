@@ -0,0 +1,62 @@
+import json
+import types
+
+import pytest
+
+from conftest import load_startup
+
+
+@pytest.fixture
+def cache_cls():
+    return load_startup('08-pv-metadata-cache.py')['PVMetadataCache']
+
+
+def signal(pvname, connected=False, **live):
+    sig = types.SimpleNamespace(pvname=pvname, connected=connected, subscriptions=[],
+                                **dict({'enum_strs': None, 'limits': (0, 0)}, **live))
+    sig.subscribe = lambda callback, **kwargs: sig.subscriptions.append(callback)
+    sig.get = lambda: live.get('value')
+    sig.wait_for_connection = lambda timeout: None
+    return sig
+
+
+def test_defaults_for_unconnected_signals(cache_cls, tmp_path):
+    cache = cache_cls(tmp_path / 'pv.json')
+    sts = signal('XF:17BM-ES{Pmp}Sts')
+    assert cache.enum_strs(sts) is None
+    assert cache.limits(sts, default=(-1, 1)) == (-1, 1)
+    cache.update(sts.pvname, enum_strs=('Idle', 'Running'), lower_ctrl_limit=-5.0,
+                 upper_ctrl_limit=5.0)
+    assert cache.enum_strs(sts) == ('Idle', 'Running')
+    assert cache.limits(sts) == (-5.0, 5.0)
+    # the signal itself is left alone
+    assert sts.enum_strs is None and sts.limits == (0, 0)
+    # connected signals give their live metadata
+    live = signal(sts.pvname, connected=True, enum_strs=('Stop', 'Run'), limits=(0, 10))
+    assert cache.enum_strs(live) == ('Stop', 'Run')
+    assert cache.limits(live) == (0, 10)
+
+
+def test_value_follows_the_signal(cache_cls, tmp_path):
+    cache = cache_cls(tmp_path / 'pv.json')
+    egu = signal('XF:17BM-ES{Flt}Mtr.EGU')
+    assert cache.value(egu, default='deg') == 'deg'
+    egu.subscriptions[0](obj=egu, value='mrad')
+    assert cache.value(egu, default='deg') == 'mrad'
+
+
+def test_saved_and_expired(cache_cls, tmp_path):
+    path = tmp_path / 'pv.json'
+    cache = cache_cls(path, save_delay=60)
+    cache.update('XF:A', units='mm', precision=3)
+    cache.update('XF:B', units='s')
+    cache.save()
+    assert cache_cls(path).get('XF:A', 'units') == 'mm'
+    cache.invalidate('XF:B')
+    cache.save()
+    assert cache_cls(path).get('XF:B', 'units') is None
+    assert cache_cls(path, max_age=-1).get('XF:A', 'units') is None
+    path.write_text('{')
+    assert cache_cls(path).get('XF:A', 'units') is None
+    path.write_text(json.dumps({'version': 0, 'pvs': {}}))
+    assert cache_cls(path).get('XF:A', 'units') is None
@@ -0,0 +1,117 @@
+import itertools
+import random
+
+import bluesky.plan_stubs as bps
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import load_startup
+
+ROWS, COLS = 12, 8
+X = [9.0 * (j % COLS) for j in range(ROWS * COLS)]
+Y = [9.0 * (j // COLS) for j in range(ROWS * COLS)]
+
+WHEEL_POSITIONS = [{'angle': 45 * i, 'angle_egu': 'deg', 'thickness': t, 'thickness_egu': 'um'}
+                   for i, t in enumerate((0, 762, 508, 305, 203, 152, 76, 25))]
+
+
+@pytest.fixture(scope='module')
+def ht():
+    return load_startup('13-settle.py', '96-ht-trajectory.py', '97-ht-plate.py',
+                        np=np, pd=pd, bps=bps)
+
+
+@pytest.fixture(scope='module')
+def model(ht):
+    return ht['SlotTimeModel'](filter_angles=[pos['angle'] for pos in WHEEL_POSITIONS])
+
+
+def slot(position, exposure=20.0, filter_index=0):
+    return {'position': position, 'exposure': exposure, 'filter_index': filter_index}
+
+
+def state(position, exposure=20.0, filter_index=0):
+    return {'x': X[position], 'y': Y[position], 'exposure': exposure,
+            'filter_index': filter_index}
+
+
+def path_cost(cost, path):
+    return sum(cost[a][b] for a, b in zip(path, path[1:]))
+
+
+def test_time_model(ht, model):
+    a = state(0)
+    assert model.time(a, a) == model.move_overhead + model.settle_window
+    far = model.time(a, state(7))
+    assert far > model.time(a, state(1))
+    # the filter rotation and the exposure change overlap with the move
+    assert model.time(a, state(1, filter_index=1)) >= model.time(a, state(1))
+    assert model.time(a, state(0, exposure=50.0)) == model.exposure_change_time
+    # an unknown filter may need a half turn; None in the next slot keeps it
+    assert model.time(state(0, filter_index=None), state(0, filter_index=4)) == \
+        model.time(state(0, filter_index=0), state(0, filter_index=4))
+    assert model.time(state(0, filter_index=3), state(0, filter_index=None)) == \
+        model.time(a, a)
+
+
+def test_improve_never_makes_a_path_slower(ht):
+    # asymmetric costs: the reversed segments must be costed both ways
+    rng = random.Random(1)
+    for _ in range(50):
+        n = 9
+        cost = [[0 if i == j else rng.uniform(0, 10) for j in range(n)] for i in range(n)]
+        path = [0] + rng.sample(range(1, n), n - 1)
+        before = path_cost(cost, path)
+        improved = ht['_improve'](cost, list(path), set())
+        assert sorted(improved) == list(range(n)) and improved[0] == 0
+        assert path_cost(cost, improved) <= before + 1e-9
+
+
+def test_plan_slot_order_is_fastest(ht, model):
+    rng = random.Random(2)
+    slots = [slot(p, exposure=rng.choice([10.0, 20.0]), filter_index=rng.choice([0, 3, 7]))
+             for p in rng.sample(range(ROWS * COLS), 30)]
+    start = state(0, filter_index=None)
+    fastest = ht['order_slots'](slots, 'fastest', X, Y, start=start, model=model)
+    assert sorted(s['position'] for s in fastest) == sorted(s['position'] for s in slots)
+    walk_time = ht['predicted_walk_time']
+    for order in ('snake', 'slots'):
+        other = ht['order_slots'](slots, order, X, Y)
+        assert walk_time(fastest, X, Y, start=start, model=model) < \
+            walk_time(other, X, Y, start=start, model=model)
+
+
+def test_plan_slot_order_small_is_optimal(ht, model):
+    slots = [slot(p, filter_index=f) for p, f in ((5, 0), (40, 7), (2, 3), (77, 0), (30, 7))]
+    start = state(0)
+    walk_time = ht['predicted_walk_time']
+    best = min(walk_time(list(p), X, Y, start=start, model=model)
+               for p in itertools.permutations(slots))
+    ordered = ht['plan_slot_order'](slots, X, Y, start=start, model=model)
+    assert walk_time(ordered, X, Y, start=start, model=model) == pytest.approx(best)
+
+
+def test_required_order(ht, model):
+    slots = [slot(p) for p in range(0, 96, 5)]
+    required = [90, 0, 45]
+    ordered = ht['plan_slot_order'](slots, X, Y, model=model, required_order=required)
+    positions = [s['position'] for s in ordered]
+    assert sorted(positions) == list(range(0, 96, 5))
+    assert [p for p in positions if p in required] == required
+    with pytest.raises(ValueError):
+        ht['plan_slot_order'](slots, X, Y, model=model, required_order=[0, 5, 0])
+    assert ht['plan_slot_order']([], X, Y, model=model) == []
+
+
+def test_snake_and_slots_orders(ht):
+    slots = [slot(p) for p in (17, 1, 0, 9, 8, 30)]
+    order = ht['order_slots']
+    assert [s['position'] for s in order(slots, 'slots', X, Y)] == [0, 1, 8, 9, 17, 30]
+    # rows 0, 1, 2 and 3 alternate directions, skipping empty rows
+    assert [s['position'] for s in order(slots, 'snake', X, Y)] == [0, 1, 9, 8, 17, 30]
+    with pytest.raises(ValueError, match='Unknown order'):
+        order(slots, 'random', X, Y)
+    with pytest.raises(ValueError, match='twice'):
+        order(slots + [slot(1)], 'slots', X, Y)
+